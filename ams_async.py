@@ -0,0 +1,733 @@
+# coding: utf-8
+
+#asyncio API for the AMS REST and blob workflow, one event loop and one connection pool (requires aiohttp)
+import os
+import json
+import time
+import asyncio
+import datetime
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+import aiohttp
+
+import ams_face_track_api as ams
+import ams_metrics
+import ams_scheduler
+import ams_odata
+
+# Connections kept open by the shared aiohttp connector (AMS and blob storage together)
+async_pool_limit = 200
+
+# Workflows in flight at once in process_videos()
+async_max_workflows = 300
+
+# Blob storage REST API
+storage_xmsversion  = '2017-04-17'
+blob_endpoint       = 'https://{0}.blob.core.windows.net/'
+download_chunk_size = 1024 * 1024
+
+# Connection errors retried by the schedulers (idempotent calls only)
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+class AsyncResponse(object):
+    '''Buffered HTTP response with the requests.Response attributes the workflow uses.'''
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+class AsyncAMSClient(object):
+    '''asyncio counterpart of AMSRestClient.
+
+    One aiohttp session (and so one connection pool) serves every AMS and blob
+    call of the event loop. Headers are built once per token and the redirected
+    AMS endpoint is cached after the first 301, and calls are rate limited and
+    retried by the account schedulers, as in AMSRestClient.
+
+    Usage:
+        async with AsyncAMSClient(token_provider=provider) as client:
+            response = await client.create_media_asset(name)
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        endpoint (str): Azure Media Services Initial Endpoint.
+        redirected_endpoint (str): Azure Media Services Redirected Endpoint, if already known.
+        token_provider (AccessTokenProvider): Token source, takes over from access_token.
+        limit (int): Maximum number of open connections.
+    '''
+    # header and endpoint handling is shared with the sync client
+    set_access_token = ams.AMSRestClient.set_access_token
+    headers = ams.AMSRestClient.headers
+    url_for = ams.AMSRestClient.url_for
+
+    def __init__(self, access_token=None, endpoint=None, redirected_endpoint=None, token_provider=None, limit=async_pool_limit):
+        self.endpoint = endpoint if endpoint is not None else ams.ams_rest_endpoint
+        self.redirected_endpoint = redirected_endpoint
+        self.scheduler = ams_scheduler.for_ams(self.endpoint)
+        self.token_provider = token_provider
+        self.limit = limit
+        self.session = None
+        self.access_token = None
+        self._headers = {}
+        self.set_access_token(access_token)
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        '''Create the session, on the running event loop.'''
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.limit))
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _refresh_token(self, force=False):
+        # adal is blocking: only go to a thread when the token has to be renewed
+        if self.token_provider is None:
+            return
+        if self.token_provider.is_valid() and not force:
+            self.set_access_token(self.token_provider.access_token)
+        else:
+            loop = asyncio.get_running_loop()
+            self.set_access_token(await loop.run_in_executor(None, self.token_provider.refresh, force))
+
+    async def _send(self, method, url, body=None, headers=None, allow_redirects=False):
+        await self.open()
+        async with self.session.request(method, url, data=body, headers=headers, allow_redirects=allow_redirects) as response:
+            content = await response.read()
+            return AsyncResponse(response.status, response.headers, content, str(response.url))
+
+    async def _send_blob(self, method, url, body=None, headers=None):
+        # a blob call under the storage account's scheduler
+        scheduler = ams_scheduler.for_blob(urllib.parse.urlsplit(url).netloc.split('.')[0])
+        return await scheduler.call_async(lambda: self._send(method, url, body, headers), method, RETRY_EXCEPTIONS)
+
+    async def request(self, method, path, body=None, rformat="json", content_type=True, extra_headers=None):
+        '''Do an AMS HTTP request, following (and caching) the AMS redirect.
+
+        Args:
+            method (str): HTTP method.
+            path (str): Azure Media Services Endpoint Path (with its query, if any).
+            body  (str): Azure Media Services Content Body.
+            rformat (str): A required JSON Accept Format.
+            content_type (bool): Send the Content-Type header.
+            extra_headers (dict): Headers added to (or replacing) the AMS headers.
+
+        Returns:
+            AsyncResponse.
+        '''
+        return await self.scheduler.call_async(lambda: self._request(method, path, body, rformat, content_type, extra_headers), method, RETRY_EXCEPTIONS)
+
+    def _headers_for(self, rformat, content_type, extra_headers):
+        headers = self.headers(rformat, content_type)
+        return dict(headers, **extra_headers) if extra_headers else headers
+
+    async def _request(self, method, path, body, rformat, content_type, extra_headers=None):
+        await self._refresh_token()
+        started = time.time()
+        url = self.url_for(''.join([self.endpoint, path]), path)
+        response = await self._send(method, url, body, self._headers_for(rformat, content_type, extra_headers))
+        if response.status_code == 401 and self.token_provider is not None:
+            # The token was revoked or expired early, get a new one and try once more
+            await self._refresh_token(force=True)
+            response = await self._send(method, url, body, self._headers_for(rformat, content_type, extra_headers))
+        # AMS response to the first call can be a redirect,
+        # so we handle it here to make it transparent for the caller...
+        if response.status_code == 301:
+            self.redirected_endpoint = response.headers['location']
+            response = await self._send(method, ''.join([self.redirected_endpoint, path]), body, self._headers_for(rformat, content_type, extra_headers))
+        ams_metrics.record_request(method, path, response.status_code, time.time() - started, len(body or ''), ams_metrics.wire_size(response))
+        return response
+
+    async def get_url(self, endpoint=None, flag=True):
+        '''Do an AMS GET request on a full URL (the Initial Endpoint by default).
+
+        Args:
+            endpoint (str): URL to get.
+            flag  (bool): A Flag to follow the redirect or not.
+
+        Returns:
+            AsyncResponse.
+        '''
+        endpoint = self.endpoint if endpoint is None else endpoint
+        return await self.scheduler.call_async(lambda: self._get_url(endpoint, flag), "GET", RETRY_EXCEPTIONS)
+
+    async def _get_url(self, endpoint, flag):
+        await self._refresh_token()
+        started = time.time()
+        response = await self._send("GET", endpoint, headers=self.headers(), allow_redirects=flag)
+        ams_metrics.record_request("GET", endpoint, response.status_code, time.time() - started, 0, ams_metrics.wire_size(response))
+        if flag and response.status_code == 200 and endpoint == self.endpoint:
+            self.redirected_endpoint = response.url
+        return response
+
+    async def send(self, request):
+        '''Do an AMS request built by ams_odata (AMSRequest).'''
+        return await self.request(request.method, request.path, request.data(), content_type=request.content_type)
+
+    async def batch(self, batch):
+        '''asyncio counterpart of do_ams_batch: the operations of an ODataBatch in one $batch request.
+
+        Returns:
+            The list of ODataResponse, or None if the service does not take $batch
+            requests (ams.odata_batch is then turned off).
+        '''
+        if self.redirected_endpoint is None:
+            await self.get_url()
+        content_type, body = batch.payload(self.redirected_endpoint or self.endpoint, {"x-ms-version": ams.xmsversion})
+        response = await self.request("POST", '/$batch', body, content_type=False,
+                                      extra_headers={"Content-Type": content_type, "Accept": "multipart/mixed"})
+        if response.status_code in (400, 404, 405, 501):
+            ams.odata_batch = False
+            return None
+        if response.status_code != 202:
+            raise IOError("POST Status: " + str(response.status_code) + " - $batch ERROR." + str(response.content))
+        return batch.parse(response.headers.get('Content-Type'), response.content)
+
+    #------------------------------------------------------------------------------------------
+    # AMS entities, same arguments as the sync functions (without the access token)
+
+    async def create_media_asset(self, name, options="0"):
+        return await self.send(ams_odata.create_asset(name, options))
+
+    async def create_media_assetfile(self, parent_asset_id, name, is_primary="false", is_encrypted="false", encryption_scheme="None", encryptionkey_id="None"):
+        return await self.send(ams_odata.create_asset_file(parent_asset_id, name, is_primary, is_encrypted, encryption_scheme, encryptionkey_id))
+
+    async def create_asset_accesspolicy(self, name, duration, permission="1"):
+        return await self.send(ams_odata.create_access_policy(name, duration, permission))
+
+    async def create_sas_locator(self, asset_id, accesspolicy_id):
+        return await self.send(ams_odata.create_locator(asset_id, accesspolicy_id))
+
+    async def update_media_assetfile(self, parent_asset_id, asset_id, content_length, name):
+        return await self.send(ams_odata.update_asset_file(parent_asset_id, asset_id, content_length, name))
+
+    async def encode_mezzanine_asset(self, processor_id, asset_id, output_assetname, json_profile):
+        return await self.send(ams_odata.create_job(self.endpoint, output_assetname, [asset_id],
+                                                    [{'input': 0, 'output': output_assetname, 'processor_id': processor_id, 'configuration': json_profile}],
+                                                    ams.job_notification_endpoint_id))
+
+    async def helper_list(self, oid, path, query=None):
+        if oid != "":
+            path = ''.join([path, "('", oid, "')"])
+        if query:
+            path = ''.join([path, "?", urllib.parse.urlencode(query, quote_via=urllib.parse.quote, safe="$',:()")])
+        return await self.request("GET", path)
+
+    async def helper_page(self, path, query, next_url=None):
+        '''Get one page of a listing (see ams.helper_page).
+
+        Returns:
+            (list of entities, next page URL or None)
+        '''
+        base = next((base for base in (self.redirected_endpoint, self.endpoint) if base and next_url and next_url.startswith(base)), None)
+        if base is not None:
+            response = await self.request("GET", next_url[len(base):])
+        else:
+            response = await self.helper_list("", path, query)
+        if (response.status_code != 200):
+            raise IOError("GET Status: " + str(response.status_code) + " - " + path + " Listing ERROR." + str(response.content))
+        return ams_odata.parse_page(response.json())
+
+    async def iter_entities(self, path, query=None, page_size=None, prefetch=None, limit=None):
+        '''Async generator over the entities of a listing (same paging as ams.helper_iter).
+
+        Usage:
+            async for asset in client.iter_entities('/Assets', ams_odata.list_query(select=['Id', 'Name'])):
+                ...
+        '''
+        query = dict(query or {})
+        skip = skip_start = int(query.pop("$skip", 0) or 0)
+        page_size = min(page_size or ams.list_page_size, ams_odata.MAX_PAGE_SIZE)
+        prefetch = ams.list_prefetch if prefetch is None else prefetch
+
+        async def fetch(skip, next_url):
+            top = page_size if limit is None else min(page_size, limit - skip + skip_start)
+            return top, await self.helper_page(path, dict(query, **{"$top": str(top), "$skip": str(skip)}), next_url)
+
+        yielded = 0
+        pending = None
+        try:
+            top, (results, next_url) = await fetch(skip, None)
+            while True:
+                skip += len(results)
+                last = not results or (len(results) < top and not next_url) or (limit is not None and yielded + len(results) >= limit)
+                pending = None if last or not prefetch else asyncio.ensure_future(fetch(skip, next_url))
+                for entity in results:
+                    yield entity
+                    yielded += 1
+                    if limit is not None and yielded >= limit:
+                        return
+                if last:
+                    return
+                top, (results, next_url) = await pending if pending is not None else await fetch(skip, next_url)
+                pending = None
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    def iter_media_assets(self, filter=None, select=None, orderby=None, **options):
+        return self.iter_entities('/Assets', ams_odata.list_query(filter, select, orderby), **options)
+
+    def iter_media_jobs(self, filter=None, select=None, orderby=None, **options):
+        return self.iter_entities('/Jobs', ams_odata.list_query(filter, select, orderby), **options)
+
+    async def helper_delete(self, oid, path):
+        return await self.send(ams_odata.delete_entity(path.lstrip('/'), oid))
+
+    async def list_media_asset(self, oid=""):
+        return await self.helper_list(oid, '/Assets')
+
+    async def list_media_job(self, oid=""):
+        return await self.helper_list(oid, '/Jobs')
+
+    async def list_media_jobs(self, job_ids):
+        return await self.helper_list("", '/Jobs', {"$filter": ' or '.join(["Id eq '" + job_id + "'" for job_id in job_ids])})
+
+    async def list_media_processor(self, oid="", query=None):
+        return await self.helper_list(oid, '/MediaProcessors', query)
+
+    async def list_asset_accesspolicy(self, oid="", query=None):
+        return await self.helper_list(oid, '/AccessPolicies', query)
+
+    async def delete_media_asset(self, oid):
+        return await self.helper_delete(oid, '/Assets')
+
+    async def delete_sas_locator(self, oid):
+        return await self.helper_delete(oid, '/Locators')
+
+    async def delete_asset_accesspolicy(self, oid):
+        return await self.helper_delete(oid, '/AccessPolicies')
+
+    #------------------------------------------------------------------------------------------
+    # Blobs, SAS authenticated REST calls on the same session
+
+    async def upload_blob(self, container_url, sas_token, blob_name, file_path, block_size=ams.upload_block_size,
+                          max_connections=ams.upload_max_connections, content_type='video/mp4'):
+        '''Upload a file as a block blob, `max_connections` blocks at a time.
+
+        Args:
+            container_url (str): URL of the container (e.g. a locator BaseUri).
+            sas_token (str): SAS query string, starting with '?'.
+            blob_name (str): Blob name.
+            file_path (str): Local file path.
+            block_size (int): Block size in bytes (grown to fit the block count limit).
+            max_connections (int): Blocks uploaded in parallel.
+            content_type (str): Blob content type.
+
+        Returns:
+            The size of the uploaded file in bytes.
+        '''
+        total = os.stat(file_path).st_size
+        while total > block_size * ams.upload_max_blocks:
+            block_size *= 2
+        block_count = max(1, (total + block_size - 1) // block_size)
+        blob_url = container_url.rstrip('/') + '/' + urllib.parse.quote(blob_name) + sas_token
+        headers = {"x-ms-version": storage_xmsversion}
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max_connections)
+
+        def read_block(index):
+            with open(file_path, mode='rb') as file:
+                file.seek(index * block_size)
+                return file.read(block_size)
+
+        async def put_block(index):
+            async with semaphore:
+                data = await loop.run_in_executor(None, read_block, index)
+                url = blob_url + '&comp=block&blockid=' + urllib.parse.quote(ams.block_id(index), safe='')
+                started = time.time()
+                response = await self._send_blob("PUT", url, data, headers)
+                ams_metrics.record_blob('put_block', time.time() - started, len(data))
+                if response.status_code != 201:
+                    raise IOError("PUT Block Status: " + str(response.status_code) + " " + str(response.content))
+
+        await asyncio.gather(*[put_block(index) for index in range(block_count)])
+        block_list = '<?xml version="1.0" encoding="utf-8"?><BlockList>' + \
+                     ''.join('<Latest>' + ams.block_id(index) + '</Latest>' for index in range(block_count)) + '</BlockList>'
+        headers = dict(headers, **{"x-ms-blob-content-type": content_type})
+        started = time.time()
+        response = await self._send_blob("PUT", blob_url + '&comp=blocklist', block_list.encode('utf-8'), headers)
+        ams_metrics.record_blob('put_block_list', time.time() - started)
+        if response.status_code != 201:
+            raise IOError("PUT Block List Status: " + str(response.status_code) + " " + str(response.content))
+        return total
+
+    async def list_blobs(self, container_url, sas_token):
+        '''List the blobs of a container, following the NextMarker pages.
+
+        Returns:
+            A list of dicts with 'name', 'size' and 'etag'.
+        '''
+        blobs = []
+        marker = ''
+        while True:
+            url = container_url.rstrip('/') + sas_token + '&restype=container&comp=list'
+            if marker:
+                url += '&marker=' + urllib.parse.quote(marker, safe='')
+            started = time.time()
+            response = await self._send_blob("GET", url, headers={"x-ms-version": storage_xmsversion})
+            ams_metrics.record_blob('list_blobs', time.time() - started)
+            if response.status_code != 200:
+                raise IOError("List Blobs Status: " + str(response.status_code) + " " + str(response.content))
+            root = ET.fromstring(response.content)
+            for blob in root.iter('Blob'):
+                properties = blob.find('Properties')
+                blobs.append({'name': blob.findtext('Name'),
+                              'size': int(properties.findtext('Content-Length') or 0),
+                              'etag': properties.findtext('Etag')})
+            marker = root.findtext('NextMarker') or ''
+            if not marker:
+                return blobs
+
+    async def download_blob(self, container_url, sas_token, blob_name, file_path):
+        '''Stream a blob to a file, through a .part file renamed into place when complete.'''
+        await self.open()
+        url = container_url.rstrip('/') + '/' + urllib.parse.quote(blob_name) + sas_token
+        tmp_file = file_path + '.part'
+        scheduler = ams_scheduler.for_blob(urllib.parse.urlsplit(url).netloc.split('.')[0])
+
+        async def fetch():
+            async with self.session.get(url, headers={"x-ms-version": storage_xmsversion}) as response:
+                if response.status == 200:
+                    with open(tmp_file, mode='wb') as file:
+                        async for chunk in response.content.iter_chunked(download_chunk_size):
+                            file.write(chunk)
+                return AsyncResponse(response.status, response.headers, b'', str(response.url))
+
+        started = time.time()
+        response = await scheduler.call_async(fetch, "GET", RETRY_EXCEPTIONS)
+        if response.status_code != 200:
+            raise IOError("GET Blob Status: " + str(response.status_code) + " - " + blob_name)
+        ams_metrics.record_blob('get_blob', time.time() - started, os.path.getsize(tmp_file))
+        os.replace(tmp_file, file_path)
+        return file_path
+
+class AsyncJobWatcher(object):
+    '''asyncio counterpart of JobWatcher: one $filter query per poll for every awaited job.
+
+    Args:
+        client (AsyncAMSClient): The client.
+        poll_min (float): Shortest interval between polls, in seconds.
+        poll_max (float): Longest interval between polls, in seconds.
+        poll_ratio (float): Interval as a fraction of the time spent Processing.
+        batch_size (int): Jobs per $filter query.
+        poll_safety (float): Poll interval while job notifications are on.
+    '''
+    def __init__(self, client, poll_min=ams.job_poll_min, poll_max=ams.job_poll_max, poll_ratio=ams.job_poll_ratio, batch_size=ams.job_filter_batch,
+                 poll_safety=ams.job_poll_safety):
+        self.client = client
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.poll_ratio = poll_ratio
+        self.batch_size = batch_size
+        self.poll_safety = poll_safety
+        self.jobs = {}
+        self.errors = 0
+        self._wake = None
+        self._task = None
+        self._loop = None
+
+    async def wait(self, job_id):
+        '''Wait for a job to be Finished, in Error or Canceled.
+
+        Returns:
+            The Media Job entity (the 'd' of the job listing).
+        '''
+        self._loop = asyncio.get_running_loop()
+        future = self._loop.create_future()
+        watched = self.jobs.setdefault(job_id, {'futures': [], 'state': None, 'since': time.time(), 'watched': time.time(), 'processing': None})
+        watched['futures'].append(future)
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+        self._wake.set()
+        return await future
+
+    def notify(self, job_id, state=None):
+        '''Take a job state change pushed by a notification (thread-safe, see JobWatcher.notify).'''
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._notified, job_id, state)
+
+    def _notified(self, job_id, state):
+        watched = self.jobs.get(job_id)
+        if watched is None:
+            return
+        if state is not None and state not in ams.JOB_FINAL_STATES:
+            if watched['state'] != state:
+                watched['state'] = state
+                watched['since'] = time.time()
+                if state == "2":
+                    watched['processing'] = watched['since']
+                print("Media Job Status........................: " + job_id + " - " + ams.translate_job_state(state) + " (notified)")
+            return
+        self._wake.set()
+
+    def interval(self):
+        '''Seconds until the next poll (same rules as JobWatcher.interval).'''
+        if self.errors:
+            return min(self.poll_max, self.poll_min * 2 ** self.errors)
+        if ams.job_notification_endpoint_id is not None:
+            return self.poll_safety
+        now = time.time()
+        interval = self.poll_max
+        for job in self.jobs.values():
+            if job['state'] == "2":
+                interval = min(interval, max(self.poll_min, (now - job['since']) * self.poll_ratio))
+            else:
+                interval = min(interval, self.poll_min)
+        return interval
+
+    async def poll(self):
+        '''Query the state of every awaited job and resolve the finished ones.'''
+        job_ids = list(self.jobs)
+        for start in range(0, len(job_ids), self.batch_size):
+            batch = [job_id for job_id in job_ids[start:start + self.batch_size] if job_id in self.jobs]
+            if not batch:
+                continue
+            response = await self.client.list_media_jobs(batch)
+            if (response.status_code != 200):
+                print("GET Status..............................: " + str(response.status_code) + " - Media Jobs Listing ERROR." + str(response.content))
+                self.errors += 1
+                return
+            for job in ams_odata.results(response.json()):
+                job_id = str(job['Id'])
+                job_state = str(job['State'])
+                watched = self.jobs.get(job_id)
+                if watched is None:
+                    continue
+                if watched['state'] != job_state:
+                    watched['state'] = job_state
+                    watched['since'] = time.time()
+                    if job_state == "2":
+                        watched['processing'] = watched['since']
+                    print("Media Job Status........................: " + job_id + " - " + ams.translate_job_state(job_state))
+                if job_state in ams.JOB_FINAL_STATES:
+                    del self.jobs[job_id]
+                    ams_metrics.record_job(watched['watched'], watched['processing'], time.time(), job_state)
+                    for future in watched['futures']:
+                        if not future.done():
+                            future.set_result(job)
+        self.errors = 0
+
+    async def close(self):
+        '''Stop polling (the jobs still awaited are cancelled).'''
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for watched in self.jobs.values():
+            for future in watched['futures']:
+                future.cancel()
+        self.jobs = {}
+
+    async def _run(self):
+        try:
+            with ams_scheduler.priority('poll'):
+                await self._poll_loop()
+        except Exception as e:
+            # the watcher is gone: fail the awaited jobs rather than leave wait() hanging
+            print("Media Jobs Watcher ERROR................: " + str(e))
+            jobs, self.jobs = self.jobs, {}
+            for watched in jobs.values():
+                for future in watched['futures']:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _poll_loop(self):
+        while self.jobs:
+            self._wake.clear()
+            try:
+                await self.poll()
+            except Exception as e:
+                print("Media Jobs Listing ERROR................: " + str(e))
+                self.errors += 1
+            if not self.jobs:
+                break
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval())
+            except asyncio.TimeoutError:
+                pass
+
+def container_sas_token(sto_account_name, sto_accountKey, container, hours=2):
+    '''Read and list SAS token of a container, signed locally with the storage account key.
+
+    Returns:
+        The SAS query string, starting with '?'.
+    '''
+    from azure.storage.blob import ContainerPermissions
+    block_blob_service = ams.get_blob_service(sto_account_name, account_key=sto_accountKey)
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
+    return '?' + block_blob_service.generate_container_shared_access_signature(container, permission=ContainerPermissions.READ | ContainerPermissions.LIST, expiry=expiry)
+
+#----------------------------------------------------------------------------------------------
+# Workflow
+
+async def create_upload_setup(client, NAME, VIDEO_NAME, accesspolicy_id):
+    '''asyncio counterpart of create_upload_setup: asset, asset file and write locator in one $batch
+    (one by one after a failed change set, to report the failing step).
+
+    Returns:
+        (asset, assetfile, locator) entities (the 'd' JSON objects).
+    '''
+    errors = ("Media Asset: '" + NAME + "' Creation ERROR.", "Media Assetfile: '" + VIDEO_NAME + "' Creation ERROR.", "SAS URL Locator Creation ERROR.")
+    responses = None
+    if ams.odata_batch:
+        batch = ams_odata.ODataBatch()
+        asset = batch.add(ams_odata.create_asset(NAME))
+        batch.add(ams_odata.create_asset_file(asset, VIDEO_NAME))
+        batch.add(ams_odata.create_locator(asset, accesspolicy_id))
+        responses = await client.batch(batch)
+        if responses is not None and any(response.status_code != 201 for response in responses):
+            # the change set is atomic: nothing was created
+            print("POST Status.............................: " + str(responses[0].status_code) + " - Upload Setup Change Set ERROR, retrying one by one")
+            responses = None
+    entities = []
+    for index, error in enumerate(errors):
+        if responses is not None:
+            response = responses[index]
+        elif index == 0:
+            response = await client.create_media_asset(NAME)
+        elif index == 1:
+            response = await client.create_media_assetfile(entities[0]['Id'], VIDEO_NAME, "false", "false")
+        else:
+            response = await client.create_sas_locator(entities[0]['Id'], accesspolicy_id)
+        if (response.status_code != 201):
+            raise IOError("POST Status: " + str(response.status_code) + " - " + error + str(response.content))
+        entities.append(ams_odata.entity(response.json()))
+    return tuple(entities)
+
+async def upload_video(client, accesspolicy_id, NAME, VIDEO_PATH):
+    '''asyncio counterpart of upload_video, with a write access policy created by the caller.
+
+    Returns:
+        The Media Asset Id.
+    '''
+    VIDEO_NAME = NAME + ".mp4"
+    asset, assetfile, locator = await create_upload_setup(client, NAME, VIDEO_NAME, accesspolicy_id)
+    asset_id = str(asset['Id'])
+    video_assetfile_id = str(assetfile['Id'])
+    try:
+        video_content_length = await client.upload_blob(str(locator['BaseUri']), str(locator['ContentAccessComponent']), VIDEO_NAME, VIDEO_PATH)
+    finally:
+        # delete the locator, so that it can't be used again
+        await client.delete_sas_locator(str(locator['Id']))
+    response = await client.update_media_assetfile(asset_id, video_assetfile_id, video_content_length, VIDEO_NAME)
+    if (response.status_code != 204):
+        raise IOError("MERGE Status: " + str(response.status_code) + " - Assetfile: '" + VIDEO_NAME + "' Update ERROR." + str(response.content))
+    return asset_id
+
+async def download_job_output(client, job, sto_account_name, sto_accountKey, include=None, exclude=None):
+    '''asyncio counterpart of download_job_output: the selected blobs of the output asset, in parallel.
+
+    Returns:
+        The list of local file paths.
+    '''
+    include = ams.download_include if include is None else include
+    exclude = ams.download_exclude if exclude is None else exclude
+    response = await client.get_url(ams_odata.navigation_uri(job, 'OutputMediaAssets', client.redirected_endpoint or client.endpoint, 'Jobs'), False)
+    if (response.status_code != 200):
+        raise IOError("GET Status: " + str(response.status_code) + " - Media Job Output Asset: '" + str(job['Id']) + "' Getting ERROR.")
+    output_asset_id = ams_odata.results(response.json())[0]['Id']
+    response = await client.list_media_asset(output_asset_id)
+    if (response.status_code != 200):
+        raise IOError("GET Status: " + str(response.status_code) + " - Media Asset: '" + output_asset_id + "' Listing ERROR.")
+    container = ams_odata.entity(response.json())['Uri'].split('/')[3]
+    container_url = blob_endpoint.format(sto_account_name) + container
+    sas_token = container_sas_token(sto_account_name, sto_accountKey, container)
+    names = [blob['name'] for blob in await client.list_blobs(container_url, sas_token) if ams.blob_selected(blob['name'], include, exclude)]
+    return list(await asyncio.gather(*[client.download_blob(container_url, sas_token, name, ams.OUTPUT_FOLDER + name + '.json') for name in names]))
+
+async def get_face_track_emotion(client, watcher, processor_id, asset_id, sto_account_name, sto_accountKey, ASSET_FINAL_NAME, configuration_emotion):
+    '''asyncio counterpart of get_face_track_emotion.
+
+    Returns:
+        (job id, list of downloaded file paths)
+    '''
+    with ams_scheduler.priority('submit'):
+        response = await client.encode_mezzanine_asset(processor_id, asset_id, ASSET_FINAL_NAME, configuration_emotion)
+    if (response.status_code != 201):
+        raise IOError("POST Status: " + str(response.status_code) + " - Media Job Creation ERROR." + str(response.content))
+    job_id = str(ams_odata.entity(response.json())['Id'])
+    job = await watcher.wait(job_id)
+    if str(job['State']) != "3":
+        raise IOError("Media Job Status: " + job_id + " - " + ams.translate_job_state(str(job['State'])))
+    with ams_metrics.stage('download'), ams_scheduler.priority('download'):
+        return job_id, await download_job_output(client, job, sto_account_name, sto_accountKey)
+
+async def process_videos(video_paths, configData, max_workflows=async_max_workflows):
+    '''Run the upload, analysis and download workflow of many videos on one event loop.
+
+    Args:
+        video_paths (list): Video paths.
+        configData (dict): The configuration (see load_config).
+        max_workflows (int): Workflows in flight at once.
+
+    Returns:
+        A dict of video path -> (job id, result paths), or the exception that stopped its workflow.
+    '''
+    provider = ams.get_token_provider(configData['tenant_id'], configData['application_id'], configData['accountKey'])
+    with open(ams.REQUEST_BODY) as file:
+        configuration_emotion = file.read()
+    results = {}
+    async with AsyncAMSClient(token_provider=provider) as client:
+        response = await client.get_url()
+        if (response.status_code != 200):
+            raise IOError("GET Status: " + str(response.status_code) + " - Getting Redirected URL ERROR.")
+        response = await client.list_media_processor(query={"$filter": "Name eq '" + ams.PROCESSOR_NAME + "'"})
+        if (response.status_code != 200) or not ams_odata.results(response.json()):
+            raise IOError("GET Status: " + str(response.status_code) + " - Media Processor: '" + ams.PROCESSOR_NAME + "' Listing ERROR.")
+        processor_id = str(max(ams_odata.results(response.json()), key=ams.processor_version)['Id'])
+        response = await client.create_asset_accesspolicy(ams.upload_policy_name, ams.upload_policy_duration, "2")
+        if (response.status_code != 201):
+            raise IOError("POST Status: " + str(response.status_code) + " - Asset Access Policy Creation ERROR." + str(response.content))
+        accesspolicy_id = str(ams_odata.entity(response.json())['Id'])
+        watcher = AsyncJobWatcher(client)
+        # the endpoint registration goes through the blocking client, once per run
+        await asyncio.get_running_loop().run_in_executor(None, ams.enable_job_notifications, provider.get_token())
+        if ams.job_notification_endpoint_id is not None:
+            import ams_notify
+            ams_notify.get_listener().subscribe(watcher.notify)
+        semaphore = asyncio.Semaphore(max_workflows)
+
+        async def workflow(video_path):
+            NAME = os.path.basename(video_path)
+            async with semaphore:
+                try:
+                    with ams_metrics.stage('upload'), ams_scheduler.priority('upload'):
+                        asset_id = await upload_video(client, accesspolicy_id, NAME, video_path)
+                    results[video_path] = await get_face_track_emotion(client, watcher, processor_id, asset_id, configData['sto_accountName'],
+                                                                       configData['sto_accountKey'], 'analysed_' + NAME, configuration_emotion)
+                    print("Async Workflow..........................: " + video_path + " - OK")
+                except (IOError, aiohttp.ClientError, KeyError, ValueError) as e:
+                    results[video_path] = e
+                    print("Async Workflow..........................: " + video_path + " - ERROR " + str(e))
+
+        try:
+            await asyncio.gather(*[workflow(video_path) for video_path in video_paths])
+        finally:
+            if ams.job_notification_endpoint_id is not None:
+                import ams_notify
+                ams_notify.get_listener().unsubscribe(watcher.notify)
+            await watcher.close()
+            await client.delete_asset_accesspolicy(accesspolicy_id)
+    return results
+
+def run(video_paths, config_file=ams.CONFIG_FILE, max_workflows=async_max_workflows):
+    '''Blocking entry point: process_videos() on a new event loop.'''
+    return asyncio.run(process_videos(video_paths, ams.load_config(config_file), max_workflows))
@@ -0,0 +1,369 @@
+# coding: utf-8
+
+#Batch mode: run many videos through the upload and face detection stages as a pipeline
+import os
+import sys
+import glob
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ams_face_track_api as ams
+import ams_dedup
+import ams_results
+import ams_journal
+import ams_metrics
+
+# Default worker limits per pipeline stage
+UPLOAD_WORKERS   = 4
+ANALYSE_WORKERS  = 8
+DOWNLOAD_WORKERS = 4
+
+# Videos packed as tasks of one Media Job (1: a job per video)
+TASKS_PER_JOB = 1
+
+VIDEO_EXTENSIONS = ('.mp4',)
+
+def discover_videos(source):
+    '''List the videos of a batch source.
+
+    Args:
+        source (str): A directory, a glob pattern or a manifest file (one video path
+            per line, '#' comments allowed, relative paths resolved against the manifest).
+
+    Returns:
+        A sorted list of video paths.
+    '''
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(VIDEO_EXTENSIONS))
+    if os.path.isfile(source) and not source.lower().endswith(VIDEO_EXTENSIONS):
+        base = os.path.dirname(os.path.abspath(source))
+        videos = []
+        with open(source) as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line == "" or line.startswith('#'):
+                    continue
+                videos.append(os.path.join(base, line))
+        return videos
+    return sorted(glob.glob(source))
+
+class BatchPipeline(object):
+    '''Staged pipeline over upload_video and get_face_track_emotion.
+
+    Each stage (upload, Face Detector job, output download) has its own worker
+    pool, so the upload of video N+1 overlaps the AMS processing of video N.
+    All outstanding jobs are polled together by the shared JobWatcher and a
+    job's output is handed to the download stage as soon as it finishes.
+
+    With tasks_per_job > 1 the uploaded videos are grouped into multi-task
+    jobs (MultiTaskJob): a group is submitted when it is full or when no upload
+    is left in progress, so short clips share the job overhead.
+
+    With a journal (WorkflowJournal) every step is committed as it completes;
+    a rerun of the batch resumes each video after its last completed step and
+    waits for the jobs already submitted instead of submitting them again.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        sto_account_name (str): Storage account name.
+        sto_accountKey (str): Storage account key.
+        upload_workers (int): Concurrent uploads.
+        analyse_workers (int): Concurrent Face Detector jobs.
+        download_workers (int): Concurrent job output downloads.
+        dedup_index (DedupIndex): Skip uploads/jobs of footage seen before, None to disable.
+        tasks_per_job (int): Videos per Media Job.
+        journal (WorkflowJournal): Workflow journal to resume from, None to disable.
+    '''
+    def __init__(self, access_token, sto_account_name, sto_accountKey, upload_workers=UPLOAD_WORKERS, analyse_workers=ANALYSE_WORKERS, download_workers=DOWNLOAD_WORKERS, dedup_index=None,
+                 tasks_per_job=TASKS_PER_JOB, journal=None):
+        self.access_token = access_token
+        self.journal = journal
+        self.tasks_per_job = max(1, min(tasks_per_job, ams.job_max_tasks))
+        self.dedup_index = dedup_index
+        self.digests = {}
+        self.configuration_digest = ams_dedup.config_digest(ams.REQUEST_BODY)
+        self.sto_account_name = sto_account_name
+        self.sto_accountKey = sto_accountKey
+        self.upload_pool = ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix='ams-upload')
+        self.analyse_pool = ThreadPoolExecutor(max_workers=analyse_workers, thread_name_prefix='ams-analyse')
+        self.download_pool = ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='ams-download')
+        self.results = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._uploading = 0
+        self._group = []
+        self._done = threading.Event()
+
+    def submit(self, video_path):
+        '''Queue a video for upload (and, once uploaded, for analysis).'''
+        with self._lock:
+            self._pending += 1
+            self._uploading += 1
+            self._done.clear()
+        self.upload_pool.submit(self._upload, video_path)
+
+    def _upload(self, video_path):
+        try:
+            self._upload_video(video_path)
+        finally:
+            with self._lock:
+                self._uploading -= 1
+                group = self._take_group(self._uploading == 0)
+            if group:
+                self.analyse_pool.submit(self._analyse_group, group)
+
+    def _queue_analysis(self, video_path, processor_id, asset_id):
+        if self.tasks_per_job == 1:
+            self.analyse_pool.submit(self._analyse, video_path, processor_id, asset_id)
+            return
+        with self._lock:
+            self._group.append((video_path, processor_id, asset_id))
+            group = self._take_group(len(self._group) >= self.tasks_per_job)
+        if group:
+            self.analyse_pool.submit(self._analyse_group, group)
+
+    def _take_group(self, flush):
+        # called with the lock held
+        if not flush or not self._group:
+            return None
+        group, self._group = self._group, []
+        return group
+
+    def _upload_video(self, video_path):
+        name = os.path.basename(video_path)
+        try:
+            if self.dedup_index is not None:
+                video_digest = self.digests[video_path] = self.dedup_index.digest(video_path)
+            if self.journal is not None:
+                entry = self.journal.start(video_path, self.configuration_digest)
+                if ams_journal.reached(entry, 'job_finished') and entry['job_state'] != "3":
+                    # the journaled job failed, run a new one
+                    entry = self.journal.rewind(video_path, 'assetfile_updated')
+                if ams_journal.reached(entry, 'job_submitted'):
+                    self.analyse_pool.submit(self._resume_analysis, video_path)
+                    return
+            if self.dedup_index is not None:
+                cached = self.dedup_index.lookup(video_digest, self.configuration_digest, lambda asset_id: ams.media_asset_exists(self.access_token, asset_id))
+                if cached.get('results'):
+                    self._finish(video_path, "OK")
+                    return
+                if cached.get('asset_id'):
+                    if self.journal is not None:
+                        self.journal.update(video_path, 'assetfile_updated', asset_id=cached['asset_id'])
+                    self._queue_analysis(video_path, ams.get_media_processor_id(self.access_token), cached['asset_id'])
+                    return
+            if self.journal is not None:
+                asset_id = ams.resumable_upload(self.access_token, self.journal, video_path, self.sto_account_name)['asset_id']
+                processor_id = ams.get_media_processor_id(self.access_token)
+            else:
+                processor_id, asset_id = ams.upload_video(self.access_token, name, self.sto_account_name, video_path)
+            if self.dedup_index is not None:
+                self.dedup_index.record_asset(self.digests[video_path], asset_id)
+        except Exception as e:
+            self._finish(video_path, "upload failed: " + str(e))
+            return
+        self._queue_analysis(video_path, processor_id, asset_id)
+
+    def _analyse(self, video_path, processor_id, asset_id):
+        if self.journal is not None:
+            self._resume_analysis(video_path, processor_id)
+            return
+        name = os.path.basename(video_path)
+        try:
+            job_id = ams.submit_face_track_job(self.access_token, processor_id, asset_id, 'analysed_' + name)
+            if job_id is None:
+                self._finish(video_path, "job submission failed")
+                return
+            # the worker slot is held until the job finishes, so analyse_workers bounds the jobs in flight
+            job = ams.wait_for_job(self.access_token, job_id)
+        except Exception as e:
+            self._finish(video_path, "analysis failed: " + str(e))
+            return
+        self.download_pool.submit(self._download, video_path, job)
+
+    def _resume_analysis(self, video_path, processor_id=None):
+        try:
+            entry = ams.resumable_analysis(self.access_token, self.journal, video_path, processor_id or ams.get_media_processor_id(self.access_token))
+        except Exception as e:
+            self._finish(video_path, "analysis failed: " + str(e))
+            return
+        self.download_pool.submit(self._download, video_path, entry['job'])
+
+    def _analyse_group(self, group):
+        with open(ams.REQUEST_BODY, mode='r') as file:
+            configuration_emotion = file.read()
+        job = ams.MultiTaskJob('analysed_batch_' + str(len(group)) + '_' + os.path.basename(group[0][0]), configuration=configuration_emotion)
+        try:
+            for video_path, processor_id, asset_id in group:
+                job.add_task(asset_id, 'analysed_' + os.path.basename(video_path), video_path, processor_id)
+            job_id = job.submit(self.access_token)
+            if job_id is None:
+                for video_path, processor_id, asset_id in group:
+                    self._finish(video_path, "job submission failed")
+                return
+            if self.journal is not None:
+                for video_path, processor_id, asset_id in group:
+                    self.journal.update(video_path, 'job_submitted', job_id=job_id, output_asset='analysed_' + os.path.basename(video_path))
+            job_entity = ams.wait_for_job(self.access_token, job_id)
+            if self.journal is not None:
+                for video_path, processor_id, asset_id in group:
+                    self.journal.update(video_path, 'job_finished', job=job_entity, job_state=job_entity['State'])
+        except Exception as e:
+            for video_path, processor_id, asset_id in group:
+                self._finish(video_path, "analysis failed: " + str(e))
+            return
+        self.download_pool.submit(self._download_group, job.outputs(), job_entity)
+
+    def _download_group(self, outputs, job):
+        try:
+            result_paths = ams.download_multi_task_output(self.access_token, job, outputs, self.sto_account_name, self.sto_accountKey)
+        except Exception as e:
+            for video_path in outputs.values():
+                self._finish(video_path, "download failed: " + str(e))
+            return
+        job_id = str(job['Id'])
+        job_state = str(job['State'])
+        for video_path, paths in result_paths.items():
+            # a failed task leaves its output asset empty, the other tasks still count
+            if job_state != "3" and not paths:
+                self._finish(video_path, "job " + ams.translate_job_state(job_state))
+                continue
+            if self.journal is not None:
+                try:
+                    self.journal.update(video_path, 'downloaded', result_paths=paths)
+                except Exception as e:
+                    self._finish(video_path, "store failed: " + str(e))
+                    continue
+            self._record(video_path, job_id, paths)
+
+    def _download(self, video_path, job):
+        try:
+            if self.journal is None:
+                result_paths = ams.download_job_output(self.access_token, job, self.sto_account_name, self.sto_accountKey)
+            elif str(job['State']) == "3":
+                result_paths = ams.resumable_download(self.access_token, self.journal, video_path, self.sto_account_name, self.sto_accountKey)['result_paths']
+            else:
+                result_paths = []
+        except Exception as e:
+            self._finish(video_path, "download failed: " + str(e))
+            return
+        if str(job['State']) != "3":
+            self._finish(video_path, "job " + ams.translate_job_state(str(job['State'])))
+            return
+        self._record(video_path, str(job['Id']), result_paths)
+
+    def _record(self, video_path, job_id, result_paths):
+        # every video reaches _finish, or join() would wait for it forever
+        try:
+            if self.dedup_index is not None:
+                self.dedup_index.record_analysis(self.digests[video_path], self.configuration_digest, job_id, result_paths)
+            if ams.STORE_RESULTS:
+                ams_results.ingest_job_results(result_paths, job_id)
+            if self.journal is not None:
+                self.journal.update(video_path, 'done')
+        except Exception as e:
+            self._finish(video_path, "store failed: " + str(e))
+            return
+        self._finish(video_path, "OK")
+
+    def _finish(self, video_path, status):
+        print("Batch Video.............................: " + video_path + " - " + status)
+        with self._lock:
+            self.results[video_path] = status
+            self._pending -= 1
+            if self._pending == 0:
+                self._done.set()
+
+    def join(self):
+        '''Wait until every submitted video went through the pipeline.
+
+        Returns:
+            A dict of video path to status ("OK" or an error description).
+        '''
+        with self._lock:
+            if self._pending == 0:
+                self._done.set()
+        self._done.wait()
+        self.upload_pool.shutdown()
+        self.analyse_pool.shutdown()
+        self.download_pool.shutdown()
+        return self.results
+
+def run_batch(source, upload_workers=UPLOAD_WORKERS, analyse_workers=ANALYSE_WORKERS, download_workers=DOWNLOAD_WORKERS, config_file=ams.CONFIG_FILE, dedup=True,
+              tasks_per_job=TASKS_PER_JOB, journal_file=ams.JOURNAL_FILE, gc_sweep=None):
+    '''Upload and analyse every video of a batch source.
+
+    Args:
+        source (str): A directory, a glob pattern or a manifest file.
+        upload_workers (int): Concurrent uploads.
+        analyse_workers (int): Concurrent Face Detector jobs.
+        download_workers (int): Concurrent job output downloads.
+        config_file (str): Path of the JSON config file.
+        dedup (bool): Skip uploads/jobs of footage found in the dedup index.
+        tasks_per_job (int): Videos packed into one Media Job.
+        journal_file (str): Workflow journal to resume from, None to disable.
+        gc_sweep (float): Seconds between two sweeps of a background ams_gc.GarbageCollector, None for none.
+
+    Returns:
+        A dict of video path to status ("OK" or an error description).
+    '''
+    configData = ams.load_config(config_file)
+    videos = discover_videos(source)
+    print("Batch Videos............................: " + str(len(videos)))
+
+    access_token, ams_redirected_rest_endpoint = ams.get_access_token_with_rest_end(configData['tenant_id'], configData['application_id'], configData['accountKey'])
+    # Size the connection pool for every worker that can be in flight at once
+    ams.configure_ams_client(pool_maxsize=max(ams.ams_pool_maxsize, upload_workers + analyse_workers + download_workers))
+
+    # resolve the Face Detector once for the whole batch, the workers hit the cache
+    ams.get_media_processor_id(access_token)
+    ams.enable_job_notifications(access_token)
+
+    journal = ams_journal.get_journal(journal_file) if journal_file is not None else None
+    pipeline = BatchPipeline(access_token, configData['sto_accountName'], configData['sto_accountKey'], upload_workers, analyse_workers, download_workers,
+                             ams_dedup.get_dedup_index() if dedup else None, tasks_per_job, journal)
+    collector = None
+    if gc_sweep:
+        # the journal keeps the assets of the videos in flight out of the sweeps
+        import ams_gc
+        collector = ams_gc.GarbageCollector(access_token, journal=journal).start(gc_sweep)
+    try:
+        for video_path in videos:
+            pipeline.submit(video_path)
+        return pipeline.join()
+    finally:
+        if collector is not None:
+            collector.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Azure Media Analytics - Face Detector batch mode')
+    parser.add_argument('source', help='directory, glob pattern or manifest file of videos')
+    parser.add_argument('--upload-workers', type=int, default=UPLOAD_WORKERS)
+    parser.add_argument('--analyse-workers', type=int, default=ANALYSE_WORKERS)
+    parser.add_argument('--download-workers', type=int, default=DOWNLOAD_WORKERS)
+    parser.add_argument('--config', default=ams.CONFIG_FILE)
+    parser.add_argument('--no-dedup', action='store_true', help='upload and analyse every video, even if seen before')
+    parser.add_argument('--tasks-per-job', type=int, default=TASKS_PER_JOB, help='videos packed as tasks of one Media Job (max ' + str(ams.job_max_tasks) + ')')
+    parser.add_argument('--journal', default=ams.JOURNAL_FILE, help='workflow journal, a rerun resumes each video after its last completed step')
+    parser.add_argument('--no-journal', action='store_true', help='run without the workflow journal')
+    parser.add_argument('--notify', action='store_true', help='have the jobs push their state changes to a local webhook instead of polling them')
+    parser.add_argument('--notify-url', help='URL AMS posts the job notifications to (implies --notify), the receiver address by default')
+    parser.add_argument('--gc-sweep', type=float, metavar='SECONDS', help='also delete the stale assets, locators and upload policies every SECONDS (see ams_gc)')
+    parser.add_argument('--metrics-json', help='write a JSON run summary of the metrics to this file')
+    parser.add_argument('--metrics-prom', help='write the metrics in Prometheus text format to this file')
+    args = parser.parse_args(argv)
+    if args.notify or args.notify_url:
+        ams.job_notifications = True
+        ams.job_notification_url = args.notify_url
+    results = run_batch(args.source, args.upload_workers, args.analyse_workers, args.download_workers, args.config, not args.no_dedup, args.tasks_per_job,
+                        None if args.no_journal else args.journal, args.gc_sweep)
+    failed = [video for video, status in results.items() if status != "OK"]
+    print("Batch Finished..........................: " + str(len(results) - len(failed)) + " OK, " + str(len(failed)) + " failed")
+    ams_metrics.print_summary()
+    ams_metrics.write_files(args.metrics_json, args.metrics_prom)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
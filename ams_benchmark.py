@@ -0,0 +1,289 @@
+# coding: utf-8
+
+#End-to-end benchmark of the single, batch and async workflows against the local AMS stand-in
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import ams_mock
+
+BENCH_SCENARIOS     = ('single', 'batch', 'async')
+BENCH_VIDEOS        = 20                 # videos per scenario
+BENCH_SINGLE_VIDEOS = 3                  # the single-video scenario runs its workflows one after the other
+BENCH_VIDEO_SIZE    = 8 * 1024 * 1024    # bytes per synthetic video
+BENCH_TOLERANCE     = 0.2                # allowed regression against a baseline (20%)
+BENCH_MIN_DELTA     = 0.01               # p95 latency changes below 10 ms are noise
+
+REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+def make_videos(folder, count, size, seed=0):
+    '''Write `count` synthetic videos of `size` bytes (the stand-in does not decode them).
+
+    Returns:
+        The sorted list of video paths.
+    '''
+    rng = random.Random(seed)
+    block = bytes(rng.getrandbits(8) for i in range(64 * 1024))
+    paths = []
+    for index in range(count):
+        path = os.path.join(folder, 'bench_{0:04d}.mp4'.format(index))
+        with open(path, 'wb') as videoFile:
+            # a distinct header per file, so every video has its own digest
+            videoFile.write(('bench video ' + str(index) + ' ').encode('ascii').ljust(64, b' '))
+            written = 64
+            while written < size:
+                chunk = block[:size - written]
+                videoFile.write(chunk)
+                written += len(chunk)
+        paths.append(path)
+    return paths
+
+def use_mock(url, workdir):
+    '''Point the client modules at a running stand-in and keep every file they write in `workdir`.
+
+    Args:
+        url (str): Base URL of the MockAMSServer.
+        workdir (str): Folder for the config, token cache, outputs, journal and stores.
+
+    Returns:
+        The path of the config file written for the stand-in.
+    '''
+    import ams_face_track_api as ams
+    config_file = os.path.join(workdir, 'config.json')
+    with open(config_file, 'w') as configFile:
+        json.dump({'accountName': 'benchmark', 'accountKey': 'benchmark-secret', 'sto_accountName': 'benchmark',
+                   'sto_accountKey': 'YmVuY2htYXJrLWtleQ==', 'tenant_id': 'benchmark', 'application_id': 'benchmark'}, configFile)
+    # a token valid for a day, so adal is never called
+    token_cache_file = os.path.join(workdir, 'token_cache.json')
+    with open(token_cache_file, 'w') as cacheFile:
+        json.dump({'accessToken': 'benchmark-token', 'expiresOnTimestamp': time.time() + 86400}, cacheFile)
+    # OUTPUT_FOLDER is used as a prefix, so it keeps its trailing separator
+    output_folder = os.path.join(workdir, 'output', '')
+    os.makedirs(output_folder, exist_ok=True)
+    ams.ams_rest_endpoint = url + '/initial/'
+    ams.blob_service_options = {'custom_domain': url + '/blob', 'protocol': 'http'}
+    ams.CONFIG_FILE = config_file
+    ams.TOKEN_CACHE_FILE = token_cache_file
+    ams.OUTPUT_FOLDER = output_folder
+    ams.REQUEST_BODY = os.path.join(REPO_FOLDER, 'emotion.json')
+    ams.JOURNAL_FILE = os.path.join(workdir, 'workflow_journal.db')
+    if 'ams_async' in sys.modules:
+        sys.modules['ams_async'].blob_endpoint = url + '/blob/'
+    return config_file
+
+def run_scenario(scenario, url, workdir, video_paths, tasks_per_job=1):
+    '''Run one workflow scenario in this process (called in the child process).
+
+    Returns:
+        A dict with the wall time, videos done, videos/hour, peak RSS and the metrics summary.
+    '''
+    import resource
+    import ams_metrics
+    if scenario == 'async':
+        import ams_async
+    config_file = use_mock(url, workdir)
+    import ams_face_track_api as ams
+    started = time.time()
+    done = 0
+    if scenario == 'single':
+        for video_path in video_paths:
+            ams.VIDEO_PATH = video_path
+            ams.main()
+            done += 1
+    elif scenario == 'batch':
+        import ams_batch
+        results = ams_batch.run_batch(os.path.dirname(video_paths[0]), config_file=config_file, dedup=False,
+                                      tasks_per_job=tasks_per_job, journal_file=ams.JOURNAL_FILE)
+        done = sum(1 for status in results.values() if status == "OK")
+    elif scenario == 'async':
+        results = ams_async.run(video_paths, config_file)
+        done = sum(1 for result in results.values() if not isinstance(result, Exception))
+    else:
+        raise ValueError("Benchmark: unknown scenario '" + scenario + "'")
+    elapsed = time.time() - started
+    return {'scenario': scenario, 'videos': len(video_paths), 'done': done, 'seconds': elapsed,
+            'videos_per_hour': done * 3600.0 / elapsed if elapsed > 0 else 0.0,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+            'metrics': ams_metrics.get_registry().summary()}
+
+def latencies(result):
+    '''Per-call latency percentiles of a scenario result: {'GET /Jobs': {'count', 'p50', 'p95'}, 'blob put_block': ...}.'''
+    calls = {}
+    for histogram in result['metrics']['histograms']:
+        if histogram['name'] == 'ams_request_seconds':
+            name = histogram['labels']['method'] + ' ' + histogram['labels']['endpoint']
+        elif histogram['name'] == 'ams_blob_seconds':
+            name = 'blob ' + histogram['labels']['operation']
+        elif histogram['name'] == 'ams_stage_seconds':
+            name = 'stage ' + histogram['labels']['stage']
+        else:
+            continue
+        calls[name] = {'count': histogram['count'], 'p50': histogram['p50'], 'p95': histogram['p95']}
+    return calls
+
+def transferred(result):
+    '''Bytes sent and received (AMS requests and blob transfers) of a scenario result.'''
+    totals = {}
+    for counter in result['metrics']['counters']:
+        if counter['name'] == 'ams_request_bytes_total':
+            key = 'ams ' + counter['labels']['direction']
+        elif counter['name'] == 'ams_blob_bytes_total':
+            key = 'blob ' + counter['labels']['operation']
+        else:
+            continue
+        totals[key] = totals.get(key, 0) + counter['value']
+    return totals
+
+def benchmark(scenarios=BENCH_SCENARIOS, videos=BENCH_VIDEOS, video_size=BENCH_VIDEO_SIZE, single_videos=BENCH_SINGLE_VIDEOS, tasks_per_job=1,
+              mock_options=None, keep=False, verbose=False):
+    '''Run each scenario in its own process against a fresh MockAMSServer.
+
+    Args:
+        scenarios (tuple): Scenarios to run ('single', 'batch', 'async').
+        videos (int): Videos per scenario.
+        video_size (int): Bytes per synthetic video.
+        single_videos (int): Videos run by the (sequential) single scenario.
+        tasks_per_job (int): Videos packed into one Media Job by the batch scenario.
+        mock_options (dict): MockAMSServer arguments (latency, job_seconds...).
+        keep (bool): Keep the work folders.
+        verbose (bool): Show the workflow output instead of logging it to the work folder.
+
+    Returns:
+        A dict with the settings and the result of each scenario.
+    '''
+    report = {'settings': {'videos': videos, 'video_size': video_size, 'single_videos': single_videos, 'tasks_per_job': tasks_per_job,
+                           'mock': dict(mock_options or {})}, 'scenarios': {}}
+    root = tempfile.mkdtemp(prefix='ams_benchmark_')
+    try:
+        video_folder = os.path.join(root, 'videos')
+        os.makedirs(video_folder)
+        video_paths = make_videos(video_folder, videos, video_size)
+        for scenario in scenarios:
+            workdir = os.path.join(root, scenario)
+            os.makedirs(workdir)
+            server = ams_mock.MockAMSServer(**(mock_options or {})).start()
+            try:
+                result_file = os.path.join(workdir, 'result.json')
+                paths = video_paths[:single_videos] if scenario == 'single' else video_paths
+                command = [sys.executable, os.path.abspath(__file__), '--child', scenario, '--url', server.url, '--result-file', result_file,
+                           '--tasks-per-job', str(tasks_per_job)] + paths
+                print("Benchmark Scenario......................: " + scenario + " (" + str(len(paths)) + " videos)")
+                sys.stdout.flush()
+                with open(os.path.join(workdir, 'workflow.log'), 'w') as logFile:
+                    returncode = subprocess.call(command, cwd=workdir, stdout=None if verbose else logFile, stderr=subprocess.STDOUT if not verbose else None)
+                if returncode != 0 or not os.path.exists(result_file):
+                    raise RuntimeError("Benchmark: scenario '" + scenario + "' failed (exit " + str(returncode) + "), see " + os.path.join(workdir, 'workflow.log'))
+                with open(result_file) as resultFile:
+                    result = json.load(resultFile)
+                result['mock'] = server.state.stats()
+            finally:
+                server.stop()
+            report['scenarios'][scenario] = result
+            print_result(result)
+    finally:
+        if keep:
+            print("Benchmark Work Folder...................: " + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+    return report
+
+def print_result(result):
+    print("Videos Done.............................: " + str(result['done']) + "/" + str(result['videos']) + " in " + "%.1f" % result['seconds'] + " s")
+    print("Videos per Hour.........................: " + "%.0f" % result['videos_per_hour'])
+    print("Peak RSS................................: " + "%.1f" % result['peak_rss_mb'] + " MB")
+    for name, nbytes in sorted(transferred(result).items()):
+        label = "Bytes " + name
+        print(label + "." * max(1, 40 - len(label)) + ": " + '{0:,}'.format(int(nbytes)))
+    for name, call in sorted(latencies(result).items()):
+        print(name + "." * max(1, 40 - len(name)) + ": " + str(call['count']) + " x, p50 " + "%.1f" % (call['p50'] * 1000) +
+              " ms, p95 " + "%.1f" % (call['p95'] * 1000) + " ms")
+    print("")
+
+def compare(report, baseline, tolerance=BENCH_TOLERANCE):
+    '''Regressions of a report against a baseline report.
+
+    Throughput may not drop, and per-call p95 latency and peak RSS may not grow,
+    by more than `tolerance` (a fraction). Calls made fewer than 5 times, and p95
+    changes smaller than BENCH_MIN_DELTA, are skipped.
+
+    Returns:
+        A list of regression descriptions (empty if none).
+    '''
+    regressions = []
+    for scenario, result in report['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(scenario)
+        if previous is None:
+            continue
+        if result['videos_per_hour'] < previous['videos_per_hour'] * (1 - tolerance):
+            regressions.append(scenario + ": videos/hour " + "%.0f" % result['videos_per_hour'] + " < " + "%.0f" % previous['videos_per_hour'])
+        if result['peak_rss_mb'] > previous['peak_rss_mb'] * (1 + tolerance):
+            regressions.append(scenario + ": peak RSS " + "%.1f" % result['peak_rss_mb'] + " MB > " + "%.1f" % previous['peak_rss_mb'] + " MB")
+        previous_calls = latencies(previous)
+        for name, call in sorted(latencies(result).items()):
+            before = previous_calls.get(name)
+            if before is None or call['count'] < 5 or before['count'] < 5:
+                continue
+            if call['p95'] > before['p95'] * (1 + tolerance) and call['p95'] - before['p95'] > BENCH_MIN_DELTA:
+                regressions.append(scenario + ": " + name + " p95 " + "%.1f" % (call['p95'] * 1000) + " ms > " + "%.1f" % (before['p95'] * 1000) + " ms")
+    return regressions
+
+def _child(args):
+    result = run_scenario(args.child, args.url, os.getcwd(), args.videos, args.tasks_per_job)
+    with open(args.result_file, 'w') as resultFile:
+        json.dump(result, resultFile)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the AMS workflows against a local stand-in (see ams_mock.py)')
+    parser.add_argument('--scenarios', default=','.join(BENCH_SCENARIOS), help='comma separated, from ' + ', '.join(BENCH_SCENARIOS))
+    parser.add_argument('--videos', type=int, default=BENCH_VIDEOS, help='videos per scenario')
+    parser.add_argument('--video-size', type=int, default=BENCH_VIDEO_SIZE, help='bytes per synthetic video')
+    parser.add_argument('--single-videos', type=int, default=BENCH_SINGLE_VIDEOS, help='videos run by the sequential single-video scenario')
+    parser.add_argument('--tasks-per-job', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.02, help='stand-in: seconds added to every AMS call')
+    parser.add_argument('--blob-latency', type=float, default=0.005, help='stand-in: seconds added to every blob call')
+    parser.add_argument('--queue-seconds', type=float, default=ams_mock.MOCK_QUEUE_SECONDS)
+    parser.add_argument('--job-seconds', type=float, default=ams_mock.MOCK_JOB_SECONDS)
+    parser.add_argument('--throttle-rps', type=float)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--baseline', help='JSON report to compare against, exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE, help='allowed regression, as a fraction')
+    parser.add_argument('--keep', action='store_true', help='keep the work folders (logs, outputs, journals)')
+    parser.add_argument('--verbose', action='store_true', help='show the workflow output')
+    # internal: run one scenario in a child process
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    parser.add_argument('child_videos', nargs='*', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        args.videos = args.child_videos
+        return _child(args)
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    for scenario in scenarios:
+        if scenario not in BENCH_SCENARIOS:
+            parser.error("unknown scenario '" + scenario + "'")
+    mock_options = {'latency': args.latency, 'blob_latency': args.blob_latency, 'queue_seconds': args.queue_seconds,
+                    'job_seconds': args.job_seconds, 'throttle_rps': args.throttle_rps}
+    report = benchmark(scenarios, args.videos, args.video_size, args.single_videos, args.tasks_per_job, mock_options, args.keep, args.verbose)
+    if args.output:
+        with open(args.output, 'w') as reportFile:
+            json.dump(report, reportFile, indent=1)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            regressions = compare(report, json.load(baselineFile), args.tolerance)
+        for regression in regressions:
+            print("Regression..............................: " + regression)
+        if regressions:
+            return 1
+        print("Baseline................................: no regression")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
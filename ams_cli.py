@@ -0,0 +1,198 @@
+# coding: utf-8
+
+#Command-line entry point: submit, batch, status, fetch-results, list-assets, cleanup and gc
+import sys
+import argparse
+
+import ams_odata
+
+# The AMS modules are imported by the subcommands (adal and the storage SDK only by those
+# that need them), so that status and list-assets start fast enough to run from cron
+CLI_CONFIG_FILE      = './config.json'
+CLI_TOKEN_CACHE_FILE = './token_cache.json'   # shared between runs, a cron job reuses the token instead of calling AAD
+
+def connect(args, redirect=False):
+    '''Load the config and get an access token (from the token cache while it is valid).
+
+    Args:
+        args (argparse.Namespace): The command line, with config and token_cache.
+        redirect (bool): Resolve the redirected AMS endpoint up front (the first
+            call follows the redirect otherwise).
+
+    Returns:
+        (ams_face_track_api module, config dict, access token)
+    '''
+    import ams_face_track_api as ams
+    ams.TOKEN_CACHE_FILE = args.token_cache or None
+    configData = ams.load_config(args.config)
+    if redirect:
+        access_token, ams_redirected_rest_endpoint = ams.get_access_token_with_rest_end(configData['tenant_id'], configData['application_id'], configData['accountKey'])
+    else:
+        provider = ams.get_token_provider(configData['tenant_id'], configData['application_id'], configData['accountKey'], background=False)
+        access_token = provider.get_token()
+        ams.get_ams_client(access_token).token_provider = provider
+    return ams, configData, access_token
+
+def cmd_submit(args):
+    import ams_face_track_api as ams
+    ams.TOKEN_CACHE_FILE = args.token_cache or None
+    if args.output:
+        ams.OUTPUT_FOLDER = args.output
+    ams.main(args.video, args.config)
+    return 0
+
+def cmd_batch(args):
+    import ams_face_track_api as ams
+    import ams_batch
+    ams.TOKEN_CACHE_FILE = args.token_cache or None
+    return ams_batch.main(args.batch_args)
+
+def cmd_status(args):
+    ams, configData, access_token = connect(args)
+    found = {}
+    for start in range(0, len(args.job_ids), ams.job_filter_batch):
+        response = ams.list_media_jobs(access_token, args.job_ids[start:start + ams.job_filter_batch])
+        if (response.status_code != 200):
+            print("GET Status..............................: " + str(response.status_code) + " - Media Job Listing ERROR." + str(response.content))
+            return 1
+        for job in ams_odata.results(response.json()):
+            found[str(job['Id'])] = job
+    failed = 0
+    for job_id in args.job_ids:
+        job = found.get(job_id)
+        if job is None:
+            print("Media Job Status........................: " + job_id + " - Not Found")
+            failed += 1
+            continue
+        state = str(job['State'])
+        print("Media Job Status........................: " + job_id + " - " + ams.translate_job_state(state))
+        if state in ("4", "5"):
+            failed += 1
+    return 1 if failed else 0
+
+def cmd_fetch_results(args):
+    ams, configData, access_token = connect(args)
+    if args.output:
+        ams.OUTPUT_FOLDER = args.output
+    response = ams.list_media_job(access_token, args.job_id)
+    if (response.status_code != 200):
+        print("GET Status..............................: " + str(response.status_code) + " - Media Job: '" + args.job_id + "' Getting ERROR." + str(response.content))
+        return 1
+    job = ams_odata.entity(response.json())
+    if str(job['State']) != "3":
+        print("Media Job Status........................: " + args.job_id + " - " + ams.translate_job_state(str(job['State'])) + ", no results to fetch")
+        return 1
+    result_paths = ams.download_job_output(access_token, job, configData['sto_accountName'], configData['sto_accountKey'], args.include, args.exclude)
+    for result_path in result_paths:
+        print("Results.................................: " + result_path)
+    if ams.STORE_RESULTS and not args.no_store:
+        import ams_results
+        ams_results.ingest_job_results(result_paths, args.job_id)
+    return 0
+
+def cmd_list_assets(args):
+    ams, configData, access_token = connect(args)
+    assets = ams.iter_media_assets(access_token, filter="Name eq '" + args.name + "'" if args.name else args.filter,
+                                   select=['Id', 'Created', 'Name'], orderby='Created', limit=args.top or None)
+    try:
+        for asset in assets:
+            print('\t'.join([str(asset['Id']), str(asset.get('Created', '')), str(asset.get('Name', ''))]))
+    except IOError as e:
+        print("Media Asset Listing ERROR...............: " + str(e))
+        return 1
+    return 0
+
+def cmd_cleanup(args):
+    ams, configData, access_token = connect(args)
+    cleanup_queue = ams.get_cleanup_queue(access_token)
+    if args.locators:
+        # the ids are collected first: deleting while paging with $skip would skip locators
+        try:
+            locator_ids = [str(locator['Id']) for locator in ams.iter_sas_locators(access_token, select=['Id', 'AssetId'], orderby='Id')
+                           if not args.asset_ids or locator.get('AssetId') in args.asset_ids]
+        except IOError as e:
+            print("SAS Locator Listing ERROR...............: " + str(e))
+            locator_ids = []
+        for locator_id in locator_ids:
+            cleanup_queue.delete_locator(locator_id)
+    if args.upload_policies:
+        response = ams.list_asset_accesspolicy(access_token, query={"$filter": "Name eq '" + ams.upload_policy_name + "'"})
+        if (response.status_code == 200):
+            for policy in ams_odata.results(response.json()):
+                cleanup_queue.delete_accesspolicy(str(policy['Id']))
+        else:
+            print("GET Status..............................: " + str(response.status_code) + " - Asset Access Policy Listing ERROR." + str(response.content))
+    for asset_id in args.asset_ids:
+        cleanup_queue.delete_asset(asset_id)
+    cleanup_queue.flush()
+    return 0
+
+def cmd_gc(args):
+    ams, configData, access_token = connect(args)
+    import ams_gc
+    collector = ams_gc.GarbageCollector(access_token, args.min_age_hours * 3600, args.pattern or ams_gc.GC_ASSET_PATTERNS, args.workers)
+    try:
+        stale, deleted = collector.collect(dry_run=not args.delete)
+    except IOError as e:
+        print("Stale Resources ERROR...................: " + str(e))
+        return 1
+    return 0 if not args.delete or deleted == len(stale) else 1
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='ams_cli.py', description='Azure Media Analytics - Face Detector command line')
+    parser.add_argument('--config', default=CLI_CONFIG_FILE, help='JSON config file (accounts and service principal)')
+    parser.add_argument('--token-cache', default=CLI_TOKEN_CACHE_FILE, help="access token cache file shared between runs, '' to disable")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+
+    submit = commands.add_parser('submit', help='upload and analyse one video, then download its results')
+    submit.add_argument('video', help='MP4 video path')
+    submit.add_argument('--output', help='results folder')
+    submit.set_defaults(run=cmd_submit)
+
+    # the arguments of batch are left to ams_batch.main (main() passes them on)
+    batch = commands.add_parser('batch', add_help=False, help='run ams_batch.py (same arguments, see batch --help)')
+    batch.set_defaults(run=cmd_batch)
+
+    status = commands.add_parser('status', help='state of Media Jobs (exit status 1 if one is missing, in Error or Canceled)')
+    status.add_argument('job_ids', nargs='+', metavar='job_id')
+    status.set_defaults(run=cmd_status)
+
+    fetch = commands.add_parser('fetch-results', help='download the output of a finished Media Job')
+    fetch.add_argument('job_id')
+    fetch.add_argument('--output', help='results folder')
+    fetch.add_argument('--include', action='append', help='fnmatch pattern of the output blobs to fetch (repeatable)')
+    fetch.add_argument('--exclude', action='append', help='fnmatch pattern of the output blobs to skip (repeatable)')
+    fetch.add_argument('--no-store', action='store_true', help='do not convert the results into the columnar store')
+    fetch.set_defaults(run=cmd_fetch_results)
+
+    list_assets = commands.add_parser('list-assets', help='list Media Assets (Id, Created, Name)')
+    list_assets.add_argument('--name', help='only the assets with this name')
+    list_assets.add_argument('--filter', help="OData $filter, e.g. \"startswith(Name, 'analysed_')\"")
+    list_assets.add_argument('--top', type=int, default=100, help='assets listed at most, 0 for all (paged)')
+    list_assets.set_defaults(run=cmd_list_assets)
+
+    cleanup = commands.add_parser('cleanup', help='delete assets, SAS locators and upload access policies (in $batch requests)')
+    cleanup.add_argument('asset_ids', nargs='*', metavar='asset_id', help='Media Assets to delete')
+    cleanup.add_argument('--locators', action='store_true', help='delete the SAS locators (of the given assets, or all)')
+    cleanup.add_argument('--upload-policies', action='store_true', help='delete the write access policies of the upload policy pool')
+    cleanup.set_defaults(run=cmd_cleanup)
+
+    gc = commands.add_parser('gc', help='find the assets, locators and upload policies left behind by failed runs (dry run unless --delete)')
+    gc.add_argument('--delete', action='store_true', help='delete what is found (rate limited, locators first)')
+    gc.add_argument('--min-age-hours', type=float, default=24, help='only collect the entities at least this old')
+    gc.add_argument('--pattern', action='append', help="fnmatch pattern of the asset names collected (repeatable, default 'analysed_*' and '*.mp4')")
+    gc.add_argument('--workers', type=int, default=8, help='concurrent deletes')
+    gc.set_defaults(run=cmd_gc)
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args, batch_args = parser.parse_known_args(argv)
+    if args.command != 'batch' and batch_args:
+        parser.error('unrecognized arguments: ' + ' '.join(batch_args))
+    args.batch_args = batch_args
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
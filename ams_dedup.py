@@ -0,0 +1,183 @@
+# coding: utf-8
+
+#Content-addressed dedup index: skip the upload and/or the Face Detector job for footage seen before
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEDUP_INDEX_FILE = './dedup_index.json'
+DEDUP_MAX_ENTRIES = 10000
+DEDUP_MAX_AGE     = 30 * 24 * 3600   # seconds, AMS assets older than this are not trusted anymore
+HASH_CHUNK_SIZE   = 4 * 1024 * 1024
+
+def file_digest(path, chunk_size=HASH_CHUNK_SIZE):
+    '''Streaming SHA-256 digest of a file.
+
+    Args:
+        path (str): File path.
+        chunk_size (int): Bytes read at a time.
+
+    Returns:
+        The hex digest.
+    '''
+    digest = hashlib.sha256()
+    with open(path, mode='rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def config_digest(request_body_path):
+    '''SHA-256 digest of a job configuration (e.g. emotion.json), insensitive to JSON formatting.
+
+    Args:
+        request_body_path (str): Path of the JSON configuration.
+
+    Returns:
+        The hex digest.
+    '''
+    with open(request_body_path) as file:
+        configuration = file.read()
+    try:
+        configuration = json.dumps(json.loads(configuration), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        pass
+    return hashlib.sha256(configuration.encode('utf-8')).hexdigest()
+
+class DedupIndex(object):
+    '''Local index of video digest -> AMS asset id, and (video, configuration) -> job and results.
+
+    Entries are kept in LRU order; the least recently used ones are evicted above
+    `max_entries` and entries older than `max_age` seconds are dropped. File digests
+    are cached by (path, size, mtime) so unchanged files are not hashed again.
+
+    Args:
+        path (str): Index file (JSON), None for a memory only index.
+        max_entries (int): Maximum number of videos kept.
+        max_age (float): Maximum age in seconds of an entry.
+    '''
+    def __init__(self, path=DEDUP_INDEX_FILE, max_entries=DEDUP_MAX_ENTRIES, max_age=DEDUP_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.digests = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        '''Load the index file, if any.'''
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as indexFile:
+                indexData = json.load(indexFile)
+        except ValueError:
+            print("Dedup Index.............................: " + self.path + " unreadable, starting empty")
+            return
+        entries = sorted(indexData.get('entries', {}).items(), key=lambda item: item[1].get('used', 0))
+        with self._lock:
+            self.entries = OrderedDict(entries)
+            self.digests = indexData.get('digests', {})
+
+    def save(self):
+        '''Write the index file atomically.'''
+        if self.path is None:
+            return
+        with self._lock:
+            indexData = {'entries': self.entries, 'digests': self.digests}
+            tmp_file = self.path + '.tmp'
+            with open(tmp_file, 'w') as indexFile:
+                json.dump(indexData, indexFile)
+            os.replace(tmp_file, self.path)
+
+    def digest(self, path):
+        '''Digest of a video file, reusing the cached value while size and mtime are unchanged.'''
+        file_stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self._lock:
+            cached = self.digests.get(key)
+        if cached is not None and cached['size'] == file_stat.st_size and cached['mtime'] == file_stat.st_mtime:
+            return cached['digest']
+        video_digest = file_digest(path)
+        with self._lock:
+            self.digests[key] = {'size': file_stat.st_size, 'mtime': file_stat.st_mtime, 'digest': video_digest}
+        return video_digest
+
+    def lookup(self, video_digest, configuration_digest, asset_exists=None):
+        '''Look up what is already known about a video.
+
+        Args:
+            video_digest (str): Digest of the video file.
+            configuration_digest (str): Digest of the job configuration.
+            asset_exists (callable): Optional check that an AMS asset id still exists
+                (e.g. through list_media_asset); stale entries are dropped.
+
+        Returns:
+            A dict with 'asset_id' when the video is already uploaded, plus 'job_id' and
+            'results' when it was already analysed with this configuration and the
+            results are still on disk. Empty if nothing is known.
+        '''
+        with self._lock:
+            self.evict()
+            entry = self.entries.get(video_digest)
+            if entry is None:
+                return {}
+            self.entries.move_to_end(video_digest)
+            entry['used'] = time.time()
+        if asset_exists is not None and not asset_exists(entry['asset_id']):
+            with self._lock:
+                self.entries.pop(video_digest, None)
+            return {}
+        found = {'asset_id': entry['asset_id']}
+        analysis = entry['analyses'].get(configuration_digest)
+        if analysis is not None and analysis['results'] and all(os.path.exists(result) for result in analysis['results']):
+            found['job_id'] = analysis['job_id']
+            found['results'] = analysis['results']
+        return found
+
+    def record_asset(self, video_digest, asset_id):
+        '''Record the AMS asset a video was uploaded to.'''
+        with self._lock:
+            now = time.time()
+            self.entries[video_digest] = {'asset_id': asset_id, 'created': now, 'used': now, 'analyses': {}}
+            self.entries.move_to_end(video_digest)
+            self.evict()
+        self.save()
+
+    def record_analysis(self, video_digest, configuration_digest, job_id, results):
+        '''Record the job and downloaded result paths of an analysed video.'''
+        with self._lock:
+            entry = self.entries.get(video_digest)
+            if entry is None:
+                return
+            entry['analyses'][configuration_digest] = {'job_id': job_id, 'results': list(results)}
+            entry['used'] = time.time()
+            self.entries.move_to_end(video_digest)
+        self.save()
+
+    def asset_ids(self):
+        '''Ids of the AMS assets the index still reuses (expired entries dropped first).'''
+        with self._lock:
+            self.evict()
+            return set(str(entry['asset_id']) for entry in self.entries.values())
+
+    def evict(self):
+        '''Drop expired entries and the least recently used ones above max_entries.'''
+        with self._lock:
+            oldest = time.time() - self.max_age
+            for video_digest in [key for key, entry in self.entries.items() if entry['created'] < oldest]:
+                del self.entries[video_digest]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+_dedup_index = None
+
+def get_dedup_index(path=DEDUP_INDEX_FILE):
+    '''Return the shared DedupIndex.'''
+    global _dedup_index
+    if _dedup_index is None:
+        _dedup_index = DedupIndex(path)
+    return _dedup_index
@@ -0,0 +1,177 @@
+# coding: utf-8
+
+#Vectorized emotion aggregation over parsed Face Detector scores (requires numpy)
+import numpy
+
+from ams_face_parser import EMOTIONS
+
+# AMS AggregateEmotion defaults (milliseconds)
+AGGREGATE_WINDOW_MS   = 250
+AGGREGATE_INTERVAL_MS = 500
+
+def as_columns(track):
+    '''NumPy columns and timescale of a FaceTrack, a StoredTrack or a dict of columns.
+
+    Args:
+        track: A FaceTrack (ams_face_parser), a StoredTrack (ams_results) or a dict
+            of column name -> sequence (with an optional 'timescale' entry).
+
+    Returns:
+        (dict of column name -> numpy array, timescale)
+    '''
+    if isinstance(track, dict):
+        columns = dict((name, numpy.asarray(values)) for name, values in track.items() if name != 'timescale')
+        return columns, float(track.get('timescale') or 1)
+    if hasattr(track, 'to_numpy'):
+        columns = track.to_numpy()
+    else:
+        columns = dict((name, numpy.asarray(track.column(name))) for name in ('timestamp', 'face_id') + EMOTIONS)
+    return columns, float(track.metadata.get('timescale') or 1)
+
+def score_matrix(columns):
+    '''The emotion scores as an (rows, len(EMOTIONS)) float array, in EMOTIONS order.'''
+    return numpy.stack([numpy.asarray(columns[emotion], dtype=numpy.float64) for emotion in EMOTIONS], axis=1)
+
+def dominant_emotion(columns):
+    '''Index (into EMOTIONS) of the highest score of each row, -1 for rows without scores.'''
+    scores = score_matrix(columns)
+    scored = numpy.isfinite(scores).all(axis=1)
+    dominant = numpy.full(len(scores), -1, dtype=numpy.int64)
+    if scored.any():
+        dominant[scored] = scores[scored].argmax(axis=1)
+    return dominant
+
+def mean_scores_per_face(track):
+    '''Mean emotion scores of every face.
+
+    Returns:
+        (face ids, (faces, len(EMOTIONS)) array of mean scores)
+    '''
+    columns, timescale = as_columns(track)
+    scores = score_matrix(columns)
+    scored = numpy.isfinite(scores).all(axis=1)
+    face_ids, face_index = numpy.unique(numpy.asarray(columns['face_id'])[scored], return_inverse=True)
+    sums = numpy.zeros((len(face_ids), len(EMOTIONS)))
+    numpy.add.at(sums, face_index, scores[scored])
+    counts = numpy.bincount(face_index, minlength=len(face_ids))
+    return face_ids, sums / numpy.maximum(counts, 1)[:, None]
+
+def dominant_emotion_per_face(track):
+    '''Dominant emotion (highest mean score) of every face.
+
+    Returns:
+        A dict of face id -> emotion name.
+    '''
+    face_ids, means = mean_scores_per_face(track)
+    return dict((int(face_id), EMOTIONS[index]) for face_id, index in zip(face_ids, means.argmax(axis=1)))
+
+def rolling_mean(track, window_seconds):
+    '''Rolling mean of each face's scores over the trailing `window_seconds`.
+
+    For every row the mean is over the rows of the same face with
+    timestamp in (t - window, t]. Computed with per-face cumulative sums and
+    a binary search for the window starts, no Python loop over rows.
+
+    Returns:
+        A (rows, len(EMOTIONS)) array aligned with the input rows (NaN for rows without scores).
+    '''
+    columns, timescale = as_columns(track)
+    scores = score_matrix(columns)
+    timestamps = numpy.asarray(columns['timestamp'], dtype=numpy.int64)
+    face_ids = numpy.asarray(columns['face_id'])
+    window = int(round(window_seconds * timescale))
+
+    # order rows by (face, time) so each face is one contiguous run
+    order = numpy.lexsort((timestamps, face_ids))
+    sorted_faces = face_ids[order]
+    # offset the timestamps of each face run so a single searchsorted never crosses faces
+    run_start = numpy.r_[0, numpy.flatnonzero(numpy.diff(sorted_faces)) + 1]
+    run_index = numpy.repeat(numpy.arange(len(run_start)), numpy.diff(numpy.r_[run_start, len(order)]))
+    span = int(timestamps.max() - timestamps.min()) + window + 1 if len(timestamps) else 1
+    keys = (timestamps[order] - (timestamps.min() if len(timestamps) else 0)) + run_index * span
+    first = numpy.searchsorted(keys, keys - window, side='right')
+
+    sorted_scores = numpy.nan_to_num(scores[order])
+    scored = numpy.isfinite(scores[order]).all(axis=1).astype(numpy.float64)
+    cumulative = numpy.vstack([numpy.zeros((1, len(EMOTIONS))), numpy.cumsum(sorted_scores, axis=0)])
+    cumulative_count = numpy.r_[0.0, numpy.cumsum(scored)]
+    last = numpy.arange(1, len(order) + 1)
+    counts = cumulative_count[last] - cumulative_count[first]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        means = (cumulative[last] - cumulative[first]) / counts[:, None]
+    result = numpy.empty_like(means)
+    result[order] = means
+    return result
+
+def interval_histogram(track, interval_seconds):
+    '''Per-interval histogram of the dominant emotion of the face rows.
+
+    Returns:
+        (interval start times in seconds, (intervals, len(EMOTIONS)) array of row counts)
+    '''
+    columns, timescale = as_columns(track)
+    dominant = dominant_emotion(columns)
+    timestamps = numpy.asarray(columns['timestamp'], dtype=numpy.int64)
+    interval = max(1, int(round(interval_seconds * timescale)))
+    scored = dominant >= 0
+    intervals = timestamps[scored] // interval
+    if len(intervals) == 0:
+        return numpy.empty(0), numpy.zeros((0, len(EMOTIONS)), dtype=numpy.int64)
+    first = intervals.min()
+    bins = (intervals - first) * len(EMOTIONS) + dominant[scored]
+    count = int(intervals.max() - first + 1)
+    histogram = numpy.bincount(bins, minlength=count * len(EMOTIONS)).reshape(count, len(EMOTIONS))
+    return (numpy.arange(count) + first) * interval / timescale, histogram
+
+def aggregate_emotion(track, window_ms=AGGREGATE_WINDOW_MS, interval_ms=AGGREGATE_INTERVAL_MS):
+    '''Local equivalent of the AMS AggregateEmotion mode.
+
+    Every `interval_ms` a window of `window_ms` is summarised over all faces in it:
+    the mean scores (windowMeanScores) and the share of faces whose dominant
+    emotion is each emotion (windowFaceDistribution).
+
+    Args:
+        track: A FaceTrack, a StoredTrack or a dict of columns (PerFaceEmotion scores).
+        window_ms (float): aggregateEmotionWindowMs.
+        interval_ms (float): aggregateEmotionIntervalMs.
+
+    Returns:
+        A dict with 'start' (window starts in seconds), 'faces' (scored rows per
+        window), 'mean_scores' and 'face_distribution' ((windows, len(EMOTIONS)) arrays).
+    '''
+    columns, timescale = as_columns(track)
+    scores = score_matrix(columns)
+    dominant = dominant_emotion(columns)
+    scored = dominant >= 0
+    timestamps = numpy.asarray(columns['timestamp'], dtype=numpy.int64)[scored]
+    order = numpy.argsort(timestamps, kind='stable')
+    timestamps = timestamps[order]
+    scores = scores[scored][order]
+    onehot = numpy.zeros((len(timestamps), len(EMOTIONS)))
+    onehot[numpy.arange(len(timestamps)), dominant[scored][order]] = 1.0
+
+    window = window_ms / 1000.0 * timescale
+    interval = interval_ms / 1000.0 * timescale
+    end = timestamps[-1] if len(timestamps) else 0
+    starts = numpy.arange(0, end + 1, interval) if len(timestamps) else numpy.empty(0)
+    first = numpy.searchsorted(timestamps, starts, side='left')
+    last = numpy.searchsorted(timestamps, starts + window, side='left')
+
+    cumulative_scores = numpy.vstack([numpy.zeros((1, len(EMOTIONS))), numpy.cumsum(scores, axis=0)])
+    cumulative_onehot = numpy.vstack([numpy.zeros((1, len(EMOTIONS))), numpy.cumsum(onehot, axis=0)])
+    faces = last - first
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean_scores = (cumulative_scores[last] - cumulative_scores[first]) / faces[:, None]
+        face_distribution = (cumulative_onehot[last] - cumulative_onehot[first]) / faces[:, None]
+    empty = faces == 0
+    mean_scores[empty] = 0.0
+    face_distribution[empty] = 0.0
+    return {'start': starts / timescale, 'faces': faces, 'mean_scores': mean_scores, 'face_distribution': face_distribution}
+
+def aggregate_emotion_events(aggregate):
+    '''AMS-shaped AggregateEmotion events (windowFaceDistribution/windowMeanScores) from aggregate_emotion().'''
+    events = []
+    for mean_scores, face_distribution in zip(aggregate['mean_scores'], aggregate['face_distribution']):
+        events.append({'windowFaceDistribution': dict(zip(EMOTIONS, face_distribution.tolist())),
+                       'windowMeanScores': dict(zip(EMOTIONS, mean_scores.tolist()))})
+    return events
@@ -0,0 +1,204 @@
+# coding: utf-8
+
+#Streaming parser for the Azure Media Face Detector output (JSON) into compact columns
+import json
+from array import array
+
+# Emotion scores reported by the Face Detector, one column each
+EMOTIONS = ('neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt')
+
+# Column name -> array typecode (fixed dtype: int64 ticks, int32 ids, float32 geometry and scores)
+COLUMNS = (('timestamp', 'q'), ('face_id', 'i'), ('x', 'f'), ('y', 'f'), ('w', 'f'), ('h', 'f')) + \
+          tuple((emotion, 'f') for emotion in EMOTIONS)
+
+# Metadata header fields of the output
+METADATA_FIELDS = ('version', 'timescale', 'offset', 'framerate', 'width', 'height')
+
+PARSE_CHUNK_SIZE = 1024 * 1024
+NUMPY_DTYPES = {'q': 'int64', 'i': 'int32', 'f': 'float32', 'd': 'float64'}
+
+class FaceTrack(object):
+    '''Face Detector rows as fixed-dtype columns plus the metadata header.
+
+    Timestamps are in ticks of `metadata['timescale']` (see seconds()); x, y, w
+    and h are relative to the frame, as in the Face Detector output. Emotion
+    columns are NaN for faces without scores.
+
+    Args:
+        metadata (dict): Header fields (timescale, offset, framerate, width, height).
+    '''
+    def __init__(self, metadata=None):
+        self.metadata = dict(metadata or {})
+        self.columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+    def append(self, timestamp, face):
+        '''Append the row of one face of an event.'''
+        columns = self.columns
+        columns['timestamp'].append(timestamp)
+        columns['face_id'].append(face['id'])
+        columns['x'].append(face.get('x', 0.0))
+        columns['y'].append(face.get('y', 0.0))
+        columns['w'].append(face.get('width', 0.0))
+        columns['h'].append(face.get('height', 0.0))
+        scores = face.get('scores') or {}
+        for emotion in EMOTIONS:
+            columns[emotion].append(scores.get(emotion, float('nan')))
+
+    def extend(self, other):
+        '''Append the rows of another FaceTrack.'''
+        for name, column in other.columns.items():
+            self.columns[name].extend(column)
+
+    def seconds(self):
+        '''Timestamps in seconds (timestamp / timescale), as an array of doubles.'''
+        timescale = float(self.metadata.get('timescale') or 1)
+        return array('d', (timestamp / timescale for timestamp in self.columns['timestamp']))
+
+    def to_numpy(self):
+        '''Return the columns as NumPy arrays (zero copy, requires numpy).'''
+        import numpy
+        return dict((name, numpy.frombuffer(column, dtype=NUMPY_DTYPES[column.typecode]) if len(column) else numpy.empty(0, dtype=NUMPY_DTYPES[column.typecode]))
+                    for name, column in self.columns.items())
+
+class _JSONStream(object):
+    '''Pull reader over a JSON text, decoding one value at a time with the C decoder.'''
+    def __init__(self, file, chunk_size=PARSE_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self, size):
+        if self.eof:
+            return False
+        chunk = self.file.read(size)
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode('utf-8')
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        '''Next non-blank character ('' at the end of the input).'''
+        while True:
+            buffer = self.buffer
+            while self.pos < len(buffer) and buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(buffer):
+                return buffer[self.pos]
+            if not self._fill(self.chunk_size):
+                return ''
+
+    def expect(self, chars):
+        '''Consume one of `chars` and return it.'''
+        char = self.peek()
+        if char == '' or char not in chars:
+            raise ValueError("Face Detector output: expected one of '" + chars + "', got '" + char + "'")
+        self.pos += 1
+        return char
+
+    def value(self):
+        '''Decode the next JSON value, reading more input until it is complete.'''
+        self.peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            if end == len(self.buffer) and self._fill(size):
+                # a number may go on in the next chunk
+                continue
+            self.pos = end
+            return value
+
+def iter_output(file, chunk_size=PARSE_CHUNK_SIZE):
+    '''Walk the top level of a Face Detector output.
+
+    Yields ('metadata', key, value) for the header fields and ('fragment', None,
+    fragment) for each fragment, holding a single fragment in memory at a time.
+    '''
+    stream = _JSONStream(file, chunk_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        stream.expect(':')
+        if key == 'fragments':
+            stream.expect('[')
+            if stream.peek() == ']':
+                stream.pos += 1
+            else:
+                while True:
+                    yield ('fragment', None, stream.value())
+                    if stream.expect(',]') == ']':
+                        break
+        else:
+            yield ('metadata', key, stream.value())
+        if stream.expect(',}') == '}':
+            return
+
+def iter_face_batches(path, batch_rows=65536, chunk_size=PARSE_CHUNK_SIZE):
+    '''Stream a Face Detector output as FaceTrack batches of about `batch_rows` rows.
+
+    Memory use is bounded by the batch and one fragment, whatever the video length.
+    The metadata of each batch holds the header fields read so far (in AMS output
+    they come before the fragments).
+
+    Args:
+        path (str): Path of the Face Detector JSON output.
+        batch_rows (int): Rows per batch.
+        chunk_size (int): Characters read at a time.
+    '''
+    metadata = {}
+    batch = FaceTrack(metadata)
+    batches = 0
+    with open(path, encoding='utf-8') as file:
+        for kind, key, value in iter_output(file, chunk_size):
+            if kind == 'metadata':
+                if key in METADATA_FIELDS:
+                    metadata[key] = value
+                    batch.metadata[key] = value
+                continue
+            start = value.get('start', 0)
+            interval = value.get('interval', 0)
+            for index, event in enumerate(value.get('events') or ()):
+                timestamp = start + index * interval
+                for face in event:
+                    if isinstance(face, dict) and 'id' in face:
+                        batch.append(timestamp, face)
+            if len(batch) >= batch_rows:
+                yield batch
+                batches += 1
+                batch = FaceTrack(metadata)
+    if len(batch) or not batches:
+        batch.metadata.update(metadata)
+        yield batch
+
+def parse_face_detector_output(path, chunk_size=PARSE_CHUNK_SIZE):
+    '''Parse a whole Face Detector output into one FaceTrack.
+
+    Args:
+        path (str): Path of the Face Detector JSON output.
+        chunk_size (int): Characters read at a time.
+
+    Returns:
+        A FaceTrack with every face row and the metadata header.
+    '''
+    track = FaceTrack()
+    for batch in iter_face_batches(path, chunk_size=chunk_size):
+        track.extend(batch)
+        track.metadata.update(batch.metadata)
+    return track
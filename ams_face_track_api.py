@@ -12,16 +12,35 @@ import time
 import sys
 import urllib
 import datetime
-import adal
+import fnmatch
+import base64
+import threading
+import atexit
+import queue
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from azure.storage.blob import BlockBlobService
-from azure.storage.blob import ContentSettings
+# adal and azure.storage.blob are imported where they are used, so that the
+# commands that only query AMS (see ams_cli.py) do not pay for loading them
+import ams_dedup
+import ams_results
+import ams_journal
+import ams_metrics
+import ams_scheduler
+import ams_odata
 
 #public variables
 VIDEO_PATH    = 'input_video_path'
 OUTPUT_FOLDER = 'results_output_path'
 REQUEST_BODY  = './emotion.json'
 CONFIG_FILE   = './config.json'
+TOKEN_CACHE_FILE = None   # e.g. './token_cache.json' to share the access token between processes
+PROCESSOR_CACHE_FILE = './processor_cache.json'   # None to keep the processor ids in memory only
+STORE_RESULTS = True   # convert the downloaded results into the columnar store (ams_results.RESULTS_STORE)
+JOURNAL_FILE  = ams_journal.JOURNAL_FILE   # None to run without the crash-safe workflow journal
+METRICS_SUMMARY_FILE    = None   # e.g. './metrics.json', JSON run summary written at exit
+METRICS_PROMETHEUS_FILE = None   # e.g. './metrics.prom', Prometheus text written at exit
 
 #AMS Endpoints...
 ams_auth_endpoint = 'https://login.microsoftonline.com/'
@@ -38,11 +57,747 @@ xml_acceptformat       = 'application/atom+xml'
 xmsversion             = '2.19'
 charset                = 'UTF-8'
 
+# JSON responses: metadata level ('verbose', 'minimal' or 'none', see ams_odata.JSON_FORMATS; the
+# light formats drop the __metadata/__deferred blocks) and the compressions accepted (None: identity)
+odata_metadata  = 'minimal'
+accept_encoding = 'gzip, deflate'
+
+# AMS REST client defaults (connection pool sizing for the keep-alive session)
+ams_pool_connections = 10
+ams_pool_maxsize     = 10
+
+# Group the upload setup calls and the cleanup deletes into OData $batch requests
+# (turned off for the run if the service refuses $batch)
+odata_batch = True
+
+# Block upload: block size (bytes) and parallel block uploads per file
+upload_block_size      = 4 * 1024 * 1024
+upload_max_connections = 5
+upload_max_blocks      = 50000   # Azure limit of blocks per block blob
+
+# Upload write access policies, shared by every upload through the policy pool
+upload_policy_name      = "8k_UploadPolicy"
+upload_policy_duration  = "60"   # in minutes, validity of each locator created from the policy
+upload_policy_pool_size = 2
+
+# Extra BlockBlobService arguments for every blob client, e.g. {'custom_domain': 'http://127.0.0.1:8080/blob', 'protocol': 'http'}
+# to point the blob transfers at a local stand-in (see ams_mock.py)
+blob_service_options = {}
+
+# Job output download: parallel blob downloads, and which blobs to fetch (fnmatch patterns)
+download_max_connections = 8
+download_include = None        # e.g. ['*.json'] to fetch only the JSON results
+download_exclude = None
+DOWNLOAD_MANIFEST = '.download_manifest.json'   # ETags of the downloaded blobs, kept in OUTPUT_FOLDER
+
+# Media processor ids are cached for this many seconds
+processor_cache_ttl = 24 * 3600
+
+# Job polling: adaptive interval (seconds) between status queries
+job_poll_min   = 5      # while Queued/Scheduled, and the first Processing checks
+job_poll_max   = 180    # upper bound, also for the error backoff
+job_poll_ratio = 0.25   # interval grows with the time a job has spent Processing
+job_filter_batch = 20   # jobs per $filter query, keeps the URL short
+
+# Listings (see helper_iter): entities per page (at most ams_odata.MAX_PAGE_SIZE), and
+# whether the next page is fetched while the current one is consumed
+list_page_size = 1000
+list_prefetch  = True
+
+# Job notifications (see ams_notify): the jobs push their state changes to a local webhook
+# receiver, and the status polling only runs as a safety net every job_poll_safety seconds
+job_notifications    = False
+job_notification_url = None   # URL AMS posts to (e.g. through a reverse proxy), the receiver's own address if None
+job_poll_safety      = 300
+job_notification_endpoint_id = None   # NotificationEndPoint the new jobs subscribe to, set by ams_notify.enable()
+
+# Multi-task jobs: tasks packed into one Media Job (AMS allows at most 50)
+job_max_tasks = 50
+
+# Access token refresh: renew this many seconds before the token expires
+token_refresh_margin = 300
+
+class AMSRestClient(object):
+    '''Reusable AMS REST client.
+
+    Holds a pooled keep-alive requests.Session, builds the AMS headers once per
+    access token and caches the redirected AMS endpoint, so that after the first
+    301 every call goes straight to the redirected endpoint. Calls go through the
+    account's RequestScheduler (ams_scheduler): rate limited, and retried when
+    throttled or, for idempotent methods, on server and connection errors.
 
+    Args:
+        access_token (str): A valid Azure authentication token.
+        endpoint (str): Azure Media Services Initial Endpoint.
+        redirected_endpoint (str): Azure Media Services Redirected Endpoint, if already known.
+        pool_connections (int): Number of connection pools to cache.
+        pool_maxsize (int): Maximum number of connections kept alive per pool.
+    '''
+    def __init__(self, access_token=None, endpoint=None, redirected_endpoint=None,
+                 pool_connections=ams_pool_connections, pool_maxsize=ams_pool_maxsize):
+        self.endpoint = endpoint if endpoint is not None else ams_rest_endpoint
+        self.redirected_endpoint = redirected_endpoint
+        self.scheduler = ams_scheduler.for_ams(self.endpoint)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.access_token = None
+        self.token_provider = None
+        self._headers = {}
+        self.set_access_token(access_token)
+
+    def set_access_token(self, access_token):
+        '''Set the access token, dropping the cached headers if it changed.'''
+        if access_token != self.access_token:
+            self.access_token = access_token
+            self._headers = {}
+
+    def headers(self, rformat="json", content_type=True):
+        '''Return the (cached) AMS headers for a response format.
+
+        Args:
+            rformat (str): A required Accept Format ("json", "json_only" or "xml").
+            content_type (bool): Include the Content-Type header.
+
+        Returns:
+            A dict of HTTP headers.
+        '''
+        key = (rformat, content_type, odata_metadata, accept_encoding)
+        headers = self._headers.get(key)
+        if headers is None:
+            # request bodies stay verbose (__metadata links), only the responses follow odata_metadata
+            content_acceptformat = json_acceptformat
+            acceptformat = ams_odata.JSON_FORMATS[odata_metadata]
+            if rformat == "json_only":
+                content_acceptformat = json_only_acceptformat
+            if rformat == "xml":
+                content_acceptformat = xml_acceptformat
+                acceptformat = xml_acceptformat + ",application/xml"
+            headers = {"Accept": acceptformat,
+                       "Accept-Charset" : charset,
+                       "Accept-Encoding": accept_encoding or "identity",
+                       "Authorization": "Bearer " + str(self.access_token),
+                       "x-ms-version" : xmsversion}
+            if rformat != "xml" and odata_metadata != "verbose":
+                # the light JSON formats are OData v3
+                headers["DataServiceVersion"] = "3.0"
+                headers["MaxDataServiceVersion"] = "3.0"
+            if content_type:
+                headers["Content-Type"] = content_acceptformat
+            self._headers[key] = headers
+        return headers
+
+    def url_for(self, endpoint, path):
+        '''Rewrite an initial endpoint URL to the cached redirected endpoint.'''
+        if self.redirected_endpoint and endpoint.startswith(self.endpoint):
+            return ''.join([self.redirected_endpoint, path])
+        return endpoint
+
+    def request(self, method, endpoint, path, body=None, rformat="json", content_type=True, extra_headers=None):
+        '''Do an AMS HTTP request, following (and caching) the AMS redirect.
+
+        Args:
+            method (str): HTTP method.
+            endpoint (str): Azure Media Services Initial Endpoint.
+            path (str): Azure Media Services Endpoint Path.
+            body  (str): Azure Media Services Content Body.
+            rformat (str): A required JSON Accept Format.
+            content_type (bool): Send the Content-Type header.
+            extra_headers (dict): Headers added to (or replacing) the AMS headers.
+
+        Returns:
+            HTTP response. JSON body.
+        '''
+        return self.scheduler.call(lambda: self._request(method, endpoint, path, body, rformat, content_type, extra_headers), method,
+                                   (requests.ConnectionError, requests.Timeout))
+
+    def _request(self, method, endpoint, path, body, rformat, content_type, extra_headers=None):
+        if self.token_provider is not None:
+            self.set_access_token(self.token_provider.get_token())
+        started = time.time()
+        headers = self.headers(rformat, content_type)
+        if extra_headers:
+            headers = dict(headers, **extra_headers)
+        url = self.url_for(endpoint, path)
+        response = self.session.request(method, url, data=body, headers=headers, allow_redirects=False)
+        if response.status_code == 401 and self.token_provider is not None:
+            # The token was revoked or expired early, get a new one and try once more
+            self.set_access_token(self.token_provider.refresh(force=True))
+            headers = self.headers(rformat, content_type)
+            if extra_headers:
+                headers = dict(headers, **extra_headers)
+            response = self.session.request(method, url, data=body, headers=headers, allow_redirects=False)
+        # AMS response to the first call can be a redirect,
+        # so we handle it here to make it transparent for the caller...
+        if response.status_code == 301:
+            location = response.headers['location']
+            if endpoint.startswith(self.endpoint):
+                self.redirected_endpoint = location
+            response = self.session.request(method, ''.join([location, path]), data=body, headers=headers)
+        ams_metrics.record_request(method, path, response.status_code, time.time() - started, len(body or ''), ams_metrics.wire_size(response))
+        return response
+
+    def get_url(self, endpoint, flag=True):
+        '''Do an AMS GET request to retrieve the Final AMS Endpoint.
+
+        Args:
+            endpoint (str): Azure Media Services Initial Endpoint.
+            flag  (bool): A Flag to follow the redirect or not.
+
+        Returns:
+            HTTP response. JSON body.
+        '''
+        return self.scheduler.call(lambda: self._get_url(endpoint, flag), "GET", (requests.ConnectionError, requests.Timeout))
+
+    def _get_url(self, endpoint, flag):
+        if self.token_provider is not None:
+            self.set_access_token(self.token_provider.get_token())
+        started = time.time()
+        headers = self.headers()
+        response = self.session.get(endpoint, headers=headers, allow_redirects=flag)
+        if flag:
+            if response.status_code == 301:
+                response = self.session.get(response.headers['location'], headers=headers)
+            if response.status_code == 200 and endpoint == self.endpoint:
+                self.redirected_endpoint = str(response.url)
+        ams_metrics.record_request("GET", endpoint, response.status_code, time.time() - started, 0, ams_metrics.wire_size(response))
+        return response
+
+_ams_client = None
+
+def get_ams_client(access_token=None):
+    '''Return the shared AMS REST client, creating it on first use.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+
+    Returns:
+        The shared AMSRestClient.
+    '''
+    global _ams_client
+    if _ams_client is None:
+        _ams_client = AMSRestClient(endpoint=ams_rest_endpoint)
+    # With a token provider attached the client always uses the provider's current token
+    if access_token is not None and _ams_client.token_provider is None:
+        _ams_client.set_access_token(access_token)
+    return _ams_client
+
+def configure_ams_client(pool_connections=ams_pool_connections, pool_maxsize=ams_pool_maxsize):
+    '''Replace the shared AMS REST client with one using a new pool size.
+
+    Args:
+        pool_connections (int): Number of connection pools to cache.
+        pool_maxsize (int): Maximum number of connections kept alive per pool.
+
+    Returns:
+        The shared AMSRestClient.
+    '''
+    global _ams_client
+    previous = _ams_client
+    _ams_client = AMSRestClient(endpoint=ams_rest_endpoint, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    if previous is not None:
+        _ams_client.set_access_token(previous.access_token)
+        _ams_client.token_provider = previous.token_provider
+        _ams_client.redirected_endpoint = previous.redirected_endpoint
+        previous.session.close()
+    return _ams_client
+
+class AccessTokenProvider(object):
+    '''Shared Azure access token cache with proactive refresh.
+
+    Keeps the token and its expiry in memory and, optionally, in a cache file
+    guarded by a file lock, so that several workers or processes make a single
+    AAD request per token lifetime. A background thread renews the token
+    `refresh_margin` seconds before it expires.
+
+    Args:
+        tenant_id (str): Tenant id of the user's account.
+        application_id (str): Application id of a Service Principal account.
+        application_secret (str): Application secret (password) of the Service Principal account.
+        cache_file (str): Optional path of a JSON file to share the token between processes.
+        refresh_margin (int): Seconds before expiry at which the token is renewed.
+    '''
+    def __init__(self, tenant_id, application_id, application_secret, cache_file=None, refresh_margin=token_refresh_margin):
+        self.tenant_id = tenant_id
+        self.application_id = application_id
+        self.application_secret = application_secret
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_on = 0.0
+        self._context = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def is_valid(self):
+        '''True if the cached token is not within the refresh margin of its expiry.'''
+        return self.access_token is not None and time.time() < self.expires_on - self.refresh_margin
+
+    def get_token(self):
+        '''Return a valid access token, refreshing it only when needed.'''
+        if self.is_valid():
+            return self.access_token
+        return self.refresh()
+
+    def refresh(self, force=False):
+        '''Renew the access token (once, even if called from several threads).
+
+        Args:
+            force (bool): Renew even if the cached token is still valid.
+
+        Returns:
+            An Azure authentication token string.
+        '''
+        with self._lock:
+            if not force and self.is_valid():
+                return self.access_token
+            if self.cache_file is None:
+                self._acquire()
+            else:
+                with _file_lock(self.cache_file + '.lock'):
+                    if force or not self._read_cache_file():
+                        self._acquire()
+                        self._write_cache_file()
+            return self.access_token
+
+    @ams_metrics.timed_stage('token')
+    def _acquire(self):
+        if self._context is None:
+            import adal
+            self._context = adal.AuthenticationContext(ams_auth_endpoint + self.tenant_id, api_version=None)
+        token_response = self._context.acquire_token_with_client_credentials(AZURE_RESOURCE_ENDPOINT, self.application_id, self.application_secret)
+        self.access_token = token_response.get('accessToken')
+        self.expires_on = token_expires_on(token_response)
+
+    def _read_cache_file(self):
+        try:
+            with open(self.cache_file) as cacheFile:
+                cacheData = json.load(cacheFile)
+        except (IOError, ValueError):
+            return False
+        self.access_token = cacheData.get('accessToken')
+        self.expires_on = float(cacheData.get('expiresOnTimestamp', 0))
+        return self.is_valid()
+
+    def _write_cache_file(self):
+        tmp_file = self.cache_file + '.tmp'
+        with open(tmp_file, 'w') as cacheFile:
+            json.dump({'accessToken': self.access_token,
+                       'expiresOn': str(datetime.datetime.fromtimestamp(self.expires_on)),
+                       'expiresOnTimestamp': self.expires_on}, cacheFile)
+        os.replace(tmp_file, self.cache_file)
+
+    def start(self):
+        '''Start the background refresh thread (idempotent).'''
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='ams-token-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop the background refresh thread.'''
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.expires_on - self.refresh_margin - time.time()
+            if wait > 0:
+                self._stop.wait(wait)
+                continue
+            try:
+                self.refresh()
+            except Exception as e:
+                print("Access Token Refresh ERROR............: " + str(e))
+                self._stop.wait(30)
+
+def token_expires_on(token_response):
+    '''AUX Function to get the expiry (epoch seconds) of an adal token response.
+
+    Args:
+        token_response (dict): A token response from adal.
+
+    Returns:
+        The expiry as a POSIX timestamp.
+    '''
+    if token_response.get('expiresIn') is not None:
+        return time.time() + float(token_response['expiresIn'])
+    try:
+        # adal reports expiresOn in local time
+        expires_on = datetime.datetime.strptime(str(token_response.get('expiresOn')), '%Y-%m-%d %H:%M:%S.%f')
+        return time.mktime(expires_on.timetuple())
+    except ValueError:
+        return time.time()
+
+class _file_lock(object):
+    '''Exclusive lock on a lock file (a no-op where fcntl is not available).'''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        try:
+            import fcntl
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            pass
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+_token_providers = {}
+_token_providers_lock = threading.Lock()
+
+def get_token_provider(tenant_id, application_id, application_secret, cache_file=None, background=True):
+    '''Return the shared access token provider for a Service Principal.
+
+    Args:
+        tenant_id (str): Tenant id of the user's account.
+        application_id (str): Application id of a Service Principal account.
+        application_secret (str): Application secret (password) of the Service Principal account.
+        cache_file (str): Optional token cache file, defaults to TOKEN_CACHE_FILE.
+        background (bool): Start the background refresh thread.
+
+    Returns:
+        The shared AccessTokenProvider.
+    '''
+    key = (tenant_id, application_id)
+    with _token_providers_lock:
+        provider = _token_providers.get(key)
+        if provider is None:
+            if cache_file is None:
+                cache_file = TOKEN_CACHE_FILE
+            provider = AccessTokenProvider(tenant_id, application_id, application_secret, cache_file)
+            _token_providers[key] = provider
+    if background:
+        provider.start()
+    return provider
+
+# Job states after which a job does not change anymore (Finished, Error, Canceled)
+JOB_FINAL_STATES = ("3", "4", "5")
+
+class JobWatcher(object):
+    '''Track every outstanding Media Job with one status query per cycle.
+
+    All watched jobs are polled together through list_media_jobs ($filter on
+    /Jobs). The poll interval adapts to the job states: short while jobs are
+    Queued or Scheduled, growing with the time spent Processing, and backing
+    off exponentially on errors. A job's callback is called, from the watcher
+    thread, as soon as it reaches Finished, Error or Canceled.
+
+    With job notifications (see ams_notify), a pushed final state triggers the
+    status query at once, and the polling falls back to every `poll_safety`
+    seconds, in case a notification is lost.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        poll_min (float): Shortest poll interval in seconds.
+        poll_max (float): Longest poll interval in seconds.
+        poll_ratio (float): Interval as a fraction of the time spent Processing.
+        batch_size (int): Jobs per $filter query.
+        poll_safety (float): Poll interval while job notifications are on.
+    '''
+    def __init__(self, access_token, poll_min=job_poll_min, poll_max=job_poll_max, poll_ratio=job_poll_ratio, batch_size=job_filter_batch,
+                 poll_safety=job_poll_safety):
+        self.access_token = access_token
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.poll_ratio = poll_ratio
+        self.batch_size = batch_size
+        self.poll_safety = poll_safety
+        self.jobs = {}
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def watch(self, job_id, callback):
+        '''Watch a job until it finishes (a job can be watched by several callers).
+
+        Args:
+            job_id (str): Media Service Job OID.
+            callback (callable): Called with the job entity (the 'd' JSON object)
+                once the job reached a final state.
+        '''
+        with self._lock:
+            self.jobs.setdefault(job_id, {'callbacks': [], 'state': None, 'since': time.time(), 'watched': time.time(), 'processing': None})['callbacks'].append(callback)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ams-job-watcher', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def wait(self, job_id, timeout=None):
+        '''Block until a job finishes.
+
+        Args:
+            job_id (str): Media Service Job OID.
+            timeout (float): Seconds to wait, None to wait forever.
+
+        Returns:
+            The job entity, or None on timeout.
+        '''
+        done = threading.Event()
+        result = {}
+        def finished(job):
+            result['job'] = job
+            done.set()
+        self.watch(job_id, finished)
+        done.wait(timeout)
+        return result.get('job')
+
+    def notify(self, job_id, state=None):
+        '''Take a job state change pushed by a notification (called from the ams_notify receiver).
+
+        A final (or unknown) state wakes the watcher up for a status query right
+        away; the other states are only recorded, without a request.
+
+        Args:
+            job_id (str): Media Service Job OID.
+            state (str): The new state code, None if unknown.
+        '''
+        with self._lock:
+            watched = self.jobs.get(job_id)
+            if watched is None:
+                return
+            if state is not None and state not in JOB_FINAL_STATES:
+                if watched['state'] != state:
+                    watched['state'] = state
+                    watched['since'] = time.time()
+                    if state == "2":
+                        watched['processing'] = watched['since']
+                    print("Media Job Status........................: " + job_id + " " + translate_job_state(state) + " (notified)")
+                return
+        self._wake.set()
+
+    def interval(self):
+        '''Seconds until the next status query.'''
+        if self.errors:
+            return min(self.poll_max, self.poll_min * 2 ** self.errors)
+        if job_notification_endpoint_id is not None:
+            return self.poll_safety
+        now = time.time()
+        interval = self.poll_max
+        with self._lock:
+            for job in self.jobs.values():
+                if job['state'] == "2":
+                    interval = min(interval, max(self.poll_min, (now - job['since']) * self.poll_ratio))
+                else:
+                    interval = min(interval, self.poll_min)
+        return interval
+
+    @ams_scheduler.prioritized('poll')
+    def poll(self):
+        '''Query the state of every watched job once and dispatch the finished ones.'''
+        with self._lock:
+            job_ids = list(self.jobs)
+        finished = []
+        for start in range(0, len(job_ids), self.batch_size):
+            response = list_media_jobs(self.access_token, job_ids[start:start + self.batch_size])
+            if (response.status_code != 200):
+                print("GET Status..............................: " + str(response.status_code) + " - Media Jobs Listing ERROR." + str(response.content))
+                self.errors += 1
+                return finished
+            for job in ams_odata.results(response.json()):
+                job_id = str(job['Id'])
+                job_state = str(job['State'])
+                with self._lock:
+                    watched = self.jobs.get(job_id)
+                    if watched is None:
+                        continue
+                    if watched['state'] != job_state:
+                        watched['state'] = job_state
+                        watched['since'] = time.time()
+                        if job_state == "2":
+                            watched['processing'] = watched['since']
+                        print("Media Job Status........................: " + job_id + " " + translate_job_state(job_state))
+                    if job_state in JOB_FINAL_STATES:
+                        del self.jobs[job_id]
+                        ams_metrics.record_job(watched['watched'], watched['processing'], time.time(), job_state)
+                        finished.extend((callback, job) for callback in watched['callbacks'])
+        self.errors = 0
+        for callback, job in finished:
+            callback(job)
+        return finished
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self.jobs:
+                    self._thread = None
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                print("Media Jobs Listing ERROR................: " + str(e))
+                self.errors += 1
+            self._wake.clear()
+            # a newly watched job wakes the watcher up early
+            self._wake.wait(self.interval())
+
+_job_watcher = None
+
+def get_job_watcher(access_token):
+    '''Return the shared JobWatcher, so concurrent workers share one status query.'''
+    global _job_watcher
+    if _job_watcher is None:
+        _job_watcher = JobWatcher(access_token)
+    _job_watcher.access_token = access_token
+    return _job_watcher
+
+def enable_job_notifications(access_token):
+    '''Start the job notification receiver and register its endpoint, if job_notifications is on (see ams_notify).'''
+    if job_notifications and job_notification_endpoint_id is None:
+        import ams_notify
+        ams_notify.enable(access_token, job_notification_url)
+
+def wait_for_job(access_token, job_id, timeout=None):
+    '''Wait for a Media Job to reach Finished, Error or Canceled.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job_id (str): Media Service Job OID.
+        timeout (float): Seconds to wait, None to wait forever.
+
+    Returns:
+        The job entity (the 'd' JSON object), or None on timeout.
+    '''
+    return get_job_watcher(access_token).wait(job_id, timeout)
 
-def uploadCallback(current, total):
+def uploadCallback(current, total, started=None):
     if (current != None):
-        print('{0:2,f}/{1:2,.0f} MB'.format(current,total/1024/1024))
+        progress = '{0:2,.0f}/{1:2,.0f} MB'.format(current/1024/1024,total/1024/1024)
+        if started is not None:
+            elapsed = time.time() - started
+            if elapsed > 0:
+                progress += ' ({0:,.2f} MB/s)'.format(current/1024/1024/elapsed)
+        print(progress)
+
+def get_blob_service(account_name, account_key=None, sas_token=None):
+    '''Build a BlockBlobService (with the account key or a SAS token), applying blob_service_options.
+
+    Its requests go through the storage account's RequestScheduler, at the
+    priority of the current stage, and its retries honour Retry-After.
+
+    Args:
+        account_name (str): The storage account name.
+        account_key (str): The storage account key.
+        sas_token (str): A SAS token (without the leading '?').
+
+    Returns:
+        BlockBlobService.
+    '''
+    from azure.storage.blob import BlockBlobService
+    block_blob_service = BlockBlobService(account_name=account_name, account_key=account_key, sas_token=sas_token, **blob_service_options)
+    block_blob_service.request_callback, block_blob_service.retry = ams_scheduler.for_blob(account_name).storage_callbacks()
+    return block_blob_service
+
+def block_id(index):
+    '''AUX Function to build the (fixed length, base64) id of the n-th block of a blob.'''
+    return base64.b64encode('{0:08d}'.format(index).encode('ascii')).decode('ascii')
+
+def upload_file_blocks(block_blob_service, container_name, blob_name, file_path, block_size=None,
+                       max_connections=None, content_type='video/mp4', state_file=None, progress_callback=uploadCallback):
+    '''Stream a file to a block blob in parallel, resumable blocks.
+
+    The file is never loaded as a whole: each worker reads its own block with a
+    seek and a bounded read. The ids of the uploaded blocks are appended to a
+    state file (a JSON header line, then one block index per line), so an
+    interrupted upload to the same blob only sends the missing blocks (the
+    uncommitted blocks kept by Azure are checked before skipping).
+
+    Args:
+        block_blob_service (BlockBlobService): The blob service (SAS or key).
+        container_name (str): Storage container name.
+        blob_name (str): Blob name.
+        file_path (str): Local file path.
+        block_size (int): Block size in bytes (grown if the file would need too many blocks), upload_block_size if None.
+        max_connections (int): Parallel block uploads, upload_max_connections if None.
+        content_type (str): Content type of the committed blob.
+        state_file (str): Resume state file, defaults to file_path + '.upload.json'.
+        progress_callback (callable): Called with (current, total, started).
+
+    Returns:
+        The size of the uploaded file in bytes.
+    '''
+    from azure.storage.blob import BlobBlock, BlockListType, ContentSettings
+    block_size = upload_block_size if block_size is None else block_size
+    max_connections = upload_max_connections if max_connections is None else max_connections
+    file_stat = os.stat(file_path)
+    total = file_stat.st_size
+    while total > block_size * upload_max_blocks:
+        block_size *= 2
+    block_count = max(1, (total + block_size - 1) // block_size)
+    if state_file is None:
+        state_file = file_path + '.upload.json'
+
+    # Resume: blocks already sent to this very blob from this very file version
+    state = {'container': container_name, 'blob': blob_name, 'size': total,
+             'mtime': file_stat.st_mtime, 'block_size': block_size, 'blocks': []}
+    try:
+        with open(state_file) as stateFile:
+            previous = json.loads(stateFile.readline())
+            blocks = list(previous.get('blocks', []))
+            for line in stateFile:
+                # a line cut short by a crash is not a recorded block
+                if line.endswith('\n'):
+                    blocks.append(int(line))
+        if all(previous.get(key) == state[key] for key in ('container', 'blob', 'size', 'mtime', 'block_size')):
+            block_list = block_blob_service.get_block_list(container_name, blob_name, block_list_type=BlockListType.Uncommitted)
+            uncommitted = set(block.id for block in block_list.uncommitted_blocks)
+            state['blocks'] = sorted(set(index for index in blocks if block_id(index) in uncommitted))
+    except Exception:
+        pass
+    done = set(state['blocks'])
+    if done:
+        print("Resuming Upload.........................: " + str(len(done)) + "/" + str(block_count) + " blocks already uploaded")
+
+    lock = threading.Lock()
+    progress = {'current': sum(min(block_size, total - index * block_size) for index in done)}
+    started = time.time()
+
+    # header and the blocks kept, written once; each uploaded block then appends its line
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as stateFile:
+        stateFile.write(json.dumps(dict((key, value) for key, value in state.items() if key != 'blocks')) + '\n')
+        stateFile.write(''.join(str(index) + '\n' for index in state['blocks']))
+    os.replace(tmp_file, state_file)
+    stateFile = open(state_file, 'a')
+
+    def put_block(index):
+        with open(file_path, mode='rb') as file:
+            file.seek(index * block_size)
+            data = file.read(block_size)
+        block_started = time.time()
+        block_blob_service.put_block(container_name, blob_name, data, block_id(index))
+        ams_metrics.record_blob('put_block', time.time() - block_started, len(data))
+        with lock:
+            state['blocks'].append(index)
+            progress['current'] += len(data)
+            stateFile.write(str(index) + '\n')
+            stateFile.flush()
+            if progress_callback is not None:
+                progress_callback(progress['current'], total, started)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_connections) as executor:
+            for future in [executor.submit(put_block, index) for index in range(block_count) if index not in done]:
+                future.result()
+    finally:
+        stateFile.close()
+
+    block_started = time.time()
+    block_blob_service.put_block_list(container_name, blob_name, [BlobBlock(id=block_id(index)) for index in range(block_count)],
+                                      content_settings=ContentSettings(content_type=content_type))
+    ams_metrics.record_blob('put_block_list', time.time() - block_started)
+    try:
+        os.remove(state_file)
+    except OSError:
+        pass
+    return total
         
 def translate_job_state(code):
     '''AUX Function to translate the (numeric) state of a Job.
@@ -71,8 +826,8 @@ def translate_job_state(code):
 
     return code_description
 
-def get_url(access_token, endpoint=ams_rest_endpoint, flag=True):
-    return do_ams_get_url(endpoint, access_token, flag)
+def get_url(access_token, endpoint=None, flag=True):
+    return do_ams_get_url(endpoint if endpoint is not None else ams_rest_endpoint, access_token, flag)
 
 def do_ams_get_url(endpoint, access_token, flag=True):
     '''Do an AMS GET request to retrieve the Final AMS Endpoint and return JSON.
@@ -84,21 +839,13 @@ def do_ams_get_url(endpoint, access_token, flag=True):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Content-Type": json_acceptformat,
-               "Accept": json_acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": "Bearer " + access_token,
-               "x-ms-version" : xmsversion}
-    body = ''
-    response = requests.get(endpoint, headers=headers, allow_redirects=flag)
-    if flag:
-        if response.status_code == 301:
-            response = requests.get(response.headers['location'], data=body, headers=headers)
-    return response
+    return get_ams_client(access_token).get_url(endpoint, flag)
 
 def get_access_token(tenant_id, application_id, application_secret):
     '''get an Azure access token using the adal library.
 
+    The token is cached (and refreshed before expiry) by the shared AccessTokenProvider.
+
     Args:
         tenant_id (str): Tenant id of the user's account.
         application_id (str): Application id of a Service Principal account.
@@ -107,18 +854,19 @@ def get_access_token(tenant_id, application_id, application_secret):
     Returns:
         An Azure authentication token string.
     '''
-    context = adal.AuthenticationContext(ams_auth_endpoint + tenant_id, api_version=None)
-    token_response = context.acquire_token_with_client_credentials(AZURE_RESOURCE_ENDPOINT, application_id, application_secret)
-    return token_response.get('accessToken')
+    return get_token_provider(tenant_id, application_id, application_secret).get_token()
 
 def get_access_token_with_rest_end(tenant_id, application_id, account_key):
-    # Get the access token...
+    # Get the access token, shared (and kept fresh) for every do_ams_* call...
     access_token = get_access_token(tenant_id, application_id, account_key)
+    get_ams_client().token_provider = get_token_provider(tenant_id, application_id, account_key)
     
     # Get AMS redirected url
     response = get_url(access_token)
     if (response.status_code == 200):
         ams_redirected_rest_endpoint = str(response.url)
+        # Later calls go straight to the redirected endpoint
+        get_ams_client(access_token).redirected_endpoint = ams_redirected_rest_endpoint
     else:
         print("GET Status: " + str(response.status_code) + " - Getting Redirected URL ERROR." + str(response.content))
         exit(1)
@@ -137,25 +885,7 @@ def do_ams_post(endpoint, path, body, access_token, rformat="json"):
     Returns:
         HTTP response. JSON body.
     '''
-    content_acceptformat = json_acceptformat
-    acceptformat = json_acceptformat
-    if rformat == "json_only":
-        content_acceptformat = json_only_acceptformat
-    if rformat == "xml":
-        content_acceptformat = xml_acceptformat
-        acceptformat = xml_acceptformat + ",application/xml"
-    headers = {"Content-Type": content_acceptformat,
-               "Accept": acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": "Bearer " + access_token,
-               "x-ms-version" : xmsversion}
-    response = requests.post(endpoint, data=body, headers=headers, allow_redirects=False)
-    # AMS response to the first call can be a redirect,
-    # so we handle it here to make it transparent for the caller...
-    if response.status_code == 301:
-        redirected_url = ''.join([response.headers['location'], path])
-        response = requests.post(redirected_url, data=body, headers=headers)
-    return response
+    return get_ams_client(access_token).request("POST", endpoint, path, body, rformat)
 
 def do_ams_patch(endpoint, path, body, access_token):
     '''Do a AMS PATCH request and return JSON.
@@ -168,18 +898,7 @@ def do_ams_patch(endpoint, path, body, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Content-Type": json_acceptformat,
-               "Accept": json_acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": "Bearer " + access_token,
-               "x-ms-version" : xmsversion}
-    response = requests.patch(endpoint, data=body, headers=headers, allow_redirects=False)
-    # AMS response to the first call can be a redirect,
-    # so we handle it here to make it transparent for the caller...
-    if response.status_code == 301:
-        redirected_url = ''.join([response.headers['location'], path])
-        response = requests.patch(redirected_url, data=body, headers=headers)
-    return response
+    return get_ams_client(access_token).request("PATCH", endpoint, path, body)
 
 def do_ams_delete(endpoint, path, access_token):
     '''Do a AMS DELETE request and return JSON.
@@ -191,17 +910,7 @@ def do_ams_delete(endpoint, path, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Accept": json_acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": 'Bearer ' + access_token,
-               "x-ms-version" : xmsversion}
-    response = requests.delete(endpoint, headers=headers, allow_redirects=False)
-    # AMS response to the first call can be a redirect,
-    # so we handle it here to make it transparent for the caller...
-    if response.status_code == 301:
-        redirected_url = ''.join([response.headers['location'], path])
-        response = requests.delete(redirected_url, headers=headers)
-    return response
+    return get_ams_client(access_token).request("DELETE", endpoint, path, content_type=False)
 
 def do_ams_get(endpoint, path, access_token):
     '''Do a AMS HTTP GET request and return JSON.
@@ -213,19 +922,7 @@ def do_ams_get(endpoint, path, access_token):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Content-Type": json_acceptformat,
-               "Accept": json_acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": "Bearer " + access_token,
-               "x-ms-version" : xmsversion}
-    body = ''
-    response = requests.get(endpoint, headers=headers, allow_redirects=False)
-    # AMS response to the first call can be a redirect,
-    # so we handle it here to make it transparent for the caller...
-    if response.status_code == 301:
-        redirected_url = ''.join([response.headers['location'], path])
-        response = requests.get(redirected_url, data=body, headers=headers)
-    return response
+    return get_ams_client(access_token).request("GET", endpoint, path)
 
 def do_ams_get_url(endpoint, access_token, flag=True):
     '''Do an AMS GET request to retrieve the Final AMS Endpoint and return JSON.
@@ -237,29 +934,59 @@ def do_ams_get_url(endpoint, access_token, flag=True):
     Returns:
         HTTP response. JSON body.
     '''
-    headers = {"Content-Type": json_acceptformat,
-               "Accept": json_acceptformat,
-               "Accept-Charset" : charset,
-               "Authorization": "Bearer " + access_token,
-               "x-ms-version" : xmsversion}
-    body = ''
-    response = requests.get(endpoint, headers=headers, allow_redirects=flag)
-    if flag:
-        if response.status_code == 301:
-            response = requests.get(response.headers['location'], data=body, headers=headers)
-    return response
+    return get_ams_client(access_token).get_url(endpoint, flag)
 
-def get_url(access_token, endpoint=ams_rest_endpoint, flag=True):
+def get_url(access_token, endpoint=None, flag=True):
     '''Get Media Services Final Endpoint URL.
     Args:
         access_token (str): A valid Azure authentication token.
-        endpoint (str): Azure Media Services Initial Endpoint.
+        endpoint (str): Azure Media Services Initial Endpoint, ams_rest_endpoint if None.
         flag (bol): flag.
 
     Returns:
         HTTP response. JSON body.
     '''
-    return do_ams_get_url(endpoint, access_token, flag)
+    return do_ams_get_url(endpoint if endpoint is not None else ams_rest_endpoint, access_token, flag)
+
+def do_ams_request(request, access_token):
+    '''Do an AMS request built by ams_odata and return JSON.
+    Args:
+        request (ams_odata.AMSRequest): Method, path and body of the request.
+        access_token (str): A valid Azure authentication token.
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    endpoint = ''.join([ams_rest_endpoint, request.path])
+    return get_ams_client(access_token).request(request.method, endpoint, request.path, request.data(), content_type=request.content_type)
+
+def do_ams_batch(batch, access_token):
+    '''Do an OData $batch request (the operations of an ams_odata.ODataBatch in one round-trip).
+    Args:
+        batch (ams_odata.ODataBatch): The operations, grouped in change sets.
+        access_token (str): A valid Azure authentication token.
+
+    Returns:
+        The list of ams_odata.ODataResponse, one per operation, or None if the
+        service does not take $batch requests (odata_batch is then turned off).
+    '''
+    global odata_batch
+    client = get_ams_client(access_token)
+    if client.redirected_endpoint is None:
+        # the operation URLs are absolute, on the redirected endpoint
+        get_url(access_token)
+    path = '/$batch'
+    endpoint = ''.join([ams_rest_endpoint, path])
+    content_type, body = batch.payload(client.redirected_endpoint or client.endpoint, {"x-ms-version": xmsversion})
+    response = client.request("POST", endpoint, path, body, content_type=False,
+                              extra_headers={"Content-Type": content_type, "Accept": "multipart/mixed"})
+    if response.status_code in (400, 404, 405, 501):
+        print("POST Status.............................: " + str(response.status_code) + " - $batch not supported, sending the requests one by one")
+        odata_batch = False
+        return None
+    if response.status_code != 202:
+        raise IOError("POST Status: " + str(response.status_code) + " - $batch ERROR." + str(response.content))
+    return batch.parse(response.headers.get('Content-Type'), response.content)
 
 def encode_mezzanine_asset(access_token, processor_id, asset_id, output_assetname, json_profile):
     '''Get Media Service Encode Mezanine Asset.
@@ -274,15 +1001,10 @@ def encode_mezzanine_asset(access_token, processor_id, asset_id, output_assetnam
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/Jobs'
-    endpoint = ''.join([ams_rest_endpoint, path])
-    assets_path = ''.join(["/Assets", "('", asset_id, "')"])
-    assets_path_encoded = urllib.parse.quote(assets_path, safe='')
-    endpoint_assets = ''.join([ams_rest_endpoint, assets_path_encoded])
-    body = '{"Name":"' + output_assetname + '","InputMediaAssets":[{"__metadata":{"uri":"' + endpoint_assets + '"}}],"Tasks":[{"Configuration":\'' + json_profile + '\',"MediaProcessorId":"' + \
-           processor_id + '","TaskBody":"<?xml version=\\"1.0\\" encoding=\\"utf-16\\"?><taskBody><inputAsset>JobInputAsset(0)</inputAsset><outputAsset assetCreationOptions=\\"0\\" assetName=\\"' \
-           + output_assetname + '\\">JobOutputAsset(0)</outputAsset></taskBody>"}]}'
-    return do_ams_post(endpoint, path, body, access_token)
+    request = ams_odata.create_job(ams_rest_endpoint, output_assetname, [asset_id],
+                                   [{'input': 0, 'output': output_assetname, 'processor_id': processor_id, 'configuration': json_profile}],
+                                   job_notification_endpoint_id)
+    return do_ams_request(request, access_token)
 
 def create_media_asset(access_token, name, options="0"):
     '''Create Media Service Asset.
@@ -295,10 +1017,7 @@ def create_media_asset(access_token, name, options="0"):
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/Assets'
-    endpoint = ''.join([ams_rest_endpoint, path])
-    body = '{"Name": "' + name + '", "Options": "' + str(options) + '"}'
-    return do_ams_post(endpoint, path, body, access_token)
+    return do_ams_request(ams_odata.create_asset(name, options), access_token)
 
 def create_media_assetfile(access_token, parent_asset_id, name, is_primary="false", is_encrypted="false", encryption_scheme="None", encryptionkey_id="None"):
     '''Create Media Service Asset File.
@@ -315,13 +1034,8 @@ def create_media_assetfile(access_token, parent_asset_id, name, is_primary="fals
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/Files'
-    endpoint = ''.join([ams_rest_endpoint, path])
-    if encryption_scheme == "StorageEncryption":
-        body = '{             "IsEncrypted": "' + is_encrypted + '",             "EncryptionScheme": "' + encryption_scheme + '",             "EncryptionVersion": "' + "1.0" + '",             "EncryptionKeyId": "' + encryptionkey_id + '",             "IsPrimary": "' + is_primary + '",             "MimeType": "video/mp4",             "Name": "' + name + '",             "ParentAssetId": "' + parent_asset_id + '"         }'
-    else:
-        body = '{             "IsPrimary": "' + is_primary + '",             "MimeType": "video/mp4",             "Name": "' + name + '",             "ParentAssetId": "' + parent_asset_id + '"         }'
-    return do_ams_post(endpoint, path, body, access_token)
+    request = ams_odata.create_asset_file(parent_asset_id, name, is_primary, is_encrypted, encryption_scheme, encryptionkey_id)
+    return do_ams_request(request, access_token)
 
 def create_asset_accesspolicy(access_token, name, duration, permission="1"):
     '''Create Media Service Asset Access Policy.
@@ -335,10 +1049,7 @@ def create_asset_accesspolicy(access_token, name, duration, permission="1"):
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/AccessPolicies'
-    endpoint = ''.join([ams_rest_endpoint, path])
-    body = '{"Name": "' + str(name) + '", "DurationInMinutes": "' + duration + '","Permissions": "' + permission + '"     }'
-    return do_ams_post(endpoint, path, body, access_token)
+    return do_ams_request(ams_odata.create_access_policy(name, duration, permission), access_token)
 
 def create_sas_locator(access_token, asset_id, accesspolicy_id):
     '''Create Media Service SAS Locator.
@@ -351,10 +1062,7 @@ def create_sas_locator(access_token, asset_id, accesspolicy_id):
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/Locators'
-    endpoint = ''.join([ams_rest_endpoint, path])
-    body = '{         "AccessPolicyId":"' + accesspolicy_id + '",         "AssetId":"' + asset_id + '",         "Type":1     }'
-    return do_ams_post(endpoint, path, body, access_token)
+    return do_ams_request(ams_odata.create_locator(asset_id, accesspolicy_id), access_token)
 
 def update_media_assetfile(access_token, parent_asset_id, asset_id, content_length, name):
     '''Update Media Service Asset File.
@@ -369,12 +1077,7 @@ def update_media_assetfile(access_token, parent_asset_id, asset_id, content_leng
     Returns:
         HTTP response. JSON body.
     '''
-    path = '/Files'
-    full_path = ''.join([path, "('", asset_id, "')"])
-    full_path_encoded = urllib.parse.quote(full_path, safe='')
-    endpoint = ''.join([ams_rest_endpoint, full_path_encoded])
-    body = '{         "ContentFileSize": "' + str(content_length) + '",         "Id": "' + asset_id + '",         "MimeType": "video/mp4",         "Name": "' + name + '",         "ParentAssetId": "' + parent_asset_id + '"     }'
-    return do_ams_patch(endpoint, full_path_encoded, body, access_token)
+    return do_ams_request(ams_odata.update_asset_file(parent_asset_id, asset_id, content_length, name), access_token)
 
 def delete_sas_locator(access_token, oid):
     '''Delete Media Service SAS Locator.
@@ -389,6 +1092,20 @@ def delete_sas_locator(access_token, oid):
     path = '/Locators'
     return helper_delete(access_token, oid, path)
 
+def list_asset_accesspolicy(access_token, oid="", query=None):
+    '''List Media Service Asset Access Policy(ies).
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        oid (str): Media Service Asset Access Policy OID.
+        query (dict): Optional OData query options.
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    path = '/AccessPolicies'
+    return helper_list(access_token, oid, path, query)
+
 def delete_asset_accesspolicy(access_token, oid):
     '''Delete Media Service Asset Access Policy.
 
@@ -405,6 +1122,8 @@ def delete_asset_accesspolicy(access_token, oid):
 def list_media_job(access_token, oid=""):
     '''List Media Service Job(s).
 
+    Without an OID only the first page is returned, iter_media_jobs() goes through the whole listing.
+
     Args:
         access_token (str): A valid Azure authentication token.
         oid (str): Media Service Job OID.
@@ -415,35 +1134,174 @@ def list_media_job(access_token, oid=""):
     path = '/Jobs'
     return helper_list(access_token, oid, path)
 
-def list_media_processor(access_token, oid=""):
+def list_media_jobs(access_token, job_ids):
+    '''List several Media Service Jobs with a single OData $filter query.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job_ids (list): Media Service Job OIDs.
+
+    Returns:
+        HTTP response. JSON body.
+    '''
+    path = '/Jobs'
+    job_filter = ' or '.join(["Id eq '" + job_id + "'" for job_id in job_ids])
+    return helper_list(access_token, "", path, {"$filter": job_filter})
+
+def list_media_processor(access_token, oid="", query=None):
     '''List Media Service Processor(s).
 
+    Without an OID only the first page is returned, iter_media_processors() goes through the whole listing.
+
     Args:
         access_token (str): A valid Azure authentication token.
         oid (str): Media Service Processor OID.
+        query (dict): Optional OData query options.
 
     Returns:
         HTTP response. JSON body.
     '''
     path = '/MediaProcessors'
-    return helper_list(access_token, oid, path)
+    return helper_list(access_token, oid, path, query)
 
-def helper_list(access_token, oid, path):
+def helper_list(access_token, oid, path, query=None):
     '''Helper Function to list a URL path.
 
     Args:
         access_token (str): A valid Azure authentication token.
         oid (str): An OID.
         path (str): A URL Path.
+        query (dict): Optional OData query options, e.g. {"$filter": "Name eq 'x'"}.
 
     Returns:
         HTTP response. JSON body.
     '''
     if oid != "":
         path = ''.join([path, "('", oid, "')"])
+    if query:
+        path = ''.join([path, "?", urllib.parse.urlencode(query, quote_via=urllib.parse.quote, safe="$',:()")])
     endpoint = ''.join([ams_rest_endpoint, path])
     return do_ams_get(endpoint, path, access_token)
 
+def helper_page(access_token, path, query, next_url=None):
+    '''Get one page of a listing.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        path (str): A URL Path, e.g. '/Assets'.
+        query (dict): OData query options of the page.
+        next_url (str): Continuation link of the previous page, followed instead of `query` if given.
+
+    Returns:
+        (list of entities, next page URL or None)
+    '''
+    if next_url:
+        response = get_ams_client(access_token).request("GET", next_url, urllib.parse.urlsplit(next_url).path)
+    else:
+        response = helper_list(access_token, "", path, query)
+    if (response.status_code != 200):
+        raise IOError("GET Status: " + str(response.status_code) + " - " + path + " Listing ERROR." + str(response.content))
+    return ams_odata.parse_page(response.json())
+
+def helper_iter(access_token, path, query=None, page_size=None, prefetch=None, limit=None):
+    '''Iterate over the entities of a listing, page by page.
+
+    The pages are requested with $top/$skip (or the continuation link when the
+    service returns one), so the whole listing is never held in memory. With
+    `prefetch`, the next page is fetched in the background while the current
+    one is consumed. $skip paging is only stable if the listing does not change:
+    give an $orderby (e.g. 'Created'), and collect the ids first before deleting
+    the entities found.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        path (str): A URL Path, e.g. '/Assets'.
+        query (dict): OData query options ($filter, $select, $orderby, see ams_odata.list_query).
+        page_size (int): Entities per page, list_page_size by default.
+        prefetch (bool): Fetch the next page ahead, list_prefetch by default.
+        limit (int): Entities yielded at most, None for all.
+
+    Yields:
+        The entities (dicts, projected by $select).
+    '''
+    query = dict(query or {})
+    skip = skip_start = int(query.pop("$skip", 0) or 0)
+    page_size = min(page_size or list_page_size, ams_odata.MAX_PAGE_SIZE)
+    prefetch = list_prefetch if prefetch is None else prefetch
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def fetch(skip, next_url):
+        top = page_size if limit is None else min(page_size, limit - skip + skip_start)
+        return top, helper_page(access_token, path, dict(query, **{"$top": str(top), "$skip": str(skip)}), next_url)
+
+    def start(skip, next_url):
+        if executor is None:
+            return None
+        # the page is fetched at the stage priority of the caller
+        return executor.submit(contextvars.copy_context().run, fetch, skip, next_url)
+
+    yielded = 0
+    try:
+        top, (results, next_url) = fetch(skip, None)
+        while True:
+            skip += len(results)
+            last = not results or (len(results) < top and not next_url) or (limit is not None and yielded + len(results) >= limit)
+            pending = None if last else start(skip, next_url)
+            for entity in results:
+                yield entity
+                yielded += 1
+                if limit is not None and yielded >= limit:
+                    return
+            if last:
+                return
+            top, (results, next_url) = pending.result() if pending is not None else fetch(skip, next_url)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+def iter_media_assets(access_token, filter=None, select=None, orderby=None, **options):
+    '''Iterate over the Media Service Assets (see helper_iter for the options).
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        filter (str): OData $filter, e.g. "startswith(Name, 'analysed_')".
+        select (list): Properties to return, e.g. ['Id', 'Name', 'Created'].
+        orderby (str): OData $orderby, e.g. 'Created'.
+
+    Yields:
+        Asset entities.
+    '''
+    return helper_iter(access_token, '/Assets', ams_odata.list_query(filter, select, orderby), **options)
+
+def iter_media_jobs(access_token, filter=None, select=None, orderby=None, **options):
+    '''Iterate over the Media Service Jobs (see iter_media_assets).'''
+    return helper_iter(access_token, '/Jobs', ams_odata.list_query(filter, select, orderby), **options)
+
+def iter_media_processors(access_token, filter=None, select=None, orderby=None, **options):
+    '''Iterate over the Media Service Processors (see iter_media_assets).'''
+    return helper_iter(access_token, '/MediaProcessors', ams_odata.list_query(filter, select, orderby), **options)
+
+def iter_sas_locators(access_token, filter=None, select=None, orderby=None, **options):
+    '''Iterate over the Media Service SAS Locators (see iter_media_assets).'''
+    return helper_iter(access_token, '/Locators', ams_odata.list_query(filter, select, orderby), **options)
+
+def iter_asset_accesspolicies(access_token, filter=None, select=None, orderby=None, **options):
+    '''Iterate over the Media Service Asset Access Policies (see iter_media_assets).'''
+    return helper_iter(access_token, '/AccessPolicies', ams_odata.list_query(filter, select, orderby), **options)
+
+def output_assets_uri(access_token, job):
+    '''URI of the OutputMediaAssets of a Media Job, whatever the metadata level of the job entity.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job (dict): The job entity.
+
+    Returns:
+        The absolute URI.
+    '''
+    client = get_ams_client(access_token)
+    return ams_odata.navigation_uri(job, 'OutputMediaAssets', client.redirected_endpoint or client.endpoint, 'Jobs')
+
 def helper_delete(access_token, oid, path):
     '''Helper Function to delete a Object at a URL path.
 
@@ -455,14 +1313,13 @@ def helper_delete(access_token, oid, path):
     Returns:
         HTTP response. JSON body.
     '''
-    full_path = ''.join([path, "('", oid, "')"])
-    full_path_encoded = urllib.parse.quote(full_path, safe='')
-    endpoint = ''.join([ams_rest_endpoint, full_path_encoded])
-    return do_ams_delete(endpoint, full_path_encoded, access_token)
+    return do_ams_request(ams_odata.delete_entity(path.lstrip('/'), oid), access_token)
 
 def list_media_asset(access_token, oid=""):
     '''List Media Service Asset(s).
 
+    Without an OID only the first page is returned, iter_media_assets() goes through the whole listing.
+
     Args:
         access_token (str): A valid Azure authentication token.
         oid (str): Media Service Asset OID.
@@ -473,84 +1330,278 @@ def list_media_asset(access_token, oid=""):
     path = '/Assets'
     return helper_list(access_token, oid, path)
 
-def upload_video(access_token, NAME, sto_account_name, VIDEO_PATH):
-    ### create an asset
-    print("Creating a Media Asset")
-    response = create_media_asset(access_token, NAME)
-    if (response.status_code == 201):
-        resjson = response.json()
-        asset_id = str(resjson['d']['Id'])
-        print("POST Status.............................: " + str(response.status_code))
-        print("Media Asset Name........................: " + NAME)
-        print("Media Asset Id..........................: " + asset_id)
-    else:
-        print("POST Status.............................: " + str(response.status_code) + " - Media Asset: '" + NAME + "' Creation ERROR." + str(response.content))
-        
-    ### create an assetfile
-    print("Creating a Media Assetfile (for the video file)")
-    response = create_media_assetfile(access_token, asset_id, NAME+".mp4", "false", "false")
-    if (response.status_code == 201):
-        resjson = response.json()
-        video_assetfile_id = str(resjson['d']['Id'])
-        print("POST Status.............................: " + str(response.status_code))
-        print("Media Assetfile Name....................: " + str(resjson['d']['Name']))
-        print("Media Assetfile Id......................: " + video_assetfile_id)
-        print("Media Assetfile IsPrimary...............: " + str(resjson['d']['IsPrimary']))
-    else:
-        print("POST Status: " + str(response.status_code) + " - Media Assetfile: '" + VIDEO_NAME + "' Creation ERROR." + str(response.content))
+class AccessPolicyPool(object):
+    '''Small pool of write access policies reused across uploads.
 
-    ### create an asset write access policy for uploading
-    print("Creating an Asset Write Access Policy")
-    duration = "5" #in minutes
-    response = create_asset_accesspolicy(access_token, "8k_UploadPolicy", duration, "2")
-    if (response.status_code == 201):
-        resjson = response.json()
-        write_accesspolicy_id = str(resjson['d']['Id'])
-        print("POST Status.............................: " + str(response.status_code))
-        print("Asset Access Policy Id..................: " + write_accesspolicy_id)
-        print("Asset Access Policy Duration/min........: " + str(resjson['d']['DurationInMinutes']))
-    else:
-        print("POST Status: " + str(response.status_code) + " - Asset Write Access Policy Creation ERROR." + str(response.content))
+    An access policy only sets the permissions and the duration of the locators
+    created from it, so one policy can serve any number of uploads. The pool
+    adopts the matching policies already on the account (same name, permissions
+    and duration) and creates new ones only up to `size`, keeping the account
+    well below the AMS policy quota. Settings left to None follow the module
+    settings (upload_policy_*), as ams_gc does: a change of name or duration
+    adopts the matching policies again.
 
-    ### create a sas locator
-    print("Creating a write SAS Locator")
-    response = create_sas_locator(access_token, asset_id, write_accesspolicy_id)
-    if (response.status_code == 201):
-        resjson = response.json()
-        saslocator_id = str(resjson['d']['Id'])
-        saslocator_baseuri = str(resjson['d']['BaseUri'])
-        sto_asset_name = os.path.basename(os.path.normpath(saslocator_baseuri))
-        saslocator_cac = str(resjson['d']['ContentAccessComponent'])
-        print("POST Status.............................: " + str(response.status_code))
-        print("SAS URL Locator StartTime...............: " + str(resjson['d']['StartTime']))
-        print("SAS URL Locator Id......................: " + saslocator_id)
-        print("SAS URL Locator Base URI................: " + saslocator_baseuri)
-        print("SAS URL Locator Content Access Component: " + saslocator_cac)
-    else:
-        print("POST Status: " + str(response.status_code) + " - SAS URL Locator Creation ERROR." + str(response.content))
+    Args:
+        access_token (str): A valid Azure authentication token.
+        name (str): Access Policy Name, upload_policy_name if None.
+        duration (str): Locator validity in minutes, upload_policy_duration if None.
+        permission (str): Access Policy permissions ("2" is write).
+        size (int): Number of policies to rotate through, upload_policy_pool_size if None.
+    '''
+    def __init__(self, access_token, name=None, duration=None, permission="2", size=None):
+        self.access_token = access_token
+        self._name = name
+        self._duration = duration
+        self.permission = permission
+        self._size = size
+        self.policy_ids = None
+        self._adopted = None
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return upload_policy_name if self._name is None else self._name
+
+    @property
+    def duration(self):
+        return upload_policy_duration if self._duration is None else self._duration
+
+    @property
+    def size(self):
+        return upload_policy_pool_size if self._size is None else self._size
+
+    def _adopt(self):
+        self.policy_ids = []
+        self._adopted = (self.name, self.duration)
+        response = list_asset_accesspolicy(self.access_token, query={"$filter": "Name eq '" + self.name + "'"})
+        if (response.status_code == 200):
+            for policy in ams_odata.results(response.json()):
+                if str(policy['Permissions']) == self.permission and float(policy['DurationInMinutes']) == float(self.duration):
+                    self.policy_ids.append(str(policy['Id']))
+        del self.policy_ids[self.size:]
+
+    def acquire(self):
+        '''Return the id of a write access policy (created on first use).'''
+        with self._lock:
+            if self.policy_ids is None or self._adopted != (self.name, self.duration):
+                self._adopt()
+            del self.policy_ids[self.size:]
+            if len(self.policy_ids) < self.size:
+                print("Creating an Asset Write Access Policy")
+                response = create_asset_accesspolicy(self.access_token, self.name, self.duration, self.permission)
+                if (response.status_code == 201):
+                    resjson = response.json()
+                    self.policy_ids.append(str(ams_odata.entity(resjson)['Id']))
+                    print("POST Status.............................: " + str(response.status_code))
+                    print("Asset Access Policy Id..................: " + str(ams_odata.entity(resjson)['Id']))
+                    print("Asset Access Policy Duration/min........: " + str(ams_odata.entity(resjson)['DurationInMinutes']))
+                else:
+                    print("POST Status: " + str(response.status_code) + " - Asset Write Access Policy Creation ERROR." + str(response.content))
+            if not self.policy_ids:
+                return None
+            policy_id = self.policy_ids[self._next % len(self.policy_ids)]
+            self._next += 1
+            return policy_id
+
+    def discard(self, policy_id):
+        '''Forget a policy that AMS rejected (e.g. deleted behind our back).'''
+        with self._lock:
+            if self.policy_ids and policy_id in self.policy_ids:
+                self.policy_ids.remove(policy_id)
+
+_policy_pool = None
+
+def get_upload_policy_pool(access_token):
+    '''Return the shared write AccessPolicyPool.'''
+    global _policy_pool
+    if _policy_pool is None:
+        _policy_pool = AccessPolicyPool(access_token)
+    _policy_pool.access_token = access_token
+    return _policy_pool
+
+class CleanupQueue(object):
+    '''Background deletion of locators and access policies, off the upload path.
+
+    Deletes are done by a daemon thread, the ones queued meanwhile (across
+    videos) sent together as one $batch request, each in its own change set so
+    that one failed delete does not hold back the others; flush() (also
+    registered with atexit) waits until the queue is drained.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+    '''
+    def __init__(self, access_token):
+        self.access_token = access_token
+        self.queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='ams-cleanup', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def delete_locator(self, oid):
+        '''Queue the deletion of a SAS Locator.'''
+        self.queue.put(('/Locators', oid))
+
+    def delete_accesspolicy(self, oid):
+        '''Queue the deletion of an Asset Access Policy.'''
+        self.queue.put(('/AccessPolicies', oid))
+
+    def delete_asset(self, oid):
+        '''Queue the deletion of a Media Asset (with its files and blob container).'''
+        self.queue.put(('/Assets', oid))
+
+    def flush(self):
+        '''Wait until every queued deletion is done.'''
+        self.queue.join()
+
+    def _take(self):
+        # the next queued delete, then the ones already waiting (up to a $batch)
+        items = [self.queue.get()]
+        while odata_batch and len(items) < ams_odata.BATCH_MAX_OPERATIONS:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _delete_batch(self, items):
+        # one response per item, None if $batch is not available
+        if len(items) < 2 or not odata_batch:
+            return None
+        batch = ams_odata.ODataBatch()
+        for path, oid in items:
+            batch.new_changeset()
+            batch.add(ams_odata.delete_entity(path[1:], oid))
+        return do_ams_batch(batch, self.access_token)
+
+    @ams_scheduler.prioritized('cleanup')
+    def _run(self):
+        while True:
+            items = self._take()
+            try:
+                responses = self._delete_batch(items)
+            except Exception as e:
+                print("DELETE ERROR............................: $batch " + str(e))
+                responses = None
+            for index, (path, oid) in enumerate(items):
+                try:
+                    response = responses[index] if responses is not None else helper_delete(self.access_token, oid, path)
+                    if (response.status_code == 204):
+                        print("DELETE Status...........................: " + str(response.status_code) + " - " + path[1:] + " Deleted: " + oid)
+                    else:
+                        print("DELETE Status...........................: " + str(response.status_code) + " - " + path[1:] + ": '" + oid + "' Delete ERROR." + str(response.content))
+                except Exception as e:
+                    print("DELETE ERROR............................: " + path[1:] + ": '" + oid + "' " + str(e))
+                finally:
+                    self.queue.task_done()
+
+_cleanup_queue = None
+
+def get_cleanup_queue(access_token):
+    '''Return the shared CleanupQueue.'''
+    global _cleanup_queue
+    if _cleanup_queue is None:
+        _cleanup_queue = CleanupQueue(access_token)
+    _cleanup_queue.access_token = access_token
+    return _cleanup_queue
+
+def media_asset_exists(access_token, asset_id):
+    '''Check that a Media Service Asset still exists.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        asset_id (str): Media Service Asset ID.
+
+    Returns:
+        True if the asset can be listed.
+    '''
+    return list_media_asset(access_token, asset_id).status_code == 200
+
+def create_upload_setup(access_token, NAME, VIDEO_NAME, accesspolicy_id):
+    '''Create the asset, its asset file and a write SAS locator of an upload.
+
+    The three are created as one $batch change set (the file and the locator
+    refer to the asset through $1), so the setup costs one round-trip instead
+    of three; without $batch support, they are created one by one. A failed
+    change set answers every operation with the same error, so it is retried
+    one by one to find the failing step (and drop a dead policy from the pool).
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        NAME (str): Media Service Asset Name.
+        VIDEO_NAME (str): Media Service Asset File Name.
+        accesspolicy_id (str): Write Access Policy ID of the locator.
+
+    Returns:
+        (asset, assetfile, locator) entities (the 'd' JSON objects).
+    '''
+    steps = (("Media Asset: '" + NAME + "' Creation ERROR.", None),
+             ("Media Assetfile: '" + VIDEO_NAME + "' Creation ERROR.", None),
+             ("SAS URL Locator Creation ERROR.", accesspolicy_id))
+    responses = None
+    if odata_batch:
+        batch = ams_odata.ODataBatch()
+        asset = batch.add(ams_odata.create_asset(NAME))
+        batch.add(ams_odata.create_asset_file(asset, VIDEO_NAME))
+        batch.add(ams_odata.create_locator(asset, accesspolicy_id))
+        responses = do_ams_batch(batch, access_token)
+        if responses is not None and any(response.status_code != 201 for response in responses):
+            # the change set is atomic: nothing was created
+            print("POST Status.............................: " + str(responses[0].status_code) + " - Upload Setup Change Set ERROR, retrying one by one")
+            responses = None
+    entities = []
+    for index, (error, policy_id) in enumerate(steps):
+        if responses is not None:
+            response = responses[index]
+        elif index == 0:
+            response = create_media_asset(access_token, NAME)
+        elif index == 1:
+            response = create_media_assetfile(access_token, entities[0]['Id'], VIDEO_NAME, "false", "false")
+        else:
+            response = create_sas_locator(access_token, entities[0]['Id'], accesspolicy_id)
+        if (response.status_code != 201):
+            if policy_id is not None and response.status_code in (400, 404):
+                get_upload_policy_pool(access_token).discard(policy_id)
+            raise IOError("POST Status: " + str(response.status_code) + " - " + error + str(response.content))
+        entities.append(ams_odata.entity(response.json()))
+    return tuple(entities)
+
+@ams_metrics.timed_stage('upload')
+@ams_scheduler.prioritized('upload')
+def upload_video(access_token, NAME, sto_account_name, VIDEO_PATH):
+    ### get a (shared, reused) asset write access policy for uploading
+    policy_pool = get_upload_policy_pool(access_token)
+    write_accesspolicy_id = policy_pool.acquire()
+    print("Asset Access Policy Id..................: " + str(write_accesspolicy_id))
+
+    ### create an asset, an assetfile (for the video file) and a write sas locator
+    print("Creating a Media Asset, Assetfile and write SAS Locator")
+    VIDEO_NAME = NAME+".mp4"
+    asset, assetfile, locator = create_upload_setup(access_token, NAME, VIDEO_NAME, write_accesspolicy_id)
+    asset_id = str(asset['Id'])
+    print("Media Asset Name........................: " + NAME)
+    print("Media Asset Id..........................: " + asset_id)
+    video_assetfile_id = str(assetfile['Id'])
+    print("Media Assetfile Name....................: " + str(assetfile['Name']))
+    print("Media Assetfile Id......................: " + video_assetfile_id)
+    print("Media Assetfile IsPrimary...............: " + str(assetfile['IsPrimary']))
+    saslocator_id = str(locator['Id'])
+    saslocator_baseuri = str(locator['BaseUri'])
+    sto_asset_name = os.path.basename(os.path.normpath(saslocator_baseuri))
+    saslocator_cac = str(locator['ContentAccessComponent'])
+    print("SAS URL Locator StartTime...............: " + str(locator['StartTime']))
+    print("SAS URL Locator Id......................: " + saslocator_id)
+    print("SAS URL Locator Base URI................: " + saslocator_baseuri)
+    print("SAS URL Locator Content Access Component: " + saslocator_cac)
 
     ### Use the Azure Blob Blob Servic library from the Azure Storage SDK.
-    block_blob_service = BlockBlobService(account_name=sto_account_name, sas_token=saslocator_cac[1:])
+    block_blob_service = get_blob_service(sto_account_name, sas_token=saslocator_cac[1:])
     
     ### Start upload the video file
     print("Uploading the Video File")
-    VIDEO_NAME = NAME+".mp4"
-    with open(VIDEO_PATH, mode='rb') as file:
-        video_content = file.read()
-        video_content_length = len(video_content)
-        
-    response = block_blob_service.create_blob_from_path(
-        sto_asset_name,
-        VIDEO_NAME,
-        VIDEO_PATH,
-        max_connections=5,
-        content_settings=ContentSettings(content_type='video/mp4'),
-        progress_callback=uploadCallback,
-    )
-    
-    if (response == None):
-        print("PUT Status..............................: 201")
-        print("Video File Uploaded.....................: OK")
+    video_content_length = upload_file_blocks(block_blob_service, sto_asset_name, VIDEO_NAME, VIDEO_PATH)
+    print("PUT Status..............................: 201")
+    print("Video File Uploaded.....................: OK")
         
     ### update the assetfile metadata after uploading
     print("Updating the Video Assetfile")
@@ -559,44 +1610,99 @@ def upload_video(access_token, NAME, sto_account_name, VIDEO_PATH):
         print("MERGE Status............................: " + str(response.status_code))
         print("Assetfile Content Length Updated........: " + str(video_content_length))
     else:
-        print("MERGE Status............................: " + str(response.status_code) + " - Assetfile: '" + VIDEO_NAME + "' Update ERROR." + str(response.content))
+        get_cleanup_queue(access_token).delete_locator(saslocator_id)
+        raise IOError("MERGE Status: " + str(response.status_code) + " - Assetfile: '" + VIDEO_NAME + "' Update ERROR." + str(response.content))
     
-    ### delete the locator, so that it can't be used again
-    print("Deleting the Locator")
-    response = delete_sas_locator(access_token, saslocator_id)
-    if (response.status_code == 204):
-        print("DELETE Status...........................: " + str(response.status_code))
-        print("SAS URL Locator Deleted.................: " + saslocator_id)
-    else:
-        print("DELETE Status...........................: " + str(response.status_code) + " - SAS URL Locator: '" + saslocator_id + "' Delete ERROR." + str(response.content))
-
-    ### delete the asset access policy
-    print("Deleting the Acess Policy")
-    response = delete_asset_accesspolicy(access_token, write_accesspolicy_id)
-    if (response.status_code == 204):
-        print("DELETE Status...........................: " + str(response.status_code))
-        print("Asset Access Policy Deleted.............: " + write_accesspolicy_id)
-    else:
-        print("DELETE Status...........................: " + str(response.status_code) + " - Asset Access Policy: '" + write_accesspolicy_id + "' Delete ERROR." + str(response.content))
+    ### delete the locator, so that it can't be used again (in the background, off the upload path)
+    get_cleanup_queue(access_token).delete_locator(saslocator_id)
 
     ### get the media processor for Face Detecion
-    print("Getting the Media Processor for Face Detection")
-    response = list_media_processor(access_token)
-    if (response.status_code == 200):
-        resjson = response.json()
-        print("GET Status..............................: " + str(response.status_code))
-        for mp in resjson['d']['results']:
-            if(str(mp['Name']) == PROCESSOR_NAME):
-                processor_id = str(mp['Id'])
-                print("MEDIA Processor Id......................: " + processor_id)
-                print("MEDIA Processor Name....................: " + PROCESSOR_NAME)
-    else:
-        print("GET Status: " + str(response.status_code) + " - Media Processors Listing ERROR." + str(response.content))
+    processor_id = get_media_processor_id(access_token)
         
     return processor_id, asset_id
 
-def get_face_track_emotion(access_token, processor_id, asset_id, sto_account_name, sto_accountKey, ASSET_FINAL_NAME):
-    
+def get_media_processor_id(access_token):
+    '''Get the Id of the Face Detection Media Processor (PROCESSOR_NAME).
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+
+    Returns:
+        The Media Processor Id.
+    '''
+    print("Getting the Media Processor for Face Detection")
+    processor_id = resolve_media_processor(access_token, PROCESSOR_NAME)
+    if processor_id is not None:
+        print("MEDIA Processor Id......................: " + processor_id)
+        print("MEDIA Processor Name....................: " + PROCESSOR_NAME)
+    return processor_id
+
+def processor_version(mp):
+    '''AUX Function to get a sortable version of a Media Processor entity.'''
+    try:
+        return tuple(int(part) for part in str(mp.get('Version', '')).split('.'))
+    except ValueError:
+        return ()
+
+_processor_cache = {}
+_processor_cache_lock = threading.Lock()
+
+def resolve_media_processor(access_token, name=None, ttl=None, cache_file=None):
+    '''Resolve a Media Processor name to the Id of its latest version.
+
+    Queries /MediaProcessors with a server-side $filter on the name, and caches
+    the Id per AMS account, in memory and in `cache_file`, for `ttl` seconds.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        name (str): Media Processor Name, PROCESSOR_NAME if None.
+        ttl (float): Seconds a resolved Id stays valid, processor_cache_ttl if None.
+        cache_file (str): JSON file shared between runs, PROCESSOR_CACHE_FILE if None (itself None for memory only).
+
+    Returns:
+        The Media Processor Id, or None if it could not be resolved.
+    '''
+    name = PROCESSOR_NAME if name is None else name
+    ttl = processor_cache_ttl if ttl is None else ttl
+    cache_file = PROCESSOR_CACHE_FILE if cache_file is None else cache_file
+    client = get_ams_client(access_token)
+    key = (client.redirected_endpoint or client.endpoint) + '|' + name
+    with _processor_cache_lock:
+        if not _processor_cache and cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as cacheFile:
+                    _processor_cache.update(json.load(cacheFile))
+            except ValueError:
+                pass
+        cached = _processor_cache.get(key)
+        if cached is not None and time.time() - cached['resolved'] < ttl:
+            return cached['id']
+
+        # still holding the lock: concurrent workers wait for this one lookup
+        response = list_media_processor(access_token, query={"$filter": "Name eq '" + name.replace("'", "''") + "'"})
+        if (response.status_code != 200):
+            print("GET Status: " + str(response.status_code) + " - Media Processors Listing ERROR." + str(response.content))
+            return None
+        print("GET Status..............................: " + str(response.status_code))
+        processors = [mp for mp in ams_odata.results(response.json()) if str(mp['Name']) == name]
+        if not processors:
+            return None
+        processor_id = str(max(processors, key=processor_version)['Id'])
+        _processor_cache[key] = {'id': processor_id, 'resolved': time.time()}
+        if cache_file is not None:
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file, 'w') as cacheFile:
+                json.dump(_processor_cache, cacheFile)
+            os.replace(tmp_file, cache_file)
+        return processor_id
+
+@ams_scheduler.prioritized('submit')
+def submit_face_track_job(access_token, processor_id, asset_id, ASSET_FINAL_NAME):
+    '''Submit the Face Detector Job for an uploaded asset.
+
+    Returns:
+        The Media Job Id, or None if the Job could not be created.
+    '''
     #input request parameters
     with open(REQUEST_BODY, mode='r') as file:
             configuration_emotion = file.read()    
@@ -605,38 +1711,39 @@ def get_face_track_emotion(access_token, processor_id, asset_id, sto_account_nam
     #print(response.json()," in track")
     if (response.status_code == 201):
         resjson = response.json()
-        job_id = str(resjson['d']['Id'])
+        job_id = str(ams_odata.entity(resjson)['Id'])
         print("POST Status.............................: " + str(response.status_code))
         print("Media Job Id............................: " + job_id)
-    else:
-        print("POST Status.............................: " + str(response.status_code) + " - Media Job Creation ERROR." + str(response.content))
+        return job_id
+    print("POST Status.............................: " + str(response.status_code) + " - Media Job Creation ERROR." + str(response.content))
+    return None
+
+@ams_metrics.timed_stage('download')
+@ams_scheduler.prioritized('download')
+def download_job_output(access_token, job, sto_account_name, sto_accountKey, include=None, exclude=None):
+    '''Download the output asset of a finished Media Job into OUTPUT_FOLDER.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job (dict): The job entity (the 'd' JSON object).
+        sto_account_name (str): Storage account name.
+        sto_accountKey (str): Storage account key.
+        include (list): fnmatch patterns of the output blobs to fetch, download_include if None.
+        exclude (list): fnmatch patterns of the output blobs to skip, download_exclude if None.
+
+    Returns:
+        The list of downloaded file paths.
+    '''
+    job_id = str(job['Id'])
+    print("Media Job Status........................: " + translate_job_state(str(job['State'])))
+    joboutputassets_uri = output_assets_uri(access_token, job)
 
-    ### list a media job
-    print("Getting the Media Job Status")
-    flag = 1
-    while(flag):
-        try:
-            response = list_media_job(access_token, job_id)
-            if (response.status_code == 200):
-                resjson = response.json()
-                job_state = str(resjson['d']['State'])
-                if (resjson['d']['EndTime'] != None):
-                    joboutputassets_uri = resjson['d']['OutputMediaAssets']['__deferred']['uri']
-                    flag = 0
-                print("GET Status..............................: " + str(response.status_code))
-                print("Media Job Status........................: " + translate_job_state(job_state))
-        except:
-            print("GET Status..............................: " + str(response.status_code) + " - Media Job: '" + asset_id + "' Listing ERROR." + str(response.content))
-            time.sleep(180)
-            continue
-        time.sleep(180)
-        
     ## getting the output Asset id
     print("Getting the Indexed Media Asset Id")
     response = get_url(access_token, joboutputassets_uri, False)
     if (response.status_code == 200):
         resjson = response.json()
-        face_asset_id = resjson['d']['results'][0]['Id']
+        face_asset_id = ams_odata.results(resjson)[0]['Id']
         print("GET Status..............................: " + str(response.status_code))
         print("Indexed Media Asset Id..................: " + face_asset_id)
     else:
@@ -647,32 +1754,436 @@ def get_face_track_emotion(access_token, processor_id, asset_id, sto_account_nam
     if (response.status_code == 200):
         resjson = response.json()
         # Get the container name from the Uri
-        outputAssetContainer = resjson['d']['Uri'].split('/')[3]
+        outputAssetContainer = ams_odata.entity(resjson)['Uri'].split('/')[3]
         print(outputAssetContainer)
 
-    ### Use the Azure Blob Blob Service library from the Azure Storage SDK to download just the output JSON file
-    block_blob_service = BlockBlobService(account_name=sto_account_name,account_key=sto_accountKey)
-    generator = block_blob_service.list_blobs(outputAssetContainer)
-    for blob in generator:
+    ### Use the Azure Blob Blob Service library from the Azure Storage SDK to download the output files (once each, in parallel)
+    block_blob_service = get_blob_service(sto_account_name, account_key=sto_accountKey)
+    print("\n\n##### Output Results ######")
+    return download_container(block_blob_service, outputAssetContainer, OUTPUT_FOLDER, include, exclude)
+
+def blob_selected(blob_name, include=None, exclude=None):
+    '''AUX Function to match a blob name against include/exclude fnmatch patterns.'''
+    if include and not any(fnmatch.fnmatch(blob_name, pattern) for pattern in include):
+        return False
+    if exclude and any(fnmatch.fnmatch(blob_name, pattern) for pattern in exclude):
+        return False
+    return True
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def load_download_manifest(manifest_path):
+    '''Return the shared in-memory ETag manifest of a path (read from disk on first use).'''
+    with _manifests_lock:
+        manifest = _manifests.get(manifest_path)
+        if manifest is None:
+            try:
+                with open(manifest_path) as manifestFile:
+                    manifest = json.load(manifestFile)
+            except (IOError, ValueError):
+                manifest = {}
+            _manifests[manifest_path] = manifest
+        return manifest
+
+def save_download_manifest(manifest_path, entries):
+    '''Merge ETag entries into a manifest and write it atomically.
+
+    Concurrent downloads into the same folder share one manifest: the entries
+    are merged under a lock (with what another process may have written
+    meanwhile) and written through a unique temporary file.
+
+    Args:
+        manifest_path (str): Path of the manifest.
+        entries (dict): Local file path -> ETag.
+    '''
+    manifest = load_download_manifest(manifest_path)
+    with _manifests_lock:
+        try:
+            with open(manifest_path) as manifestFile:
+                manifest.update(json.load(manifestFile))
+        except (IOError, ValueError):
+            pass
+        manifest.update(entries)
+        fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(manifest_path) + '.', suffix='.tmp', dir=os.path.dirname(manifest_path) or '.')
+        try:
+            with os.fdopen(fd, 'w') as manifestFile:
+                json.dump(manifest, manifestFile)
+            os.replace(tmp_file, manifest_path)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+
+def download_container(block_blob_service, container_name, output_folder=None, include=None, exclude=None, max_connections=None):
+    '''Download the blobs of a container concurrently, each exactly once.
+
+    The container is listed once. Every selected blob is streamed to a temporary
+    file and renamed into place, so a local file is always complete. Blobs whose
+    local copy has the same ETag (recorded in DOWNLOAD_MANIFEST) or, without a
+    recorded ETag, the same size are skipped.
+
+    Args:
+        block_blob_service (BlockBlobService): The blob service.
+        container_name (str): Storage container name.
+        output_folder (str): Prefix of the local file paths, OUTPUT_FOLDER if None.
+        include (list): fnmatch patterns of the blobs to fetch, download_include if None.
+        exclude (list): fnmatch patterns of the blobs to skip, download_exclude if None.
+        max_connections (int): Concurrent blob downloads, download_max_connections if None.
+
+    Returns:
+        The list of local file paths, downloaded or already up to date.
+    '''
+    # the module settings are read at call time, so they can be changed after import
+    output_folder = OUTPUT_FOLDER if output_folder is None else output_folder
+    include = download_include if include is None else include
+    exclude = download_exclude if exclude is None else exclude
+    max_connections = download_max_connections if max_connections is None else max_connections
+    manifest_path = output_folder + DOWNLOAD_MANIFEST
+    manifest = load_download_manifest(manifest_path)
+    downloaded = {}
+    lock = threading.Lock()
+
+    def fetch(blob):
+        file_path = output_folder + blob.name + '.json'
+        etag = blob.properties.etag
+        if os.path.exists(file_path):
+            with _manifests_lock:
+                known_etag = manifest.get(file_path)
+            if (known_etag == etag) if known_etag is not None else (os.path.getsize(file_path) == blob.properties.content_length):
+                print("Up To Date..............................: " + blob.name)
+                ams_metrics.get_registry().inc('ams_blob_skipped_total')
+                return file_path
+        parent = os.path.dirname(file_path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        tmp_file = file_path + '.part'
+        blob_started = time.time()
+        block_blob_service.get_blob_to_path(container_name, blob.name, tmp_file)
+        ams_metrics.record_blob('get_blob', time.time() - blob_started, os.path.getsize(tmp_file))
+        os.replace(tmp_file, file_path)
+        with lock:
+            downloaded[file_path] = etag
         print(blob.name)
         if (blob.name.endswith(".json")):
-            print("\n\n##### Output Results ######")
-            blobText = block_blob_service.get_blob_to_text(outputAssetContainer, blob.name)
-            #print(blobText.content)
             print('Results saved as JSON')
-            block_blob_service.get_blob_to_path(outputAssetContainer, blob.name,  OUTPUT_FOLDER + blob.name+'.json')
-        else:
-            block_blob_service.get_blob_to_path(outputAssetContainer, blob.name, OUTPUT_FOLDER + blob.name+'.json')
+        return file_path
 
+    list_started = time.time()
+    blobs = [blob for blob in block_blob_service.list_blobs(container_name) if blob_selected(blob.name, include, exclude)]
+    ams_metrics.record_blob('list_blobs', time.time() - list_started)
+    with ThreadPoolExecutor(max_workers=max_connections) as executor:
+        result_paths = list(executor.map(fetch, blobs))
+    if downloaded:
+        save_download_manifest(manifest_path, downloaded)
+    return result_paths
 
-def main():    
-    # Load Azure app defaults
+def get_face_track_emotion(access_token, processor_id, asset_id, sto_account_name, sto_accountKey, ASSET_FINAL_NAME):
+    job_id = submit_face_track_job(access_token, processor_id, asset_id, ASSET_FINAL_NAME)
+    if job_id is None:
+        return None, []
+
+    ### wait for the media job (shared, adaptive status polling)
+    print("Getting the Media Job Status")
+    job = wait_for_job(access_token, job_id)
+
+    result_paths = download_job_output(access_token, job, sto_account_name, sto_accountKey)
+    return job_id, result_paths
+
+class MultiTaskJob(object):
+    '''Builder of a Media Job with many input assets and tasks.
+
+    Each task reads one JobInputAsset(n) and writes its own JobOutputAsset(n),
+    with its own processor and configuration, so many short clips share the
+    scheduling, the status polling and the output resolution of a single job.
+    The output asset names are kept to map the outputs back to their sources.
+
+    Usage:
+        job = MultiTaskJob('analysed_batch', processor_id, configuration_emotion)
+        for video_path, asset_id in assets:
+            job.add_task(asset_id, 'analysed_' + os.path.basename(video_path), video_path)
+        job_id = job.submit(access_token)
+
+    Args:
+        name (str): Media Job name.
+        processor_id (str): Default Media Processor Id of the tasks.
+        configuration (str): Default task configuration (e.g. the emotion.json preset).
+    '''
+    def __init__(self, name, processor_id=None, configuration=None):
+        self.name = name
+        self.processor_id = processor_id
+        self.configuration = configuration
+        self.inputs = []
+        self.tasks = []
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def is_full(self, max_tasks=job_max_tasks):
+        return len(self.tasks) >= max_tasks
+
+    def add_task(self, asset_id, output_assetname, source=None, processor_id=None, configuration=None):
+        '''Add a task on an input asset (an asset used by several tasks is input once).
+
+        Args:
+            asset_id (str): Media Service Asset ID of the input.
+            output_assetname (str): Name of the task output asset, unique within the job.
+            source: What the output maps back to (e.g. the video path), defaults to asset_id.
+            processor_id (str): Media Processor Id, defaults to the job's.
+            configuration (str): Task configuration, defaults to the job's.
+
+        Returns:
+            The index n of the task's JobOutputAsset(n).
+        '''
+        if any(task['output'] == output_assetname for task in self.tasks):
+            raise ValueError("Media Job: duplicate output asset name '" + output_assetname + "'")
+        if len(self.tasks) >= job_max_tasks:
+            raise ValueError("Media Job: more than " + str(job_max_tasks) + " tasks")
+        if asset_id not in self.inputs:
+            self.inputs.append(asset_id)
+        self.tasks.append({'input': self.inputs.index(asset_id), 'output': output_assetname,
+                           'source': asset_id if source is None else source,
+                           'processor_id': processor_id or self.processor_id,
+                           'configuration': configuration if configuration is not None else self.configuration})
+        return len(self.tasks) - 1
+
+    def outputs(self):
+        '''Output asset name -> source of every task.'''
+        return dict((task['output'], task['source']) for task in self.tasks)
+
+    def request(self):
+        '''The POST /Jobs request (ams_odata.AMSRequest).'''
+        tasks = [dict(task, name=task['output']) for task in self.tasks]
+        return ams_odata.create_job(ams_rest_endpoint, self.name, self.inputs, tasks, job_notification_endpoint_id)
+
+    @ams_scheduler.prioritized('submit')
+    def submit(self, access_token):
+        '''Create the Media Job.
+
+        Returns:
+            The Media Job Id, or None if the Job could not be created.
+        '''
+        response = do_ams_request(self.request(), access_token)
+        if (response.status_code == 201):
+            job_id = str(ams_odata.entity(response.json())['Id'])
+            print("POST Status.............................: " + str(response.status_code))
+            print("Media Job Id............................: " + job_id + " (" + str(len(self.tasks)) + " tasks)")
+            return job_id
+        print("POST Status.............................: " + str(response.status_code) + " - Media Job Creation ERROR." + str(response.content))
+        return None
+
+def list_job_output_assets(access_token, job):
+    '''List the output assets of a Media Job.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job (dict): The job entity (the 'd' JSON object).
+
+    Returns:
+        The list of output asset entities (with Id, Name and Uri).
+    '''
+    response = get_url(access_token, output_assets_uri(access_token, job), False)
+    if (response.status_code != 200):
+        print("GET Status..............................: " + str(response.status_code) + " - Media Job Output Asset: '" + str(job['Id']) + "' Getting ERROR." + str(response.content))
+        return []
+    return ams_odata.results(response.json())
+
+@ams_metrics.timed_stage('download')
+@ams_scheduler.prioritized('download')
+def download_multi_task_output(access_token, job, outputs, sto_account_name, sto_accountKey, include=None, exclude=None):
+    '''Download the output assets of a multi-task Media Job, mapped back to their sources.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        job (dict): The job entity (the 'd' JSON object).
+        outputs (dict): Output asset name -> source (MultiTaskJob.outputs()).
+        sto_account_name (str): Storage account name.
+        sto_accountKey (str): Storage account key.
+        include (list): fnmatch patterns of the output blobs to fetch, download_include if None.
+        exclude (list): fnmatch patterns of the output blobs to skip, download_exclude if None.
+
+    Returns:
+        A dict of source -> list of downloaded file paths (empty for a task without output).
+    '''
+    block_blob_service = get_blob_service(sto_account_name, account_key=sto_accountKey)
+    result_paths = dict((source, []) for source in outputs.values())
+    for asset in list_job_output_assets(access_token, job):
+        source = outputs.get(asset['Name'])
+        if source is None:
+            continue
+        outputAssetContainer = asset['Uri'].split('/')[3]
+        print("Output Asset............................: " + asset['Name'] + " -> " + str(source))
+        result_paths[source] = download_container(block_blob_service, outputAssetContainer, OUTPUT_FOLDER, include, exclude)
+    return result_paths
+
+@ams_metrics.timed_stage('upload')
+@ams_scheduler.prioritized('upload')
+def resumable_upload(access_token, journal, video_path, sto_account_name):
+    '''Upload a video, committing each step to the workflow journal and resuming after the last one.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        journal (WorkflowJournal): The workflow journal.
+        video_path (str): Path of the video.
+        sto_account_name (str): Storage account name.
+
+    Returns:
+        The journal entry (with the asset_id) once the asset file is updated.
+    '''
+    NAME = os.path.basename(video_path)
+    VIDEO_NAME = NAME + ".mp4"
+    entry = journal.start(video_path)
+    if ams_journal.reached(entry, 'asset_created') and not ams_journal.reached(entry, 'job_submitted') and not media_asset_exists(access_token, entry['asset_id']):
+        print("Journaled Asset Gone....................: " + entry['asset_id'] + ", uploading again")
+        entry = journal.rewind(video_path, 'new')
+    elif ams_journal.reached(entry, 'asset_created'):
+        print("Resuming Workflow.......................: " + video_path + " after '" + entry['state'] + "'")
+
+    locator = None
+    if not ams_journal.reached(entry, 'asset_created'):
+        # asset, asset file and write locator in one round-trip, journaled together
+        write_accesspolicy_id = get_upload_policy_pool(access_token).acquire()
+        asset, assetfile, locator = create_upload_setup(access_token, NAME, VIDEO_NAME, write_accesspolicy_id)
+        entry = journal.update(video_path, 'assetfile_created', asset_id=asset['Id'], assetfile_id=assetfile['Id'], locator_id=locator['Id'])
+        print("Media Asset Id..........................: " + entry['asset_id'])
+        print("Media Assetfile Id......................: " + entry['assetfile_id'])
+
+    if not ams_journal.reached(entry, 'asset_created'):
+        response = create_media_asset(access_token, NAME)
+        if (response.status_code != 201):
+            raise IOError("POST Status: " + str(response.status_code) + " - Media Asset: '" + NAME + "' Creation ERROR." + str(response.content))
+        entry = journal.update(video_path, 'asset_created', asset_id=ams_odata.entity(response.json())['Id'])
+        print("Media Asset Id..........................: " + entry['asset_id'])
+
+    if not ams_journal.reached(entry, 'assetfile_created'):
+        response = create_media_assetfile(access_token, entry['asset_id'], VIDEO_NAME, "false", "false")
+        if (response.status_code != 201):
+            raise IOError("POST Status: " + str(response.status_code) + " - Media Assetfile: '" + VIDEO_NAME + "' Creation ERROR." + str(response.content))
+        entry = journal.update(video_path, 'assetfile_created', assetfile_id=ams_odata.entity(response.json())['Id'])
+        print("Media Assetfile Id......................: " + entry['assetfile_id'])
+
+    if not ams_journal.reached(entry, 'uploaded'):
+        if locator is None:
+            if entry['locator_id']:
+                # locator of the interrupted upload
+                get_cleanup_queue(access_token).delete_locator(entry['locator_id'])
+            policy_pool = get_upload_policy_pool(access_token)
+            write_accesspolicy_id = policy_pool.acquire()
+            response = create_sas_locator(access_token, entry['asset_id'], write_accesspolicy_id)
+            if (response.status_code != 201):
+                if response.status_code in (400, 404):
+                    policy_pool.discard(write_accesspolicy_id)
+                raise IOError("POST Status: " + str(response.status_code) + " - SAS URL Locator Creation ERROR." + str(response.content))
+            locator = ams_odata.entity(response.json())
+            entry = journal.update(video_path, locator_id=locator['Id'])
+        block_blob_service = get_blob_service(sto_account_name, sas_token=str(locator['ContentAccessComponent'])[1:])
+        sto_asset_name = os.path.basename(os.path.normpath(str(locator['BaseUri'])))
+        # the blocks already uploaded by the interrupted run are kept (upload_file_blocks state file)
+        video_content_length = upload_file_blocks(block_blob_service, sto_asset_name, VIDEO_NAME, video_path)
+        entry = journal.update(video_path, 'uploaded', content_length=video_content_length, locator_id=None)
+        get_cleanup_queue(access_token).delete_locator(locator['Id'])
+        print("Video File Uploaded.....................: " + str(video_content_length))
+
+    if not ams_journal.reached(entry, 'assetfile_updated'):
+        response = update_media_assetfile(access_token, entry['asset_id'], entry['assetfile_id'], entry['content_length'], VIDEO_NAME)
+        if (response.status_code != 204):
+            raise IOError("MERGE Status: " + str(response.status_code) + " - Assetfile: '" + VIDEO_NAME + "' Update ERROR." + str(response.content))
+        entry = journal.update(video_path, 'assetfile_updated')
+    return entry
+
+def resumable_analysis(access_token, journal, video_path, processor_id):
+    '''Submit (once) and wait for the Face Detector job of an uploaded video, through the workflow journal.
+
+    A job found in the journal is waited for, not submitted again.
+
+    Returns:
+        The journal entry once the job reached a final state (job and job_state set).
+    '''
+    entry = journal.get(video_path)
+    if not ams_journal.reached(entry, 'job_submitted'):
+        output_assetname = 'analysed_' + os.path.basename(video_path)
+        job_id = submit_face_track_job(access_token, processor_id, entry['asset_id'], output_assetname)
+        if job_id is None:
+            raise IOError("Media Job Creation ERROR: " + video_path)
+        entry = journal.update(video_path, 'job_submitted', job_id=job_id, output_asset=output_assetname)
+    if not ams_journal.reached(entry, 'job_finished'):
+        print("Waiting For Media Job...................: " + entry['job_id'])
+        job = wait_for_job(access_token, entry['job_id'])
+        entry = journal.update(video_path, 'job_finished', job=job, job_state=job['State'])
+    return entry
+
+def resumable_download(access_token, journal, video_path, sto_account_name, sto_accountKey):
+    '''Download the output asset of a video's finished job, through the workflow journal.
+
+    Returns:
+        The journal entry once the results are downloaded (result_paths set).
+    '''
+    entry = journal.get(video_path)
+    if not ams_journal.reached(entry, 'downloaded'):
+        source = ams_journal.video_key(video_path)
+        result_paths = download_multi_task_output(access_token, entry['job'], {entry['output_asset']: source}, sto_account_name, sto_accountKey)[source]
+        entry = journal.update(video_path, 'downloaded', result_paths=result_paths)
+    return entry
+
+def run_video_workflow(access_token, journal, video_path, sto_account_name, sto_accountKey, configuration_digest=None):
+    '''Upload, analyse and download a video, resuming from the workflow journal.
+
+    A video whose journaled job ended in Error or Canceled, or ran with another
+    configuration, gets a new job; a video file changed since starts over.
+
+    Args:
+        configuration_digest (str): Digest of the job configuration, of REQUEST_BODY if None.
+
+    Returns:
+        (job id, list of downloaded file paths), (None, []) if the job failed.
+    '''
+    if configuration_digest is None:
+        configuration_digest = ams_dedup.config_digest(REQUEST_BODY)
+    entry = journal.start(video_path, configuration_digest)
+    if ams_journal.reached(entry, 'job_finished') and entry['job_state'] != "3":
+        journal.rewind(video_path, 'assetfile_updated')
+    resumable_upload(access_token, journal, video_path, sto_account_name)
+    entry = resumable_analysis(access_token, journal, video_path, get_media_processor_id(access_token))
+    if entry['job_state'] != "3":
+        print("Media Job Status........................: " + entry['job_id'] + " " + translate_job_state(entry['job_state']))
+        return None, []
+    entry = resumable_download(access_token, journal, video_path, sto_account_name, sto_accountKey)
+    journal.update(video_path, 'done')
+    return entry['job_id'], entry['result_paths']
+
+
+def load_config(config_file=CONFIG_FILE):
+    '''Load the Azure app defaults.
+
+    Args:
+        config_file (str): Path of the JSON config file.
+
+    Returns:
+        A dict with the config values.
+    '''
     try:
-        with open(CONFIG_FILE) as configFile:
-            configData = json.load(configFile)
+        with open(config_file) as configFile:
+            return json.load(configFile)
     except FileNotFoundError:
         print("ERROR: Expecting config.json in examples folder")
         sys.exit()
+
+def write_metrics():
+    '''Write the metrics files set in METRICS_SUMMARY_FILE and METRICS_PROMETHEUS_FILE (run at exit).'''
+    ams_metrics.write_files(METRICS_SUMMARY_FILE, METRICS_PROMETHEUS_FILE)
+
+atexit.register(write_metrics)
+
+def main(video_path=None, config_file=None):
+    '''Upload and analyse one video (VIDEO_PATH by default, see ams_cli.py submit).
+
+    Args:
+        video_path (str): Path of the video, VIDEO_PATH if None.
+        config_file (str): Path of the JSON config file, CONFIG_FILE if None.
+    '''
+    video_path = video_path if video_path is not None else VIDEO_PATH
+    # Load Azure app defaults
+    configData = load_config(config_file if config_file is not None else CONFIG_FILE)
         
     account_name     = configData['accountName']
     account_key      = configData['accountKey']
@@ -688,15 +2199,41 @@ def main():
     
     #step 1: Get Access Token
     access_token, ams_redirected_rest_endpoint = get_access_token_with_rest_end(tenant_id, application_id, account_key)
+    enable_job_notifications(access_token)
     
     #setp 2: Upload video
     #setup path for input video
-    NAME = os.path.basename(VIDEO_PATH)
+    NAME = os.path.basename(video_path)
     ASSET_FINAL_NAME = 'analysed_'+NAME
-    processor_id, asset_id= upload_video(access_token, NAME, sto_account_name, VIDEO_PATH)
-    
-    #step 3: Get face detection with Emotion
-    get_face_track_emotion(access_token, processor_id, asset_id, sto_account_name, sto_accountKey, ASSET_FINAL_NAME)
+    # skip the upload (and the job) if this very footage was processed before
+    dedup_index = ams_dedup.get_dedup_index()
+    video_digest = dedup_index.digest(video_path)
+    configuration_digest = ams_dedup.config_digest(REQUEST_BODY)
+    cached = dedup_index.lookup(video_digest, configuration_digest, lambda asset_id: media_asset_exists(access_token, asset_id))
+    if cached.get('results'):
+        print("Already Analysed (Media Job Id).........: " + cached['job_id'])
+        for result_path in cached['results']:
+            print("Results.................................: " + result_path)
+        return
+    if JOURNAL_FILE is not None and not cached.get('asset_id'):
+        # steps 2 and 3 through the journal: a rerun resumes after the last completed step
+        job_id, result_paths = run_video_workflow(access_token, ams_journal.get_journal(JOURNAL_FILE), video_path, sto_account_name, sto_accountKey, configuration_digest)
+        dedup_index.record_asset(video_digest, ams_journal.get_journal(JOURNAL_FILE).get(video_path)['asset_id'])
+    else:
+        if cached.get('asset_id'):
+            asset_id = cached['asset_id']
+            print("Already Uploaded (Media Asset Id).......: " + asset_id)
+            processor_id = get_media_processor_id(access_token)
+        else:
+            processor_id, asset_id= upload_video(access_token, NAME, sto_account_name, video_path)
+            dedup_index.record_asset(video_digest, asset_id)
+
+        #step 3: Get face detection with Emotion
+        job_id, result_paths = get_face_track_emotion(access_token, processor_id, asset_id, sto_account_name, sto_accountKey, ASSET_FINAL_NAME)
+    if job_id is not None:
+        dedup_index.record_analysis(video_digest, configuration_digest, job_id, result_paths)
+        if STORE_RESULTS:
+            ams_results.ingest_job_results(result_paths, job_id)
     
 
     
@@ -0,0 +1,224 @@
+# coding: utf-8
+
+#Stale resource collector: finds the assets, locators and upload policies left behind by failed runs and deletes them
+import time
+import fnmatch
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import ams_face_track_api as ams
+import ams_dedup
+import ams_metrics
+import ams_odata
+import ams_scheduler
+
+# Entities younger than this are never collected (seconds), so the uploads and jobs in flight are left alone
+GC_MIN_AGE = 24 * 3600
+
+# Names of the assets the workflows create: uploads are named after the video file, outputs 'analysed_<video>'
+GC_ASSET_PATTERNS = ('analysed_*', '*.mp4')
+
+# Concurrent deletes (all of them still go through the account's rate limit, at the 'cleanup' priority)
+GC_WORKERS = 8
+
+# Background sweeper: seconds between two sweeps
+GC_SWEEP_INTERVAL = 3600
+
+# Job states that still need their assets: Queued, Scheduled, Processing, Canceling
+ACTIVE_JOB_STATES = ("0", "1", "2", "6")
+
+# Deletion order: a policy cannot go while locators use it, nor an asset while it has locators
+DELETE_ORDER = ('Locators', 'Assets', 'AccessPolicies')
+
+class StaleResource(object):
+    '''An entity the collector would delete, and why.'''
+    def __init__(self, entity_set, oid, name, reason):
+        self.entity_set = entity_set
+        self.oid = oid
+        self.name = name
+        self.reason = reason
+
+    def __repr__(self):
+        return 'StaleResource(' + self.entity_set + " '" + self.oid + "' " + self.reason + ')'
+
+class GarbageCollector(object):
+    '''Finds and deletes the AMS entities left behind by failed or interrupted runs.
+
+    - Locators on an upload policy (upload_policy_name) that have expired, or
+      whose asset is gone.
+    - Assets named like the workflow's (asset_patterns) older than `min_age`,
+      that no Queued, Scheduled, Processing or Canceling job uses, that no
+      unfinished journal entry refers to and that the dedup index does not
+      reuse. Orphans are not the only ones: with the default patterns the
+      outputs of completed jobs ('analysed_*') are collected too, once their
+      results are downloaded; narrow asset_patterns to keep them.
+    - Upload policies beyond the ones the AccessPolicyPool adopts, older than
+      `min_age` and without a live locator.
+
+    find() only lists them; collect() deletes them (dry run by default), in
+    parallel through helper_delete, locators first and policies last. start()
+    runs collect() periodically from a daemon thread, e.g. next to a batch.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        min_age (float): Seconds an entity must have existed to be collected.
+        asset_patterns (tuple): fnmatch patterns of the asset names collected.
+        workers (int): Concurrent deletes.
+        journal (WorkflowJournal): Journal whose unfinished videos' assets are kept, None for none.
+        dedup_index (DedupIndex): Index whose uploaded assets are kept, the shared one if None.
+    '''
+    def __init__(self, access_token, min_age=GC_MIN_AGE, asset_patterns=GC_ASSET_PATTERNS, workers=GC_WORKERS, journal=None, dedup_index=None):
+        self.access_token = access_token
+        self.min_age = min_age
+        self.asset_patterns = tuple(asset_patterns)
+        self.workers = workers
+        self.journal = journal
+        self.dedup_index = dedup_index if dedup_index is not None else ams_dedup.get_dedup_index()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _old(self, entity, now):
+        created = ams_odata.parse_time(entity.get('Created'))
+        return created is not None and now - created >= self.min_age
+
+    def protected_assets(self):
+        '''Ids of the assets still needed: inputs and outputs of the active jobs, assets of unfinished journal
+        entries, uploads the dedup index reuses (for up to DEDUP_MAX_AGE).
+
+        Returns:
+            (set of asset ids, set of output asset names of the unfinished journal entries)
+        '''
+        protected = self.dedup_index.asset_ids()
+        names = set()
+        job_filter = ' or '.join(["State eq " + state for state in ACTIVE_JOB_STATES])
+        for job in ams.iter_media_jobs(self.access_token, filter=job_filter, select=['Id', 'State']):
+            if str(job['State']) not in ACTIVE_JOB_STATES:
+                continue
+            client = ams.get_ams_client(self.access_token)
+            for navigation in ('InputMediaAssets', 'OutputMediaAssets'):
+                response = ams.get_url(self.access_token, ams_odata.navigation_uri(job, navigation, client.redirected_endpoint or client.endpoint, 'Jobs'), False)
+                if (response.status_code != 200):
+                    raise IOError("GET Status: " + str(response.status_code) + " - Media Job " + navigation + ": '" + str(job['Id']) + "' Getting ERROR.")
+                protected.update(str(asset['Id']) for asset in ams_odata.results(response.json()))
+        for entry in self._pending():
+            if entry.get('asset_id'):
+                protected.add(str(entry['asset_id']))
+            if entry.get('output_asset'):
+                names.add(str(entry['output_asset']))
+        return protected, names
+
+    def _pending(self):
+        return self.journal.pending() if self.journal is not None else []
+
+    def find(self, now=None):
+        '''List the stale entities (nothing is deleted).
+
+        Returns:
+            A list of StaleResource, in deletion order.
+        '''
+        now = time.time() if now is None else now
+        stale = []
+
+        # upload policies: the pool keeps the first ones matching its settings, as AccessPolicyPool._adopt does
+        policies = list(ams.iter_asset_accesspolicies(self.access_token, filter="Name eq '" + ams.upload_policy_name + "'"))
+        pooled = [str(policy['Id']) for policy in policies
+                  if str(policy['Permissions']) == "2" and float(policy['DurationInMinutes']) == float(ams.upload_policy_duration)][:ams.upload_policy_pool_size]
+        durations = dict((str(policy['Id']), float(policy['DurationInMinutes']) * 60) for policy in policies)
+
+        asset_ids = set()
+        assets = []
+        for asset in ams.iter_media_assets(self.access_token, select=['Id', 'Name', 'Created']):
+            asset_ids.add(str(asset['Id']))
+            if any(fnmatch.fnmatchcase(str(asset.get('Name', '')), pattern) for pattern in self.asset_patterns) and self._old(asset, now):
+                assets.append(asset)
+
+        live_locators = []
+        journal_locators = set(str(entry['locator_id']) for entry in self._pending() if entry.get('locator_id'))
+        for locator in ams.iter_sas_locators(self.access_token, select=['Id', 'AssetId', 'AccessPolicyId', 'StartTime', 'ExpirationDateTime']):
+            policy_id = str(locator.get('AccessPolicyId'))
+            if policy_id not in durations:
+                # not one of the workflow's locators
+                continue
+            expires = ams_odata.parse_time(locator.get('ExpirationDateTime'))
+            if expires is None:
+                started = ams_odata.parse_time(locator.get('StartTime'))
+                expires = started + durations[policy_id] if started is not None else None
+            if str(locator['Id']) in journal_locators:
+                live_locators.append(locator)
+            elif str(locator.get('AssetId')) not in asset_ids:
+                stale.append(StaleResource('Locators', str(locator['Id']), str(locator.get('AssetId')), 'asset gone'))
+            elif expires is not None and expires < now:
+                stale.append(StaleResource('Locators', str(locator['Id']), str(locator.get('AssetId')), 'expired'))
+            else:
+                live_locators.append(locator)
+
+        stale_assets = set()
+        if assets:
+            protected, protected_names = self.protected_assets()
+            for asset in assets:
+                if str(asset['Id']) not in protected and str(asset.get('Name', '')) not in protected_names:
+                    stale_assets.add(str(asset['Id']))
+                    stale.append(StaleResource('Assets', str(asset['Id']), str(asset.get('Name', '')), 'no active job'))
+        live_policies = set()
+        for locator in live_locators:
+            if str(locator.get('AssetId')) in stale_assets:
+                stale.append(StaleResource('Locators', str(locator['Id']), str(locator.get('AssetId')), 'asset collected'))
+            else:
+                live_policies.add(str(locator.get('AccessPolicyId')))
+
+        for policy in policies:
+            policy_id = str(policy['Id'])
+            if policy_id not in pooled and policy_id not in live_policies and self._old(policy, now):
+                stale.append(StaleResource('AccessPolicies', policy_id, str(policy.get('Name', '')), 'beyond the upload policy pool'))
+        return stale
+
+    @ams_scheduler.prioritized('cleanup')
+    def _delete(self, resource):
+        response = ams.helper_delete(self.access_token, resource.oid, '/' + resource.entity_set)
+        # already gone counts as collected
+        deleted = response.status_code in (200, 202, 204, 404)
+        ams_metrics.get_registry().inc('ams_gc_deleted_total', entity_set=resource.entity_set, result='deleted' if deleted else str(response.status_code))
+        if not deleted:
+            print("DELETE Status...........................: " + str(response.status_code) + " - " + resource.entity_set + ": '" + resource.oid + "' Deleting ERROR." + str(response.content))
+        return deleted
+
+    def collect(self, dry_run=True):
+        '''Find the stale entities and delete them (only print them with `dry_run`).
+
+        Returns:
+            (list of StaleResource found, number deleted)
+        '''
+        stale = self.find()
+        for resource in stale:
+            print(("Stale " + resource.entity_set).ljust(40, '.') + ": " + resource.oid + " " + resource.name + " (" + resource.reason + ")")
+        deleted = 0
+        if not dry_run and stale:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                # one entity set after the other, see DELETE_ORDER
+                for entity_set in DELETE_ORDER:
+                    deleted += sum(executor.map(self._delete, [resource for resource in stale if resource.entity_set == entity_set]))
+        print("Stale Resources.........................: " + str(len(stale)) + " found, " + (str(deleted) + " deleted" if not dry_run else "dry run"))
+        return stale, deleted
+
+    def start(self, interval=GC_SWEEP_INTERVAL, dry_run=False):
+        '''Sweep every `interval` seconds from a daemon thread (the first sweep right away).'''
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sweep, args=(interval, dry_run), name='ams-gc', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop sweeping (a sweep under way is finished first).'''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sweep(self, interval, dry_run):
+        while not self._stop.is_set():
+            try:
+                self.collect(dry_run)
+            except (IOError, ValueError, KeyError) as e:
+                print("Stale Resources ERROR...................: " + str(e))
+            self._stop.wait(interval)
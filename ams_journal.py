@@ -0,0 +1,165 @@
+# coding: utf-8
+
+#Crash-safe workflow journal (SQLite, WAL): the last completed step of every video, for resuming
+import os
+import json
+import time
+import sqlite3
+import threading
+
+JOURNAL_FILE = './workflow_journal.db'
+
+# Workflow steps, in order; a video is resumed after the last one it reached
+STEPS = ('new', 'asset_created', 'assetfile_created', 'uploaded', 'assetfile_updated',
+         'job_submitted', 'job_finished', 'downloaded', 'done')
+
+# Columns kept per video besides its key, state and timestamps
+FIELDS = ('video_path', 'asset_id', 'assetfile_id', 'locator_id', 'content_length', 'job_id',
+          'output_asset', 'job', 'job_state', 'result_paths', 'error', 'video_stamp', 'configuration_digest')
+
+# Step that produces each field (cleared when rewinding before it)
+FIELD_STEPS = {'asset_id': 'asset_created', 'assetfile_id': 'assetfile_created', 'locator_id': 'uploaded',
+               'content_length': 'uploaded', 'job_id': 'job_submitted', 'output_asset': 'job_submitted',
+               'job': 'job_finished', 'job_state': 'job_finished', 'result_paths': 'downloaded'}
+
+# Fields holding JSON values
+JSON_FIELDS = ('job', 'result_paths')
+
+def video_key(video_path):
+    '''Journal key of a video (its absolute path).'''
+    return os.path.abspath(video_path)
+
+def video_stamp(video_path):
+    '''Size and modification time of a video file, to tell when another file is written to the same path.'''
+    file_stat = os.stat(video_path)
+    return str(file_stat.st_size) + ':' + str(file_stat.st_mtime_ns)
+
+def reached(entry, step):
+    '''True if a journal entry completed `step` (or a later one).'''
+    return entry is not None and STEPS.index(entry['state']) >= STEPS.index(step)
+
+class WorkflowJournal(object):
+    '''Persistent state machine of the video workflows.
+
+    Every completed step is committed to a SQLite database in WAL mode before
+    the next one starts, together with the ids it produced (asset, asset file,
+    locator, job, output asset, result paths). A run that dies can be restarted
+    and each video resumes after its last completed step. WAL keeps the commits
+    cheap and lets several threads and processes read while one writes.
+
+    An entry also records the file's size and mtime and the job configuration
+    digest it was started with: a changed file starts over from 'new', a changed
+    configuration from 'assetfile_updated' (same upload, new job).
+
+    Args:
+        path (str): Database file, ':memory:' for a journal that is not persisted.
+    '''
+    def __init__(self, path=JOURNAL_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS videos (key TEXT PRIMARY KEY, state TEXT NOT NULL, created REAL, updated REAL, ' +
+                                ', '.join(field + ' TEXT' for field in FIELDS) + ')')
+        # journals written before a field existed
+        columns = set(row['name'] for row in self.connection.execute('PRAGMA table_info(videos)'))
+        for field in FIELDS:
+            if field not in columns:
+                self.connection.execute('ALTER TABLE videos ADD COLUMN ' + field + ' TEXT')
+
+    def _entry(self, row):
+        if row is None:
+            return None
+        entry = dict(row)
+        for field in JSON_FIELDS:
+            if entry[field] is not None:
+                entry[field] = json.loads(entry[field])
+        return entry
+
+    def get(self, video_path):
+        '''The journal entry of a video (a dict of the columns), None if unknown.'''
+        with self._lock:
+            return self._entry(self.connection.execute('SELECT * FROM videos WHERE key = ?', (video_key(video_path),)).fetchone())
+
+    def start(self, video_path, configuration_digest=None):
+        '''Add a video in the 'new' state, unless it is journaled already.
+
+        A journaled video is restarted from 'new' if the file changed since (size
+        or mtime), and from 'assetfile_updated' if it was analysed with another
+        configuration.
+
+        Args:
+            video_path (str): Path of the video.
+            configuration_digest (str): Digest of the job configuration (ams_dedup.config_digest), None not to check it.
+
+        Returns:
+            The journal entry.
+        '''
+        now = time.time()
+        stamp = video_stamp(video_path)
+        with self._lock:
+            self.connection.execute('INSERT OR IGNORE INTO videos (key, state, created, updated, video_path, video_stamp, configuration_digest) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (video_key(video_path), 'new', now, now, video_path, stamp, configuration_digest))
+        entry = self.get(video_path)
+        if entry['video_stamp'] != stamp:
+            if entry['state'] != 'new':
+                print("Journaled Video Changed.................: " + video_path + ", starting over")
+            entry = self.rewind(video_path, 'new', video_stamp=stamp, configuration_digest=configuration_digest)
+        elif configuration_digest is not None and entry['configuration_digest'] != configuration_digest:
+            if reached(entry, 'job_submitted'):
+                print("Journaled Configuration Changed.........: " + video_path + ", new job")
+                entry = self.rewind(video_path, 'assetfile_updated', configuration_digest=configuration_digest)
+            else:
+                entry = self.update(video_path, configuration_digest=configuration_digest)
+        return entry
+
+    def update(self, video_path, step=None, **fields):
+        '''Record fields of a video and, with `step`, that the step is completed.
+
+        Returns:
+            The updated journal entry.
+        '''
+        if step is not None and step not in STEPS:
+            raise ValueError("Workflow Journal: unknown step '" + step + "'")
+        values = {'updated': time.time()}
+        if step is not None:
+            values['state'] = step
+        for field, value in fields.items():
+            if field not in FIELDS:
+                raise ValueError("Workflow Journal: unknown field '" + field + "'")
+            if field in JSON_FIELDS and value is not None:
+                value = json.dumps(value)
+            elif value is not None:
+                value = str(value)
+            values[field] = value
+        with self._lock:
+            self.connection.execute('UPDATE videos SET ' + ', '.join(name + ' = ?' for name in values) + ' WHERE key = ?',
+                                    tuple(values.values()) + (video_key(video_path),))
+        return self.get(video_path)
+
+    def rewind(self, video_path, step, **fields):
+        '''Go back to `step`, clearing the fields produced by the later steps (and setting `fields`).'''
+        cleared = dict((field, None) for field, produced_by in FIELD_STEPS.items() if STEPS.index(produced_by) > STEPS.index(step))
+        cleared.update(fields)
+        return self.update(video_path, step, error=None, **cleared)
+
+    def pending(self):
+        '''Entries of the videos not done yet, oldest first.'''
+        with self._lock:
+            rows = self.connection.execute("SELECT * FROM videos WHERE state != 'done' ORDER BY created").fetchall()
+        return [self._entry(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+_journal = None
+
+def get_journal(path=JOURNAL_FILE):
+    '''Return the shared WorkflowJournal.'''
+    global _journal
+    if _journal is None:
+        _journal = WorkflowJournal(path)
+    return _journal
@@ -0,0 +1,264 @@
+# coding: utf-8
+
+#Metrics: per-stage timers, per-endpoint request counters, latency histograms and byte counters
+import os
+import re
+import json
+import time
+import threading
+import functools
+import urllib.parse
+from bisect import bisect_left
+
+# Set to False to make every recording call a no-op
+enabled = True
+
+# Upper bounds (seconds) of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# Job states reported by the watchers, as label values
+JOB_STATE_LABELS = {"0": "Queued", "1": "Scheduled", "2": "Processing", "3": "Finished", "4": "Error", "5": "Canceled", "6": "Canceling"}
+
+_entity_id = re.compile(r"\('[^']*'\)")
+
+class Histogram(object):
+    '''Fixed-bucket histogram (Prometheus style: counts per upper bound, sum and count).'''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        '''Estimate of the q-quantile, interpolated within its bucket (and kept within min and max).'''
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.buckets[-1]
+                return min(max(lower + (upper - lower) * (rank - cumulative) / count, self.min), self.max)
+            cumulative += count
+        return self.max
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.registry.observe(self.name, time.time() - self.started, **self.labels)
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_null_timer = _NullTimer()
+
+class MetricsRegistry(object):
+    '''Thread-safe store of labelled counters and histograms.
+
+    Series are keyed by (name, sorted labels). Counter names end in `_total`,
+    histogram names in `_seconds` by convention.
+    '''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        '''Add `value` to a counter.'''
+        if not enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        '''Record a value (seconds) in a histogram.'''
+        if not enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        '''Context manager recording its duration in a histogram.'''
+        if not enabled:
+            return _null_timer
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def prometheus_text(self):
+        '''The metrics in the Prometheus text exposition format.'''
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.buckets, list(histogram.counts), histogram.sum, histogram.count))
+                                for key, histogram in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + _format_labels(labels) + ' ' + _format_value(value))
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' histogram')
+            cumulative = 0
+            for bound, bucket_count in zip(buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = bound if isinstance(bound, str) else _format_value(bound)
+                lines.append(name + '_bucket' + _format_labels(labels + (('le', le),)) + ' ' + str(cumulative))
+            lines.append(name + '_sum' + _format_labels(labels) + ' ' + _format_value(total))
+            lines.append(name + '_count' + _format_labels(labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        '''JSON-serialisable run summary: counters and, per histogram, count, sum, min, max, mean, p50, p95 and p99.'''
+        with self._lock:
+            summaryData = {'started': self.started, 'elapsed': time.time() - self.started, 'counters': [], 'histograms': []}
+            for (name, labels), value in sorted(self.counters.items()):
+                summaryData['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                summaryData['histograms'].append({'name': name, 'labels': dict(labels), 'count': histogram.count, 'sum': histogram.sum,
+                                                  'min': histogram.min, 'max': histogram.max,
+                                                  'mean': histogram.sum / histogram.count if histogram.count else None,
+                                                  'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95), 'p99': histogram.quantile(0.99)})
+        return summaryData
+
+    def write_json(self, path):
+        '''Write the run summary to a JSON file (atomically).'''
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as summaryFile:
+            json.dump(self.summary(), summaryFile, indent=1)
+        os.replace(tmp_file, path)
+
+    def write_prometheus(self, path):
+        '''Write the Prometheus text to a file (e.g. for the node exporter textfile collector).'''
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'w') as promFile:
+            promFile.write(self.prometheus_text())
+        os.replace(tmp_file, path)
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels) + '}'
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+_registry = MetricsRegistry()
+
+def get_registry():
+    '''Return the shared MetricsRegistry.'''
+    return _registry
+
+def endpoint_label(path):
+    '''Endpoint label of an AMS path or URL: the entity sets without ids or query (e.g. /Jobs/OutputMediaAssets).'''
+    path = urllib.parse.unquote(urllib.parse.urlsplit(path).path if '://' in path else path.split('?')[0])
+    if '/api/' in path:
+        path = path[path.index('/api/') + len('/api'):]
+    return _entity_id.sub('', path) or '/'
+
+def stage(name):
+    '''Context manager timing a workflow stage (ams_stage_seconds{stage=name}).'''
+    return _registry.timer('ams_stage_seconds', stage=name)
+
+def timed_stage(name):
+    '''Decorator timing every call of a function as a workflow stage.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def record_request(method, path, status_code, seconds, sent=0, received=0):
+    '''Record one AMS REST call.'''
+    if not enabled:
+        return
+    endpoint = endpoint_label(path)
+    _registry.inc('ams_requests_total', method=method, endpoint=endpoint, status=str(status_code))
+    _registry.observe('ams_request_seconds', seconds, method=method, endpoint=endpoint)
+    if sent:
+        _registry.inc('ams_request_bytes_total', sent, direction='sent')
+    if received:
+        _registry.inc('ams_request_bytes_total', received, direction='received')
+
+def wire_size(response):
+    '''Bytes of a response body on the wire: its Content-Length when compressed, else the body length.'''
+    if response.headers.get('Content-Encoding') and response.headers.get('Content-Length'):
+        return int(response.headers['Content-Length'])
+    return len(response.content)
+
+def record_blob(operation, seconds, nbytes=0):
+    '''Record one blob storage transfer (put_block, put_block_list, get_blob, list_blobs...).'''
+    if not enabled:
+        return
+    _registry.inc('ams_blob_requests_total', operation=operation)
+    _registry.observe('ams_blob_seconds', seconds, operation=operation)
+    if nbytes:
+        _registry.inc('ams_blob_bytes_total', nbytes, operation=operation)
+
+def record_job(watched_since, processing_since, finished_at, job_state):
+    '''Record the queue (until Processing) and processing time of a finished job.
+
+    Args:
+        watched_since (float): When the job started being watched.
+        processing_since (float): When it was first seen Processing, None if never.
+        finished_at (float): When it was seen in its final state.
+        job_state (str): Its final state code.
+    '''
+    if not enabled:
+        return
+    _registry.inc('ams_jobs_total', state=JOB_STATE_LABELS.get(job_state, job_state))
+    _registry.observe('ams_stage_seconds', (processing_since or finished_at) - watched_since, stage='job_queue')
+    if processing_since is not None:
+        _registry.observe('ams_stage_seconds', finished_at - processing_since, stage='job_processing')
+
+def write_files(summary_file=None, prometheus_file=None):
+    '''Write the JSON run summary and/or the Prometheus text, for the paths given.'''
+    if summary_file:
+        _registry.write_json(summary_file)
+    if prometheus_file:
+        _registry.write_prometheus(prometheus_file)
+
+def print_summary():
+    '''Print the time spent per workflow stage.'''
+    for histogram in _registry.summary()['histograms']:
+        if histogram['name'] == 'ams_stage_seconds':
+            label = "Stage " + histogram['labels']['stage']
+            print(label + "." * max(1, 40 - len(label)) + ": " + str(histogram['count']) + " x, mean " + "%.2f" % histogram['mean'] +
+                  " s, p95 " + "%.2f" % histogram['p95'] + " s")
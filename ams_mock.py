@@ -0,0 +1,740 @@
+# coding: utf-8
+
+#Local stand-in for the AMS v2 REST API and Blob storage, for benchmarks and offline runs
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import gzip
+import argparse
+import threading
+import email.utils
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import xml.etree.ElementTree as ET
+
+import ams_odata
+
+# Defaults of the simulated service
+MOCK_LATENCY        = 0.0    # seconds added to every AMS call
+MOCK_BLOB_LATENCY   = 0.0    # seconds added to every blob call
+MOCK_QUEUE_SECONDS  = 1.0    # time a job stays Queued
+MOCK_JOB_SECONDS    = 5.0    # time a job stays Processing
+MOCK_OUTPUT_EVENTS  = 600    # Face Detector events written per task output
+MOCK_LIST_PAGE_SIZE = 1000   # AMS returns at most 1000 entities per listing
+MOCK_GZIP_LEVEL     = 6      # JSON responses are gzipped when the client accepts it
+MOCK_NOTIFY_INTERVAL = 0.05  # how often the job notifications are checked for, in seconds
+
+MOCK_JOB_STATES = {0: 'Queued', 1: 'Scheduled', 2: 'Processing', 3: 'Finished', 4: 'Error', 5: 'Canceled', 6: 'Canceling'}
+
+PROCESSOR_NAME = 'Azure Media Face Detector'
+
+_entity_path = re.compile(r"^/(\w+)(?:\('([^']*)'\))?(?:/(\w+))?$")
+
+def _http_date(timestamp=None):
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+def _sort_key(value):
+    # dates are served as HTTP dates, order them by time
+    if isinstance(value, str) and email.utils.parsedate(value):
+        return (1, email.utils.mktime_tz(email.utils.parsedate_tz(value)), value)
+    return (0, 0, str(value) if value is not None else '')
+
+def _light(entity):
+    return dict((name, value) for name, value in entity.items() if name != '__metadata' and not (isinstance(value, dict) and '__deferred' in value))
+
+def _loads_lenient(body):
+    '''JSON with the single-quoted string values the AMS OData parser also accepts.'''
+    try:
+        return json.loads(body)
+    except ValueError:
+        return json.loads(re.sub(r":\s*'((?:[^'\\]|\\.)*)'", lambda match: ':' + json.dumps(match.group(1)), body))
+
+def face_detector_output(events=MOCK_OUTPUT_EVENTS, faces=2, seed=0):
+    '''A Face Detector (PerFaceEmotion) JSON output with `events` events of `faces` faces.'''
+    emotions = ('neutral', 'happiness', 'surprise', 'sadness', 'anger', 'disgust', 'fear', 'contempt')
+    rng = random.Random(seed)
+    interval = 1001
+    fragments = []
+    for start in range(0, events, 30):
+        fragment_events = []
+        for index in range(start, min(events, start + 30)):
+            event = []
+            for face_id in range(faces):
+                scores = [rng.random() for emotion in emotions]
+                total = sum(scores)
+                event.append({'id': face_id, 'x': round(0.1 + 0.4 * face_id, 3), 'y': 0.2, 'width': 0.15, 'height': 0.25,
+                              'scores': dict((emotion, round(score / total, 6)) for emotion, score in zip(emotions, scores))})
+            fragment_events.append(event)
+        fragments.append({'start': start * interval, 'duration': len(fragment_events) * interval, 'interval': interval, 'events': fragment_events})
+    return json.dumps({'version': 1, 'timescale': 30000, 'offset': 0, 'framerate': 29.97, 'width': 1280, 'height': 720, 'fragments': fragments})
+
+class TokenBucket(object):
+    '''Request rate limiter: `rate` requests per second, bursts of up to `burst`.'''
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        '''Take a token; returns 0 if granted, else the seconds until one is available.'''
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+class MockState(object):
+    '''In-memory AMS entities and blob containers.'''
+    def __init__(self, queue_seconds=MOCK_QUEUE_SECONDS, job_seconds=MOCK_JOB_SECONDS, job_error_rate=0.0, output_events=MOCK_OUTPUT_EVENTS):
+        self.queue_seconds = queue_seconds
+        self.job_seconds = job_seconds
+        self.job_error_rate = job_error_rate
+        self.output_events = output_events
+        self.entities = {'Assets': {}, 'Files': {}, 'AccessPolicies': {}, 'Locators': {}, 'Jobs': {}, 'MediaProcessors': {}, 'NotificationEndPoints': {}}
+        self.containers = {}
+        self.requests = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.throttled = 0
+        self.notifications = 0
+        self._notifier = None
+        self._lock = threading.RLock()
+        for version in ('1.1', '1.2'):
+            processor_id = 'nb:mpid:UUID:' + str(uuid.uuid4())
+            self.entities['MediaProcessors'][processor_id] = {'Id': processor_id, 'Name': PROCESSOR_NAME, 'Version': version, 'Vendor': 'Microsoft'}
+
+    def count(self, label, bytes_in, bytes_out):
+        with self._lock:
+            self.requests[label] = self.requests.get(label, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out, 'throttled': self.throttled,
+                    'notifications': self.notifications,
+                    'entities': dict((name, len(entities)) for name, entities in self.entities.items()),
+                    'blobs': sum(len(container['blobs']) for container in self.containers.values())}
+
+    def container(self, name):
+        with self._lock:
+            return self.containers.setdefault(name, {'blobs': {}, 'blocks': {}})
+
+    def job_state(self, job):
+        '''Advance a job on the clock: Queued, Processing, then Finished (or Error); outputs are written once.'''
+        elapsed = time.time() - job['created']
+        if job['final'] is not None:
+            return job['final']
+        if elapsed < self.queue_seconds:
+            return 0
+        if elapsed < self.queue_seconds + self.job_seconds:
+            return 2
+        with self._lock:
+            if job['final'] is None:
+                failed = random.random() < self.job_error_rate
+                if not failed:
+                    self._write_outputs(job)
+                job['final'] = 4 if failed else 3
+                job['ended'] = time.time()
+        return job['final']
+
+    def watch_notifications(self):
+        '''Start the thread posting the JobStateChange notifications of the subscribed jobs (idempotent).'''
+        with self._lock:
+            if self._notifier is None:
+                self._notifier = threading.Thread(target=self._notify_loop, name='ams-mock-notify', daemon=True)
+                self._notifier.start()
+
+    def _notify_loop(self):
+        while True:
+            time.sleep(MOCK_NOTIFY_INTERVAL)
+            with self._lock:
+                jobs = [job for job in self.entities['Jobs'].values() if job.get('notify') and job.get('notified') not in (3, 4, 5)]
+            for job in jobs:
+                job_state = self.job_state(job)
+                if job_state != job['notified']:
+                    self._notify(job, job['notified'], job_state)
+                    job['notified'] = job_state
+
+    def _notify(self, job, old_state, new_state):
+        message = json.dumps({'MessageVersion': '1.1', 'ETag': uuid.uuid4().hex, 'EventType': 'JobStateChange', 'TimeStamp': _http_date(),
+                              'Properties': {'JobId': job['Id'], 'JobName': job['Name'], 'OldState': MOCK_JOB_STATES.get(old_state, 'Queued'),
+                                             'NewState': MOCK_JOB_STATES[new_state], 'AccountName': 'mock'}}).encode('utf-8')
+        for address in job['notify']:
+            try:
+                urllib.request.urlopen(urllib.request.Request(address, data=message, headers={'Content-Type': 'application/json'}), timeout=5).close()
+                with self._lock:
+                    self.notifications += 1
+            except (IOError, ValueError):
+                # a lost notification: the client's safety polling catches up
+                pass
+
+    def _write_outputs(self, job):
+        for task in job['tasks']:
+            input_asset = self.entities['Assets'].get(job['inputs'][task['input']]) if task['input'] < len(job['inputs']) else None
+            output_asset = self.entities['Assets'][job['outputs'][task['output']]]
+            base = 'video'
+            if input_asset is not None:
+                names = [entity['Name'] for entity in self.entities['Files'].values() if entity['ParentAssetId'] == input_asset['Id']]
+                if names:
+                    base = names[0].rsplit('.', 1)[0]
+            container = self.container(output_asset['Container'])
+            data = face_detector_output(self.output_events, seed=hash(base) & 0xffff).encode('utf-8')
+            container['blobs'][base + '_annotations.json'] = {'data': data, 'etag': '"0x' + uuid.uuid4().hex[:16].upper() + '"',
+                                                              'modified': time.time(), 'type': 'application/json'}
+
+class MockHandler(BaseHTTPRequestHandler):
+    '''Request handler; the server carries the MockState and the latency/throttling settings.'''
+    protocol_version = 'HTTP/1.1'
+    server_version = 'AMSMock/1.0'
+    _captured = None   # list collecting the responses of the $batch operations, instead of sending them
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body are written separately, do not let Nagle hold the body back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    #------------------------------------------------------------------------------------------
+    # plumbing
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', headers=None, content_type='application/json;odata=verbose;charset=utf-8'):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if self._captured is not None:
+            self._captured.append((status, body, headers or {}, content_type))
+            return len(body)
+        if body and content_type.startswith('application/json') and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body, MOCK_GZIP_LEVEL)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        if body or status not in (204, 304):
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        return len(body)
+
+    def _json(self, status, data, headers=None):
+        accept = self.headers.get('Accept') or ''
+        if self._captured is None and 'd' in data and ('odata=minimalmetadata' in accept or 'odata=nometadata' in accept):
+            # OData v3 light JSON: bare entities, listings in 'value', no __metadata/__deferred
+            minimal = 'odata=minimalmetadata' in accept
+            data = data['d']
+            if 'results' in data:
+                data = {'value': [_light(entity) for entity in data['results']]}
+            elif '__metadata' in data:
+                data = _light(data)
+            if minimal:
+                data = dict({'odata.metadata': self.server.url + '/api/$metadata'}, **data)
+            return self._send(status, json.dumps(data), headers,
+                              'application/json;odata=' + ('minimalmetadata' if minimal else 'nometadata') + ';streaming=true;charset=utf-8')
+        return self._send(status, json.dumps(data), headers)
+
+    def _error(self, status, code, message, headers=None):
+        return self._json(status, {'error': {'code': code, 'message': {'lang': 'en-US', 'value': message}}}, headers)
+
+    def _dispatch(self):
+        split = urllib.parse.urlsplit(self.path)
+        path = re.sub('/+', '/', urllib.parse.unquote(split.path))
+        query = dict(urllib.parse.parse_qsl(split.query, keep_blank_values=True))
+        body = self._body()
+        state = self.server.state
+        if path.startswith('/initial'):
+            sent = self._send(301, b'', {'Location': self.server.url + '/api/'})
+            state.count('301 redirect', len(body), sent)
+            return
+        if path.startswith('/api'):
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if self.server.throttle is not None:
+                wait = self.server.throttle.take()
+                if wait:
+                    with state._lock:
+                        state.throttled += 1
+                    sent = self._error(503, 'ServerBusy', 'The server is busy, retry later.', {'Retry-After': str(max(1, int(round(wait))))})
+                    state.count(self.command + ' throttled', len(body), sent)
+                    return
+            if not self.headers.get('Authorization', '').startswith('Bearer '):
+                sent = self._error(401, 'Unauthorized', 'Missing bearer token.')
+            else:
+                sent = self._ams(path[len('/api'):] or '/', query, body, self.command)
+            state.count(self.command + ' ' + re.sub(r"\('[^']*'\)", '', path[len('/api'):] or '/'), len(body), sent)
+            return
+        if path.startswith('/blob/'):
+            if self.server.blob_latency:
+                time.sleep(self.server.blob_latency)
+            parts = path[len('/blob/'):].split('/', 1)
+            sent = self._blob(parts[0], parts[1] if len(parts) > 1 else '', query, body)
+            state.count(self.command + ' blob' + ('?comp=' + query['comp'] if 'comp' in query else ''), len(body), sent)
+            return
+        if path == '/stats':
+            self._json(200, state.stats())
+            return
+        self._error(404, 'NotFound', 'No route for ' + path)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_MERGE = do_DELETE = do_HEAD = _dispatch
+
+    #------------------------------------------------------------------------------------------
+    # AMS REST
+
+    def _entity_uri(self, entity_set, oid):
+        return self.server.url + '/api/' + entity_set + "('" + urllib.parse.quote(oid, safe=':') + "')"
+
+    def _with_metadata(self, entity_set, entity):
+        entity = dict((key, value) for key, value in entity.items() if key not in ('Container', 'created', 'final', 'ended', 'inputs', 'outputs', 'tasks', 'notify', 'notified'))
+        entity['__metadata'] = {'uri': self._entity_uri(entity_set, entity['Id']), 'type': 'Microsoft.Cloud.Media.Vod.Rest.Data.Models.' + entity_set[:-1]}
+        if entity_set == 'Jobs':
+            entity['OutputMediaAssets'] = {'__deferred': {'uri': self._entity_uri('Jobs', entity['Id']) + '/OutputMediaAssets'}}
+            entity['InputMediaAssets'] = {'__deferred': {'uri': self._entity_uri('Jobs', entity['Id']) + '/InputMediaAssets'}}
+        return entity
+
+    def _ams(self, path, query, body, method):
+        state = self.server.state
+        if path == '/':
+            return self._json(200, {'d': {'EntitySets': sorted(state.entities)}})
+        if path == '/$batch' and method == 'POST':
+            return self._batch(body)
+        match = _entity_path.match(path)
+        if match is None or match.group(1) not in state.entities:
+            return self._error(404, 'ResourceNotFound', 'Resource not found for the segment ' + path)
+        entity_set, oid, navigation = match.groups()
+        entities = state.entities[entity_set]
+        if method == 'POST' and oid is None:
+            try:
+                data = _loads_lenient(body.decode('utf-8'))
+            except ValueError as e:
+                return self._error(400, 'BadRequest', 'Invalid JSON: ' + str(e))
+            return self._create(entity_set, data)
+        if oid is not None:
+            with state._lock:
+                entity = entities.get(oid)
+            if entity is None:
+                return self._error(404, 'ResourceNotFound', entity_set + " '" + oid + "' not found")
+            if method == 'POST' and entity_set == 'Assets' and navigation in ('Files', 'Locators'):
+                # creation through the asset's navigation property (e.g. POST $1/Files in a $batch)
+                try:
+                    data = _loads_lenient(body.decode('utf-8'))
+                except ValueError as e:
+                    return self._error(400, 'BadRequest', 'Invalid JSON: ' + str(e))
+                data['ParentAssetId' if navigation == 'Files' else 'AssetId'] = oid
+                return self._create(navigation, data)
+            if method == 'DELETE':
+                with state._lock:
+                    entities.pop(oid, None)
+                return self._send(204)
+            if method in ('PATCH', 'MERGE'):
+                with state._lock:
+                    entity.update(dict((key, value) for key, value in _loads_lenient(body.decode('utf-8')).items() if key != 'Id'))
+                return self._send(204)
+            if entity_set == 'Jobs':
+                entity['State'] = state.job_state(entity)
+            if navigation in ('InputMediaAssets', 'OutputMediaAssets') and entity_set == 'Jobs':
+                asset_ids = entity['inputs' if navigation == 'InputMediaAssets' else 'outputs']
+                return self._json(200, {'d': {'results': [self._with_metadata('Assets', state.entities['Assets'][asset_id]) for asset_id in asset_ids
+                                                          if asset_id in state.entities['Assets']]}})
+            if navigation == 'Files' and entity_set == 'Assets':
+                files = [self._with_metadata('Files', file) for file in state.entities['Files'].values() if file['ParentAssetId'] == oid]
+                return self._json(200, {'d': {'results': files}})
+            if navigation is not None:
+                return self._json(200, {'d': {'results': []}})
+            return self._json(200, {'d': self._with_metadata(entity_set, entity)})
+        if method != 'GET':
+            return self._error(405, 'MethodNotAllowed', method + ' ' + path)
+        return self._list(entity_set, query)
+
+    def _batch(self, body):
+        # OData $batch: every change set applied all or nothing, $n resolved to the entity created by operation n
+        try:
+            parts = ams_odata.parse_multipart(self.headers.get('Content-Type'), body)
+        except ValueError as e:
+            return self._error(400, 'BadRequest', str(e))
+        response_parts = []
+        for headers, payload in parts:
+            if ams_odata.boundary_of(headers.get('content-type')):
+                response_parts.append(self._changeset(headers['content-type'], payload))
+            else:
+                status, response, created = self._operation(payload, {})
+                response_parts.append(({'Content-Type': 'application/http', 'Content-Transfer-Encoding': 'binary'}, response))
+        boundary = 'batchresponse_' + str(uuid.uuid4())
+        return self._send(202, ams_odata.multipart(boundary, response_parts), content_type='multipart/mixed; boundary=' + boundary)
+
+    def _changeset(self, content_type, payload):
+        state = self.server.state
+        references = {}
+        created = []
+        responses = []
+        for headers, operation in ams_odata.parse_multipart(content_type, payload):
+            status, response, entity = self._operation(operation, references)
+            if status >= 400:
+                # roll the change set back, its single response is the error
+                with state._lock:
+                    for entity_set, oid in created:
+                        state.entities[entity_set].pop(oid, None)
+                return {'Content-Type': 'application/http', 'Content-Transfer-Encoding': 'binary'}, response
+            if entity is not None:
+                created.append(entity)
+            responses.append(({'Content-Type': 'application/http', 'Content-Transfer-Encoding': 'binary'}, response))
+        boundary = 'changesetresponse_' + str(uuid.uuid4())
+        return {'Content-Type': 'multipart/mixed; boundary=' + boundary}, ams_odata.multipart(boundary, responses)
+
+    def _operation(self, data, references):
+        # run one application/http operation, returns (status, response bytes, created (entity set, id) or None)
+        start_line, headers, body = ams_odata.parse_http_message(data)
+        method, url = start_line.split(' ')[:2]
+        content_id = headers.get('content-id')
+        if url.startswith('$'):
+            reference, _, rest = url[1:].partition('/')
+            url = references.get(reference, '/-') + '/' + rest
+        split = urllib.parse.urlsplit(url)
+        path = re.sub('/+', '/', urllib.parse.unquote(split.path))
+        if path.startswith('/api'):
+            path = path[len('/api'):]
+        self._captured = []
+        try:
+            self._ams(path or '/', dict(urllib.parse.parse_qsl(split.query, keep_blank_values=True)), body, method)
+            status, response_body, response_headers, content_type = self._captured[0]
+        finally:
+            self._captured = None
+        response_headers = dict(response_headers)
+        if content_id:
+            response_headers['Content-ID'] = content_id
+        if response_body:
+            response_headers['Content-Type'] = content_type
+        entity = None
+        if status == 201:
+            uri = json.loads(response_body.decode('utf-8'))['d']['__metadata']['uri']
+            entity_path = urllib.parse.unquote(uri[len(self.server.url + '/api'):])
+            match = _entity_path.match(entity_path)
+            entity = (match.group(1), match.group(2))
+            if content_id:
+                references[content_id] = entity_path
+        reason = self.responses.get(status, ('',))[0]
+        return status, ams_odata.http_message('HTTP/1.1 ' + str(status) + ' ' + reason, response_headers, response_body), entity
+
+    def _list(self, entity_set, query):
+        state = self.server.state
+        with state._lock:
+            results = list(state.entities[entity_set].values())
+        if entity_set == 'Jobs':
+            for job in results:
+                job['State'] = state.job_state(job)
+        condition = query.get('$filter')
+        if condition:
+            alternatives = [re.match(r"\s*(\w+)\s+eq\s+(?:'([^']*)'|(\d+))\s*$", part) for part in re.split(r'\s+or\s+', condition)]
+            if any(alternative is None for alternative in alternatives):
+                return self._error(400, 'BadRequest', 'Unsupported $filter: ' + condition)
+            wanted = [(alternative.group(1), alternative.group(2) if alternative.group(3) is None else alternative.group(3)) for alternative in alternatives]
+            results = [entity for entity in results if any(str(entity.get(name)) == value for name, value in wanted)]
+        for term in reversed([term for term in (query.get('$orderby') or '').split(',') if term.strip()]):
+            order = re.match(r"\s*(\w+)(?:\s+(asc|desc))?\s*$", term)
+            if order is None:
+                return self._error(400, 'BadRequest', 'Unsupported $orderby: ' + term)
+            results.sort(key=lambda entity: _sort_key(entity.get(order.group(1))), reverse=order.group(2) == 'desc')
+        skip = int(query.get('$skip') or 0)
+        top = min(int(query.get('$top') or MOCK_LIST_PAGE_SIZE), MOCK_LIST_PAGE_SIZE)
+        page = [self._with_metadata(entity_set, entity) for entity in results[skip:skip + top]]
+        if query.get('$select'):
+            properties = set(name.strip() for name in query['$select'].split(',')) | set(['__metadata'])
+            page = [dict((name, value) for name, value in entity.items() if name in properties) for entity in page]
+        return self._json(200, {'d': {'results': page}})
+
+    def _create(self, entity_set, data):
+        state = self.server.state
+        now = time.time()
+        created = _http_date(now)
+        if entity_set == 'Assets':
+            oid = 'nb:cid:UUID:' + str(uuid.uuid4())
+            container = 'asset-' + oid[len('nb:cid:UUID:'):]
+            entity = {'Id': oid, 'Name': data.get('Name', ''), 'Options': int(data.get('Options') or 0), 'State': 0, 'Created': created,
+                      'Uri': self.server.url + '/' + container, 'Container': container}
+            state.container(container)
+        elif entity_set == 'Files':
+            if data.get('ParentAssetId') not in state.entities['Assets']:
+                return self._error(400, 'BadRequest', "ParentAssetId '" + str(data.get('ParentAssetId')) + "' not found")
+            oid = 'nb:cid:UUID:' + str(uuid.uuid4())
+            entity = {'Id': oid, 'Name': data.get('Name', ''), 'ParentAssetId': data['ParentAssetId'], 'IsPrimary': data.get('IsPrimary', 'false'),
+                      'IsEncrypted': data.get('IsEncrypted', 'false'), 'MimeType': data.get('MimeType'), 'ContentFileSize': '0', 'Created': created}
+        elif entity_set == 'AccessPolicies':
+            oid = 'nb:pid:UUID:' + str(uuid.uuid4())
+            entity = {'Id': oid, 'Name': data.get('Name', ''), 'DurationInMinutes': float(data.get('DurationInMinutes') or 0),
+                      'Permissions': int(data.get('Permissions') or 0), 'Created': created}
+        elif entity_set == 'Locators':
+            asset = state.entities['Assets'].get(data.get('AssetId'))
+            if asset is None or data.get('AccessPolicyId') not in state.entities['AccessPolicies']:
+                return self._error(400, 'BadRequest', 'Unknown AssetId or AccessPolicyId')
+            oid = 'nb:lid:UUID:' + str(uuid.uuid4())
+            base_uri = self.server.url + '/blob/' + asset['Container']
+            sas = '?sv=2017-04-17&sr=c&si=' + uuid.uuid4().hex + '&sig=mock&se=' + urllib.parse.quote(_http_date(now + 3600))
+            entity = {'Id': oid, 'AssetId': asset['Id'], 'AccessPolicyId': data['AccessPolicyId'], 'Type': int(data.get('Type') or 1),
+                      'StartTime': created, 'BaseUri': base_uri, 'ContentAccessComponent': sas, 'Path': base_uri + sas}
+        elif entity_set == 'NotificationEndPoints':
+            oid = 'nb:nepid:UUID:' + str(uuid.uuid4())
+            entity = {'Id': oid, 'Name': data.get('Name', ''), 'EndPointType': int(data.get('EndPointType') or 0),
+                      'EndPointAddress': data.get('EndPointAddress', ''), 'Created': created}
+        elif entity_set == 'Jobs':
+            return self._create_job(data)
+        else:
+            return self._error(405, 'MethodNotAllowed', 'POST ' + entity_set)
+        with state._lock:
+            state.entities[entity_set][oid] = entity
+        return self._json(201, {'d': self._with_metadata(entity_set, entity)})
+
+    def _create_job(self, data):
+        state = self.server.state
+        inputs = []
+        for input_asset in data.get('InputMediaAssets') or ():
+            match = re.search(r"Assets\('([^']*)'\)", urllib.parse.unquote(input_asset.get('__metadata', {}).get('uri', '')))
+            if match is None or match.group(1) not in state.entities['Assets']:
+                return self._error(400, 'BadRequest', 'Unknown input asset ' + json.dumps(input_asset))
+            inputs.append(match.group(1))
+        tasks = []
+        output_names = {}
+        for task in data.get('Tasks') or ():
+            if task.get('MediaProcessorId') not in state.entities['MediaProcessors']:
+                return self._error(400, 'BadRequest', "Unknown MediaProcessorId '" + str(task.get('MediaProcessorId')) + "'")
+            try:
+                task_body = ET.fromstring(re.sub(r'^<\?xml[^>]*\?>', '', task.get('TaskBody', '')))
+                input_index = int(re.search(r'\((\d+)\)', task_body.findtext('inputAsset')).group(1))
+                output = task_body.find('outputAsset')
+                output_index = int(re.search(r'\((\d+)\)', output.text).group(1))
+            except (ET.ParseError, AttributeError, TypeError) as e:
+                return self._error(400, 'BadRequest', 'Invalid TaskBody: ' + str(e))
+            if input_index >= len(inputs):
+                return self._error(400, 'BadRequest', 'JobInputAsset(' + str(input_index) + ') out of range')
+            output_names[output_index] = output.get('assetName', '')
+            tasks.append({'input': input_index, 'output': output_index, 'configuration': task.get('Configuration')})
+        if not tasks:
+            return self._error(400, 'BadRequest', 'A job needs at least one task')
+        outputs = []
+        for index in sorted(output_names):
+            response_asset = {'Name': output_names[index]}
+            oid = 'nb:cid:UUID:' + str(uuid.uuid4())
+            container = 'asset-' + oid[len('nb:cid:UUID:'):]
+            response_asset.update({'Id': oid, 'Options': 0, 'State': 0, 'Created': _http_date(), 'Uri': self.server.url + '/' + container, 'Container': container})
+            state.container(container)
+            with state._lock:
+                state.entities['Assets'][oid] = response_asset
+            outputs.append(oid)
+        notify = []
+        for subscription in data.get('JobNotificationSubscriptions') or ():
+            endpoint = state.entities['NotificationEndPoints'].get(subscription.get('NotificationEndPointId'))
+            if endpoint is None:
+                return self._error(400, 'BadRequest', "Unknown NotificationEndPointId '" + str(subscription.get('NotificationEndPointId')) + "'")
+            if endpoint['EndPointType'] == 3:
+                notify.append(endpoint['EndPointAddress'])
+        job_id = 'nb:jid:UUID:' + str(uuid.uuid4())
+        job = {'Id': job_id, 'Name': data.get('Name', ''), 'State': 0, 'Created': _http_date(), 'created': time.time(), 'final': None,
+               'inputs': inputs, 'outputs': outputs, 'tasks': [dict(task, output=sorted(output_names).index(task['output'])) for task in tasks],
+               'notify': notify, 'notified': None}
+        with state._lock:
+            state.entities['Jobs'][job_id] = job
+        if notify:
+            state.watch_notifications()
+        return self._json(201, {'d': self._with_metadata('Jobs', job)})
+
+    #------------------------------------------------------------------------------------------
+    # Blob storage
+
+    def _blob_headers(self, blob):
+        return {'ETag': blob['etag'], 'Last-Modified': _http_date(blob['modified']), 'x-ms-blob-type': 'BlockBlob', 'x-ms-version': '2017-04-17'}
+
+    def _blob(self, container_name, blob_name, query, body):
+        state = self.server.state
+        container = state.container(container_name)
+        if not blob_name:
+            if query.get('comp') == 'list':
+                return self._list_blobs(container_name, container, query)
+            if self.command == 'PUT':
+                return self._send(201, b'', {'ETag': '"0x1"', 'Last-Modified': _http_date()})
+            return self._send(200, b'', {'x-ms-version': '2017-04-17'})
+        comp = query.get('comp')
+        if self.command == 'PUT' and comp == 'block':
+            with state._lock:
+                container['blocks'].setdefault(blob_name, {})[query.get('blockid', '')] = body
+            return self._send(201, b'', {'x-ms-request-server-encrypted': 'true'})
+        if self.command == 'PUT' and comp == 'blocklist':
+            try:
+                block_ids = [element.text for element in ET.fromstring(body)]
+            except ET.ParseError as e:
+                return self._send(400, 'Invalid block list: ' + str(e), content_type='text/plain')
+            with state._lock:
+                blocks = container['blocks'].get(blob_name, {})
+                committed = container['blobs'].get(blob_name, {}).get('blocks', {})
+                missing = [block_id for block_id in block_ids if block_id not in blocks and block_id not in committed]
+                if missing:
+                    return self._send(400, 'InvalidBlockList', content_type='text/plain')
+                parts = [(block_id, blocks.get(block_id, committed.get(block_id))) for block_id in block_ids]
+                blob = {'data': b''.join(data for block_id, data in parts), 'blocks': dict(parts),
+                        'etag': '"0x' + uuid.uuid4().hex[:16].upper() + '"', 'modified': time.time(),
+                        'type': self.headers.get('x-ms-blob-content-type') or 'application/octet-stream'}
+                container['blobs'][blob_name] = blob
+                container['blocks'].pop(blob_name, None)
+            return self._send(201, b'', self._blob_headers(blob))
+        if self.command == 'PUT':
+            with state._lock:
+                blob = {'data': body, 'blocks': {}, 'etag': '"0x' + uuid.uuid4().hex[:16].upper() + '"', 'modified': time.time(),
+                        'type': self.headers.get('x-ms-blob-content-type') or 'application/octet-stream'}
+                container['blobs'][blob_name] = blob
+            return self._send(201, b'', self._blob_headers(blob))
+        if self.command == 'GET' and comp == 'blocklist':
+            blob = container['blobs'].get(blob_name, {})
+            uncommitted = container['blocks'].get(blob_name, {})
+            xml = '<?xml version="1.0" encoding="utf-8"?><BlockList><CommittedBlocks>' + \
+                  ''.join('<Block><Name>' + block_id + '</Name><Size>' + str(len(data)) + '</Size></Block>' for block_id, data in blob.get('blocks', {}).items()) + \
+                  '</CommittedBlocks><UncommittedBlocks>' + \
+                  ''.join('<Block><Name>' + block_id + '</Name><Size>' + str(len(data)) + '</Size></Block>' for block_id, data in uncommitted.items()) + \
+                  '</UncommittedBlocks></BlockList>'
+            return self._send(200, xml, {'x-ms-blob-content-length': str(len(blob.get('data', b'')))}, content_type='application/xml')
+        blob = container['blobs'].get(blob_name)
+        if blob is None:
+            return self._send(404, '<?xml version="1.0" encoding="utf-8"?><Error><Code>BlobNotFound</Code><Message>The specified blob does not exist.</Message></Error>',
+                              {'x-ms-error-code': 'BlobNotFound'}, content_type='application/xml')
+        if self.command == 'DELETE':
+            with state._lock:
+                container['blobs'].pop(blob_name, None)
+            return self._send(202)
+        data = blob['data']
+        headers = self._blob_headers(blob)
+        byte_range = self.headers.get('x-ms-range') or self.headers.get('Range')
+        if byte_range:
+            match = re.match(r'bytes=(\d+)-(\d*)', byte_range)
+            start = int(match.group(1))
+            if start >= len(data):
+                return self._send(416, '<?xml version="1.0" encoding="utf-8"?><Error><Code>InvalidRange</Code></Error>',
+                                  {'x-ms-error-code': 'InvalidRange', 'Content-Range': 'bytes */' + str(len(data))}, content_type='application/xml')
+            end = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            headers['Content-Range'] = 'bytes ' + str(start) + '-' + str(end) + '/' + str(len(data))
+            return self._send(206, data[start:end + 1], headers, content_type=blob['type'])
+        return self._send(200, data, headers, content_type=blob['type'])
+
+    def _list_blobs(self, container_name, container, query):
+        names = sorted(container['blobs'])
+        marker = query.get('marker') or ''
+        if marker:
+            names = [name for name in names if name >= marker]
+        page_size = int(query.get('maxresults') or 5000)
+        page, rest = names[:page_size], names[page_size:]
+        items = []
+        for name in page:
+            blob = container['blobs'][name]
+            items.append('<Blob><Name>' + name + '</Name><Properties><Last-Modified>' + _http_date(blob['modified']) + '</Last-Modified><Etag>' +
+                         blob['etag'] + '</Etag><Content-Length>' + str(len(blob['data'])) + '</Content-Length><Content-Type>' + blob['type'] +
+                         '</Content-Type><BlobType>BlockBlob</BlobType><LeaseStatus>unlocked</LeaseStatus><LeaseState>available</LeaseState></Properties></Blob>')
+        xml = '<?xml version="1.0" encoding="utf-8"?><EnumerationResults ServiceEndpoint="' + self.server.url + '/blob/" ContainerName="' + container_name + \
+              '"><Blobs>' + ''.join(items) + '</Blobs><NextMarker>' + (rest[0] if rest else '') + '</NextMarker></EnumerationResults>'
+        return self._send(200, xml, content_type='application/xml')
+
+class MockAMSServer(ThreadingHTTPServer):
+    '''Local stand-in for AMS v2 and Blob storage, served from a background thread.
+
+    Endpoints: `url + '/initial/'` answers every call with a 301 to `url + '/api/'`
+    (the AMS redirect), `/api/` serves Assets, Files, AccessPolicies, Locators,
+    Jobs, MediaProcessors and NotificationEndPoints (OData verbose JSON, $filter on "X eq 'v'" or "X eq n" terms,
+    $select, $orderby, $top/$skip), `/blob/<container>/<blob>` serves block upload, block lists,
+    listings and ranged downloads, and `/stats` the request counters.
+
+    Jobs stay Queued for `queue_seconds`, Processing for `job_seconds`, then end
+    Finished (with a Face Detector output per task) or, at `job_error_rate`, in Error.
+    Jobs subscribed to a WebHook NotificationEndPoint post each state change to it.
+
+    Usage:
+        with MockAMSServer(latency=0.02, job_seconds=2) as server:
+            server.start()
+            ams.ams_rest_endpoint = server.ams_endpoint
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port, 0 for any free port.
+        latency (float): Seconds added to every AMS call.
+        blob_latency (float): Seconds added to every blob call.
+        throttle_rps (float): AMS calls per second before 503 + Retry-After, None for no limit.
+        throttle_burst (int): Burst allowed above throttle_rps.
+        queue_seconds (float): Time a job stays Queued.
+        job_seconds (float): Time a job stays Processing.
+        job_error_rate (float): Share of the jobs ending in Error.
+        output_events (int): Face Detector events per task output.
+        verbose (bool): Log every request.
+    '''
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, host='127.0.0.1', port=0, latency=MOCK_LATENCY, blob_latency=MOCK_BLOB_LATENCY, throttle_rps=None, throttle_burst=20,
+                 queue_seconds=MOCK_QUEUE_SECONDS, job_seconds=MOCK_JOB_SECONDS, job_error_rate=0.0, output_events=MOCK_OUTPUT_EVENTS, verbose=False):
+        ThreadingHTTPServer.__init__(self, (host, port), MockHandler)
+        self.url = 'http://' + host + ':' + str(self.server_address[1])
+        self.latency = latency
+        self.blob_latency = blob_latency
+        self.throttle = TokenBucket(throttle_rps, throttle_burst) if throttle_rps else None
+        self.verbose = verbose
+        self.state = MockState(queue_seconds, job_seconds, job_error_rate, output_events)
+        self._thread = None
+
+    @property
+    def ams_endpoint(self):
+        '''The initial AMS endpoint (redirects to the API endpoint).'''
+        return self.url + '/initial/'
+
+    @property
+    def blob_endpoint(self):
+        '''Base URL of the blob containers.'''
+        return self.url + '/blob/'
+
+    def start(self):
+        '''Serve from a daemon thread.'''
+        self._thread = threading.Thread(target=self.serve_forever, name='ams-mock', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local stand-in for Azure Media Services v2 and Blob storage')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=MOCK_LATENCY, help='seconds added to every AMS call')
+    parser.add_argument('--blob-latency', type=float, default=MOCK_BLOB_LATENCY, help='seconds added to every blob call')
+    parser.add_argument('--throttle-rps', type=float, help='AMS calls per second before 503 + Retry-After')
+    parser.add_argument('--throttle-burst', type=int, default=20)
+    parser.add_argument('--queue-seconds', type=float, default=MOCK_QUEUE_SECONDS)
+    parser.add_argument('--job-seconds', type=float, default=MOCK_JOB_SECONDS)
+    parser.add_argument('--job-error-rate', type=float, default=0.0)
+    parser.add_argument('--output-events', type=int, default=MOCK_OUTPUT_EVENTS)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    server = MockAMSServer(args.host, args.port, args.latency, args.blob_latency, args.throttle_rps, args.throttle_burst,
+                           args.queue_seconds, args.job_seconds, args.job_error_rate, args.output_events, args.verbose)
+    print("Mock AMS Endpoint.......................: " + server.ams_endpoint)
+    print("Mock Blob Endpoint......................: " + server.blob_endpoint)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+# coding: utf-8
+
+#Job notifications: a local webhook receiver for the AMS NotificationEndPoints, waking the job watchers
+import hmac
+import json
+import hashlib
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ams_face_track_api as ams
+import ams_metrics
+import ams_odata
+
+# Webhook receiver: address it listens on, and the path AMS posts to
+NOTIFY_HOST = '0.0.0.0'
+NOTIFY_PORT = 8765
+NOTIFY_PATH = '/ams/notifications'
+
+# NotificationEndPoint registered on the account (reused across runs for the same address)
+NOTIFY_ENDPOINT_NAME = 'FaceTrackJobWebHook'
+NOTIFY_ENDPOINT_TYPE = 3   # WebHook (1: Azure Queue)
+
+# Job state names of the notifications -> Job.State codes
+JOB_STATE_CODES = {'Queued': "0", 'Scheduled': "1", 'Processing': "2", 'Finished': "3", 'Error': "4", 'Canceled': "5", 'Canceling': "6"}
+
+def verify_signature(body, signature, signing_key):
+    '''Check the ms-signature header of a webhook call (HMAC-SHA256 of the body, hex, optionally "sha256=" prefixed).
+
+    Args:
+        body (bytes): The request body.
+        signature (str): The ms-signature header.
+        signing_key (str): The base64 signing key of the NotificationEndPoint.
+
+    Returns:
+        True if the signature matches.
+    '''
+    import base64
+    if not signature:
+        return False
+    digest = hmac.new(base64.b64decode(signing_key), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(digest, signature.split('=', 1)[-1].strip().lower())
+
+def job_state_change(message):
+    '''Job id and new state code of a JobStateChange notification, None for any other event.
+
+    Args:
+        message (dict): The notification (MessageVersion, EventType, Properties...).
+
+    Returns:
+        (job id, state code or None), or None.
+    '''
+    if message.get('EventType') != 'JobStateChange':
+        return None
+    properties = message.get('Properties') or {}
+    job_id = properties.get('JobId')
+    if not job_id:
+        return None
+    return str(job_id), JOB_STATE_CODES.get(properties.get('NewState'))
+
+def is_loopback(url):
+    '''True if a URL points at this machine only (localhost, 127.x, ::1).'''
+    host = urllib.parse.urlsplit(url).hostname or ''
+    return host == 'localhost' or host.startswith('127.') or host == '::1'
+
+class _NotificationHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # reachability check of the endpoint
+        self._reply(200, b'OK')
+
+    def do_POST(self):
+        listener = self.server.listener
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.split('?')[0] != listener.path:
+            return self._reply(404)
+        if listener.signing_key and not verify_signature(body, self.headers.get('ms-signature'), listener.signing_key):
+            ams_metrics.get_registry().inc('ams_job_notifications_total', result='bad_signature')
+            return self._reply(401)
+        try:
+            message = json.loads(body.decode('utf-8'))
+        except ValueError:
+            ams_metrics.get_registry().inc('ams_job_notifications_total', result='bad_message')
+            return self._reply(400)
+        # answer first, AMS does not have to wait for the watchers
+        self._reply(200)
+        listener.dispatch(message)
+
+class JobNotificationListener(object):
+    '''Local webhook receiver of the AMS job notifications.
+
+    AMS posts a JobStateChange message to the NotificationEndPoint of every job
+    subscribed to it; the receiver passes the job id and its new state to the
+    subscribed callbacks (JobWatcher.notify, AsyncJobWatcher.notify).
+
+    Args:
+        host (str): Address to listen on.
+        port (int): Port, 0 for any free port.
+        public_url (str): URL AMS posts to (e.g. through a reverse proxy), the receiver's own address if None.
+        path (str): Path of the webhook.
+        signing_key (str): Base64 key checked against the ms-signature header, None to accept unsigned calls.
+    '''
+    def __init__(self, host=NOTIFY_HOST, port=NOTIFY_PORT, public_url=None, path=NOTIFY_PATH, signing_key=None):
+        self.host = host
+        self.port = port
+        self.public_url = public_url
+        self.path = path
+        self.signing_key = signing_key
+        self.callbacks = []
+        self.server = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint_address(self):
+        '''The URL registered as the NotificationEndPoint address.'''
+        if self.public_url:
+            return self.public_url
+        host = '127.0.0.1' if self.host in ('', '0.0.0.0') else self.host
+        return 'http://' + host + ':' + str(self.server.server_address[1] if self.server is not None else self.port) + self.path
+
+    def subscribe(self, callback):
+        '''Call `callback(job_id, state)` for every job state change.'''
+        with self._lock:
+            if callback not in self.callbacks:
+                self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self.callbacks:
+                self.callbacks.remove(callback)
+
+    def dispatch(self, message):
+        '''Pass a notification to the subscribed callbacks.'''
+        change = job_state_change(message)
+        if change is None:
+            ams_metrics.get_registry().inc('ams_job_notifications_total', result='ignored')
+            return
+        ams_metrics.get_registry().inc('ams_job_notifications_total', result='job_state')
+        with self._lock:
+            callbacks = list(self.callbacks)
+        for callback in callbacks:
+            try:
+                callback(*change)
+            except Exception as e:
+                print("Job Notification ERROR..................: " + change[0] + " " + str(e))
+
+    def start(self):
+        '''Serve from a daemon thread (idempotent).'''
+        if self.server is None:
+            self.server = ThreadingHTTPServer((self.host, self.port), _NotificationHandler)
+            self.server.daemon_threads = True
+            self.server.listener = self
+            self._thread = threading.Thread(target=self.server.serve_forever, name='ams-notify', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def register_endpoint(access_token, address, name=NOTIFY_ENDPOINT_NAME, endpoint_type=NOTIFY_ENDPOINT_TYPE):
+    '''Return the id of the NotificationEndPoint posting to `address` (created if not already on the account).
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        address (str): Webhook URL (or queue name).
+        name (str): NotificationEndPoint name.
+        endpoint_type (int): 3 for a WebHook, 1 for an Azure Queue.
+
+    Returns:
+        The NotificationEndPoint Id.
+    '''
+    response = ams.helper_list(access_token, "", '/NotificationEndPoints', {"$filter": "Name eq '" + name + "'"})
+    if (response.status_code == 200):
+        for endpoint in ams_odata.results(response.json()):
+            if endpoint.get('EndPointAddress') == address and int(endpoint.get('EndPointType') or 0) == endpoint_type:
+                return str(endpoint['Id'])
+    response = ams.do_ams_request(ams_odata.create_notification_endpoint(name, address, endpoint_type), access_token)
+    if (response.status_code != 201):
+        raise IOError("POST Status: " + str(response.status_code) + " - Notification EndPoint Creation ERROR." + str(response.content))
+    endpoint_id = str(ams_odata.entity(response.json())['Id'])
+    print("POST Status.............................: " + str(response.status_code))
+    print("Notification EndPoint Id................: " + endpoint_id + " -> " + address)
+    return endpoint_id
+
+_listener = None
+
+def get_listener():
+    '''Return the shared JobNotificationListener (not started).'''
+    global _listener
+    if _listener is None:
+        _listener = JobNotificationListener(NOTIFY_HOST, NOTIFY_PORT, path=NOTIFY_PATH)
+    return _listener
+
+def enable(access_token, public_url=None, signing_key=None):
+    '''Receive the job notifications: start the receiver, register its endpoint and subscribe the new jobs to it.
+
+    The JobWatcher is woken up by the notifications and then only polls as a
+    safety net (ams.job_poll_safety). Without a usable endpoint the workflow
+    keeps polling as before; that includes a receiver on a loopback address
+    (no public_url) while AMS is remote, since AMS could never post to it.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        public_url (str): URL AMS posts to, the receiver's own address if None.
+        signing_key (str): Base64 key of the ms-signature check, None for none.
+
+    Returns:
+        The JobNotificationListener, or None if the endpoint could not be registered.
+    '''
+    listener = get_listener()
+    if public_url:
+        listener.public_url = public_url
+    if signing_key:
+        listener.signing_key = signing_key
+    if is_loopback(listener.endpoint_address) and not is_loopback(ams.ams_rest_endpoint):
+        print("Job Notifications.......................: off, polling only (" + listener.endpoint_address + " is not reachable from AMS, set job_notification_url)")
+        return None
+    listener.start()
+    try:
+        ams.job_notification_endpoint_id = register_endpoint(access_token, listener.endpoint_address)
+    except (IOError, ValueError, KeyError) as e:
+        print("Job Notifications.......................: off, polling only (" + str(e) + ")")
+        listener.stop()
+        return None
+    listener.subscribe(ams.get_job_watcher(access_token).notify)
+    print("Job Notifications.......................: " + listener.endpoint_address)
+    return listener
+
+def disable():
+    '''Stop the receiver; the jobs submitted from now on are polled again.'''
+    ams.job_notification_endpoint_id = None
+    if _listener is not None:
+        _listener.stop()
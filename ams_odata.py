@@ -0,0 +1,438 @@
+# coding: utf-8
+
+#OData request builder: typed AMS request bodies, entity paths and $batch (multipart) requests
+import re
+import json
+import uuid
+import datetime
+import email.utils
+import urllib.parse
+
+# Operations sent in one $batch request
+BATCH_MAX_OPERATIONS = 100
+
+# Entities AMS returns at most per listing page ($top above it is cut down to it)
+MAX_PAGE_SIZE = 1000
+
+# TargetJobState of a job notification subscription (1: final states only)
+JOB_NOTIFY_ALL_STATES = 2
+
+# Accept and Content-Type of the operations of a $batch request
+JSON_VERBOSE = 'application/json;odata=verbose'
+
+# Accept of the JSON responses for each metadata level: 'verbose' wraps every response in 'd'
+# with __metadata/__deferred blocks, the OData v3 light formats return bare objects ('value' for listings)
+JSON_FORMATS = {'verbose': JSON_VERBOSE,
+                'minimal': 'application/json;odata=minimalmetadata',
+                'none':    'application/json;odata=nometadata'}
+
+_status_line = re.compile(r'^HTTP/\d\.\d (\d{3})')
+_verbose_date = re.compile(r'^/Date\((-?\d+)(?:[+-]\d+)?\)/$')
+_iso_date = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(\.\d+)?(Z|[+-]\d\d:\d\d)?$')
+
+class Ref(object):
+    '''Reference to the entity created by an earlier operation of the same change set ($n).'''
+    def __init__(self, content_id):
+        self.content_id = content_id
+
+    def __str__(self):
+        return '$' + str(self.content_id)
+
+class AMSRequest(object):
+    '''One AMS REST operation: method, path (relative to the API root) and JSON body.
+
+    Args:
+        method (str): HTTP method.
+        path (str): Path under the API root, e.g. '/Assets', or under a Ref, e.g. '$1/Files'.
+        body (dict): JSON body, None for none.
+    '''
+    def __init__(self, method, path, body=None):
+        self.method = method
+        self.path = path
+        self.body = body
+
+    @property
+    def content_type(self):
+        '''True if the request carries a JSON body (and so a Content-Type).'''
+        return self.body is not None
+
+    def data(self):
+        '''The serialized body, None for none.'''
+        if self.body is None:
+            return None
+        return json.dumps(self.body, separators=(',', ':'))
+
+    def __repr__(self):
+        return 'AMSRequest(' + self.method + ' ' + self.path + ')'
+
+def entity_path(entity_set, oid):
+    '''Path of one entity, e.g. /Assets('nb:cid:UUID:...') (quoted as a whole, as the AMS samples do).'''
+    return urllib.parse.quote(''.join(['/', entity_set, "('", oid, "')"]), safe='')
+
+def list_query(filter=None, select=None, orderby=None, top=None, skip=None):
+    '''OData query options of a listing.
+
+    Args:
+        filter (str): $filter expression, e.g. "Name eq 'x'".
+        select (str or list): Properties to return ($select), all if None.
+        orderby (str or list): $orderby terms, e.g. 'Created desc'.
+        top (int): Entities per page.
+        skip (int): Entities skipped.
+
+    Returns:
+        A dict of query options, for helper_list.
+    '''
+    query = {}
+    if filter:
+        query["$filter"] = filter
+    if select:
+        query["$select"] = select if isinstance(select, str) else ','.join(select)
+    if orderby:
+        query["$orderby"] = orderby if isinstance(orderby, str) else ','.join(orderby)
+    if top is not None:
+        query["$top"] = str(top)
+    if skip:
+        query["$skip"] = str(skip)
+    return query
+
+#----------------------------------------------------------------------------------------------
+# Response normalization: the same entities whatever the metadata level of the response
+
+def entity(body):
+    '''The entity of a single-entity response.
+
+    Args:
+        body (dict): The JSON body, verbose ({'d': {...}}) or light ({...}).
+
+    Returns:
+        The entity dict.
+    '''
+    return body['d'] if 'd' in body else body
+
+def results(body):
+    '''The entities of a listing response (verbose 'd'/'results', or light 'value').'''
+    return parse_page(body)[0]
+
+def parse_page(body):
+    '''Entities and continuation link of a listing page.
+
+    Args:
+        body (dict): The JSON body of the listing, verbose ({'d': {'results': [...], '__next': url}})
+            or light ({'value': [...], 'odata.nextLink': url}).
+
+    Returns:
+        (list of entities, next page URL or None)
+    '''
+    if 'value' in body:
+        return body['value'], body.get('odata.nextLink')
+    data = body['d'] if 'd' in body else body
+    if isinstance(data, list):
+        return data, None
+    return data.get('results', []), data.get('__next')
+
+def parse_time(value):
+    '''Epoch seconds of an entity date: verbose /Date(ms)/, ISO 8601 (light JSON) or HTTP date; None if unknown.'''
+    if not value:
+        return None
+    value = str(value)
+    match = _verbose_date.match(value)
+    if match is not None:
+        return int(match.group(1)) / 1000.0
+    match = _iso_date.match(value)
+    if match is not None:
+        # AMS writes 7 fraction digits, more than datetime parses
+        seconds = datetime.datetime.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S').replace(tzinfo=datetime.timezone.utc).timestamp()
+        offset = match.group(3)
+        if offset and offset != 'Z':
+            seconds -= (1 if offset[0] == '+' else -1) * (int(offset[1:3]) * 3600 + int(offset[4:6]) * 60)
+        return seconds + float(match.group(2) or 0)
+    parsed = email.utils.parsedate_tz(value)
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+def navigation_uri(entity, name, service_root, entity_set):
+    '''URI of a navigation property of an entity, e.g. the OutputMediaAssets of a job.
+
+    The verbose format links it as __deferred, the light formats only with full
+    metadata, so it is built from the entity id otherwise.
+
+    Args:
+        entity (dict): The entity.
+        name (str): The navigation property.
+        service_root (str): The (redirected) API root.
+        entity_set (str): Entity set of the entity, e.g. 'Jobs'.
+
+    Returns:
+        The absolute URI.
+    '''
+    link = entity.get(name)
+    if isinstance(link, dict) and '__deferred' in link:
+        return link['__deferred']['uri']
+    if entity.get(name + '@odata.navigationLinkUrl'):
+        return entity[name + '@odata.navigationLinkUrl']
+    return entity_uri(service_root, entity_set, entity['Id']) + '/' + name
+
+def entity_uri(service_root, entity_set, oid):
+    '''Absolute URI of one entity (for __metadata links).'''
+    # joined on a plain '/': entity_path also quotes its leading one, which would decode as root//Assets(...)
+    return ''.join([service_root.rstrip('/'), '/', urllib.parse.quote(''.join([entity_set, "('", oid, "')"]), safe='')])
+
+def _parent(parent, entity_set):
+    # POST target of an entity created under a parent: the navigation of a Ref, else the entity set
+    if isinstance(parent, Ref):
+        return str(parent) + '/' + entity_set
+    return '/' + entity_set
+
+#----------------------------------------------------------------------------------------------
+# Entity requests
+
+def create_asset(name, options=0):
+    '''POST /Assets.'''
+    return AMSRequest("POST", '/Assets', {"Name": name, "Options": str(options)})
+
+def create_asset_file(parent_asset, name, is_primary="false", is_encrypted="false", encryption_scheme="None", encryptionkey_id="None", mime_type="video/mp4"):
+    '''POST /Files, or $n/Files for an asset created in the same change set.
+
+    Args:
+        parent_asset (str or Ref): Parent Asset Id, or a Ref to its creation.
+    '''
+    body = {"IsPrimary": is_primary, "MimeType": mime_type, "Name": name}
+    if encryption_scheme == "StorageEncryption":
+        body.update({"IsEncrypted": is_encrypted, "EncryptionScheme": encryption_scheme, "EncryptionVersion": "1.0", "EncryptionKeyId": encryptionkey_id})
+    if not isinstance(parent_asset, Ref):
+        body["ParentAssetId"] = parent_asset
+    return AMSRequest("POST", _parent(parent_asset, 'Files'), body)
+
+def update_asset_file(parent_asset_id, assetfile_id, content_length, name, mime_type="video/mp4"):
+    '''PATCH /Files('id'): size and name of an uploaded file.'''
+    return AMSRequest("PATCH", entity_path('Files', assetfile_id),
+                      {"ContentFileSize": str(content_length), "Id": assetfile_id, "MimeType": mime_type, "Name": name, "ParentAssetId": parent_asset_id})
+
+def create_access_policy(name, duration, permission="1"):
+    '''POST /AccessPolicies.'''
+    return AMSRequest("POST", '/AccessPolicies', {"Name": str(name), "DurationInMinutes": str(duration), "Permissions": str(permission)})
+
+def create_locator(asset, accesspolicy_id, locator_type=1):
+    '''POST /Locators, or $n/Locators for an asset created in the same change set (1: SAS locator).'''
+    body = {"AccessPolicyId": accesspolicy_id, "Type": locator_type}
+    if not isinstance(asset, Ref):
+        body["AssetId"] = asset
+    return AMSRequest("POST", _parent(asset, 'Locators'), body)
+
+def task_body(input_index, output_index, output_assetname):
+    '''The TaskBody XML of a task reading JobInputAsset(input_index) into JobOutputAsset(output_index).'''
+    return '<?xml version="1.0" encoding="utf-16"?><taskBody><inputAsset>JobInputAsset(' + str(input_index) + ')</inputAsset>' + \
+           '<outputAsset assetCreationOptions="0" assetName="' + output_assetname + '">JobOutputAsset(' + str(output_index) + ')</outputAsset></taskBody>'
+
+def create_job(service_root, name, input_asset_ids, tasks, notification_endpoint_id=None):
+    '''POST /Jobs.
+
+    Args:
+        service_root (str): Initial AMS endpoint, base of the input asset links.
+        name (str): Media Job name.
+        input_asset_ids (list): Input Asset Ids, JobInputAsset(n) in this order.
+        tasks (list): Dicts with 'input' (index), 'output' (asset name), 'processor_id',
+            'configuration' (the preset text) and optionally 'name'; task n writes JobOutputAsset(n).
+        notification_endpoint_id (str): NotificationEndPoint told about every state change of the job.
+    '''
+    job_tasks = []
+    for index, task in enumerate(tasks):
+        job_task = {"Configuration": task['configuration'], "MediaProcessorId": task['processor_id'],
+                    "TaskBody": task_body(task['input'], index, task['output'])}
+        if task.get('name'):
+            job_task["Name"] = task['name']
+        job_tasks.append(job_task)
+    body = {"Name": name,
+            "InputMediaAssets": [{"__metadata": {"uri": entity_uri(service_root, 'Assets', asset_id)}} for asset_id in input_asset_ids],
+            "Tasks": job_tasks}
+    if notification_endpoint_id is not None:
+        body["JobNotificationSubscriptions"] = [{"NotificationEndPointId": notification_endpoint_id, "TargetJobState": JOB_NOTIFY_ALL_STATES}]
+    return AMSRequest("POST", '/Jobs', body)
+
+def create_notification_endpoint(name, address, endpoint_type=3):
+    '''POST /NotificationEndPoints (endpoint_type 3: WebHook, 1: Azure Queue).'''
+    return AMSRequest("POST", '/NotificationEndPoints', {"Name": name, "EndPointType": endpoint_type, "EndPointAddress": address})
+
+def delete_entity(entity_set, oid):
+    '''DELETE /<entity_set>('id').'''
+    return AMSRequest("DELETE", entity_path(entity_set, oid))
+
+#----------------------------------------------------------------------------------------------
+# $batch
+
+class ODataResponse(object):
+    '''Response of one operation of a $batch, with the requests.Response attributes the workflow uses.'''
+    def __init__(self, status_code, headers, content, content_id=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.content_id = content_id
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+class ODataBatch(object):
+    '''A group of AMS operations sent as one OData $batch request.
+
+    Operations are grouped in change sets: the operations of a change set are
+    applied together (all or none), and a later operation can target the entity
+    created by an earlier one of the same change set through the Ref add()
+    returns (e.g. POST $1/Files). Every operation gets one response, in order;
+    a failed change set answers with a single error response.
+
+    Usage:
+        batch = ODataBatch()
+        asset = batch.add(create_asset(name))
+        batch.add(create_asset_file(asset, name + '.mp4'))
+        responses = do_ams_batch(batch, access_token)
+
+    Args:
+        max_operations (int): Operations allowed in the batch.
+    '''
+    def __init__(self, max_operations=BATCH_MAX_OPERATIONS):
+        self.max_operations = max_operations
+        self.changesets = [[]]
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def is_full(self):
+        return len(self.operations) >= self.max_operations
+
+    def add(self, request):
+        '''Add an operation to the current change set.
+
+        Returns:
+            The Ref of the operation.
+        '''
+        if self.is_full():
+            raise ValueError("OData Batch: more than " + str(self.max_operations) + " operations")
+        self.operations.append(request)
+        content_id = len(self.operations)
+        self.changesets[-1].append((content_id, request))
+        return Ref(content_id)
+
+    def new_changeset(self):
+        '''Start a new change set (the operations of different change sets are independent).'''
+        if self.changesets[-1]:
+            self.changesets.append([])
+
+    def payload(self, service_root, headers=None):
+        '''Serialize the batch.
+
+        Args:
+            service_root (str): The (redirected) AMS endpoint the operation URLs are built on.
+            headers (dict): Headers added to every operation (e.g. the x-ms-version).
+
+        Returns:
+            (Content-Type of the $batch request, body bytes)
+        '''
+        batch_boundary = 'batch_' + str(uuid.uuid4())
+        parts = []
+        for changeset in self.changesets:
+            if not changeset:
+                continue
+            changeset_boundary = 'changeset_' + str(uuid.uuid4())
+            operations = []
+            for content_id, request in changeset:
+                url = request.path if request.path.startswith('$') else service_root.rstrip('/') + '/' + request.path.lstrip('/')
+                operation_headers = {'Content-ID': str(content_id), 'Accept': JSON_VERBOSE, 'DataServiceVersion': '3.0', 'MaxDataServiceVersion': '3.0'}
+                operation_headers.update(headers or {})
+                if request.content_type:
+                    operation_headers['Content-Type'] = JSON_VERBOSE
+                operations.append(({'Content-Type': 'application/http', 'Content-Transfer-Encoding': 'binary'},
+                                   http_message(request.method + ' ' + url + ' HTTP/1.1', operation_headers, request.data())))
+            parts.append(({'Content-Type': 'multipart/mixed; boundary=' + changeset_boundary}, multipart(changeset_boundary, operations)))
+        return 'multipart/mixed; boundary=' + batch_boundary, multipart(batch_boundary, parts)
+
+    def parse(self, content_type, content):
+        '''Parse the multipart response of the batch.
+
+        Returns:
+            The list of ODataResponse, one per operation, in operation order.
+        '''
+        changesets = [changeset for changeset in self.changesets if changeset]
+        responses = []
+        for index, (headers, payload) in enumerate(parse_multipart(content_type, content)):
+            if boundary_of(headers.get('content-type')):
+                parsed = parse_batch(headers['content-type'], payload)
+            else:
+                # a failed change set answers with a single response, which stands for each of its operations
+                parsed = [parse_response(payload)] * (len(changesets[index]) if index < len(changesets) else 1)
+            responses.extend(ODataResponse(status_code, response_headers, body, response_headers.get('content-id'))
+                             for status_code, response_headers, body in parsed)
+        return responses
+
+def http_message(start_line, headers, body=None):
+    '''An HTTP request or response as the bytes of an application/http part.'''
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    lines = [start_line] + [name + ': ' + str(value) for name, value in headers.items()]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + (body or b'')
+
+def multipart(boundary, parts):
+    '''A multipart/mixed body from (headers, payload bytes) parts.'''
+    body = b''
+    for headers, payload in parts:
+        body += ('--' + boundary + '\r\n' + ''.join(name + ': ' + value + '\r\n' for name, value in headers.items()) + '\r\n').encode('utf-8')
+        body += payload + b'\r\n'
+    return body + ('--' + boundary + '--\r\n').encode('utf-8')
+
+def boundary_of(content_type):
+    '''The boundary parameter of a multipart Content-Type, None if not multipart.'''
+    match = re.search(r'boundary="?([^";]+)"?', content_type or '')
+    return match.group(1) if match and content_type.lower().startswith('multipart/') else None
+
+def parse_multipart(content_type, content):
+    '''Split a multipart body into (headers, payload bytes) parts (header names in lower case).'''
+    boundary = boundary_of(content_type)
+    if boundary is None:
+        raise ValueError("OData Batch: not a multipart body (" + str(content_type) + ")")
+    delimiter = ('--' + boundary).encode('utf-8')
+    parts = []
+    for chunk in content.split(delimiter)[1:]:
+        if chunk.startswith(b'--'):
+            break
+        chunk = chunk[2:] if chunk.startswith(b'\r\n') else chunk
+        chunk = chunk[:-2] if chunk.endswith(b'\r\n') else chunk
+        head, _, payload = chunk.partition(b'\r\n\r\n')
+        headers = {}
+        for line in head.decode('utf-8').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        parts.append((headers, payload))
+    return parts
+
+def parse_http_message(data):
+    '''Parse an application/http part.
+
+    Returns:
+        (start line, headers with lower case names, body bytes)
+    '''
+    head, _, body = data.partition(b'\r\n\r\n')
+    lines = head.decode('utf-8').split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers, body
+
+def parse_response(data):
+    '''Parse an application/http response part into (status code, headers, body).'''
+    start_line, headers, body = parse_http_message(data)
+    match = _status_line.match(start_line)
+    if match is None:
+        raise ValueError("OData Batch: bad response line '" + start_line + "'")
+    return int(match.group(1)), headers, body
+
+def parse_batch(content_type, content):
+    '''Flatten a $batch response into (status code, headers, body) per operation response.'''
+    responses = []
+    for headers, payload in parse_multipart(content_type, content):
+        if boundary_of(headers.get('content-type')):
+            responses.extend(parse_batch(headers['content-type'], payload))
+        else:
+            responses.append(parse_response(payload))
+    return responses
@@ -0,0 +1,287 @@
+# coding: utf-8
+
+#Indexed columnar store of the Face Detector results, memory-mapped for queries
+import os
+import json
+import mmap
+import shutil
+import hashlib
+import operator
+from array import array
+from bisect import bisect_left
+
+import ams_face_parser
+
+RESULTS_STORE = './results_store'
+
+# Operators allowed in query `where` clauses
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge, '==': operator.eq, '!=': operator.ne}
+
+class StoredTrack(object):
+    '''One video of the results store, its columns memory-mapped on demand.
+
+    Layout of a video directory: `meta.json` (metadata header, row count, column
+    typecodes, face index offsets), one raw `<column>.bin` per column in time
+    order, and `face_rows.bin`, the row numbers grouped by face id (time order
+    within a face).
+
+    Args:
+        path (str): The video directory.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as metaFile:
+            self.meta = json.load(metaFile)
+        self.metadata = self.meta['metadata']
+        self.rows = self.meta['rows']
+        self._maps = {}
+
+    def __len__(self):
+        return self.rows
+
+    def _map(self, name, typecode):
+        view = self._maps.get(name)
+        if view is None:
+            if self.rows == 0:
+                view = array(typecode)
+            else:
+                with open(os.path.join(self.path, name + '.bin'), mode='rb') as file:
+                    view = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+            self._maps[name] = view
+        return view
+
+    def column(self, name):
+        '''The whole column, memory-mapped (pages are read only when touched).'''
+        return self._map(name, self.meta['columns'][name])
+
+    def face_ids(self):
+        '''The face ids of this video.'''
+        return sorted(int(face_id) for face_id in self.meta['faces'])
+
+    def time_range(self, start=None, end=None):
+        '''Row range [first, last) with start <= timestamp (seconds) < end, by binary search.'''
+        timestamps = self.column('timestamp')
+        timescale = float(self.metadata.get('timescale') or 1)
+        first = 0 if start is None else bisect_left(timestamps, int(round(start * timescale)))
+        last = self.rows if end is None else bisect_left(timestamps, int(round(end * timescale)))
+        return first, last
+
+    def select(self, face_id=None, start=None, end=None):
+        '''Row numbers of a face and/or a time range, touching only the index pages needed.
+
+        Returns:
+            A range or an array of row numbers, in time order.
+        '''
+        first, last = self.time_range(start, end)
+        if face_id is None:
+            return range(first, last)
+        offsets = self.meta['faces'].get(str(face_id))
+        if offsets is None:
+            return array('q')
+        face_rows = self._map('face_rows', 'q')
+        begin, stop = offsets
+        lo = bisect_left(face_rows, first, begin, stop)
+        hi = bisect_left(face_rows, last, lo, stop)
+        return face_rows[lo:hi]
+
+    def close(self):
+        '''Release the memory maps.'''
+        for view in self._maps.values():
+            if isinstance(view, memoryview):
+                view.release()
+        self._maps = {}
+
+def _write_face_index(path, rows):
+    '''Write face_rows.bin, the row numbers grouped by face id in time order within a face.
+
+    Returns:
+        A dict of face id (str) -> [first, last) offsets in face_rows.bin.
+    '''
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    face_id_path = os.path.join(path, 'face_id.bin')
+    faces = {}
+    if numpy is not None:
+        face_rows = numpy.empty(0, dtype='q')
+        if rows:
+            # a stable sort keeps the time order within a face
+            face_column = numpy.memmap(face_id_path, dtype=dict(ams_face_parser.COLUMNS)['face_id'], mode='r', shape=(rows,))
+            face_rows = numpy.argsort(face_column, kind='stable').astype('q', copy=False)
+            sorted_ids = face_column[face_rows]
+            del face_column
+            starts = numpy.concatenate(([0], numpy.flatnonzero(sorted_ids[1:] != sorted_ids[:-1]) + 1))
+            stops = numpy.append(starts[1:], rows)
+            faces = dict((str(face_id), [start, stop]) for face_id, start, stop in zip(sorted_ids[starts].tolist(), starts.tolist(), stops.tolist()))
+    else:
+        # two passes over the column: count, then place
+        face_column = array(dict(ams_face_parser.COLUMNS)['face_id'])
+        if rows:
+            with open(face_id_path, mode='rb') as file:
+                face_column.fromfile(file, rows)
+        counts = {}
+        for face_id in face_column:
+            counts[face_id] = counts.get(face_id, 0) + 1
+        position = 0
+        next_slot = {}
+        for face_id in sorted(counts):
+            faces[str(face_id)] = [position, position + counts[face_id]]
+            next_slot[face_id] = position
+            position += counts[face_id]
+        face_rows = array('q', bytes(8 * rows))
+        for row, face_id in enumerate(face_column):
+            face_rows[next_slot[face_id]] = row
+            next_slot[face_id] += 1
+    with open(os.path.join(path, 'face_rows.bin'), mode='wb') as file:
+        face_rows.tofile(file)
+    return faces
+
+class ResultsStore(object):
+    '''Columnar, indexed store of Face Detector results, one directory per video.
+
+    Args:
+        root (str): Store directory.
+    '''
+    def __init__(self, root=RESULTS_STORE):
+        self.root = root
+        self._open = {}
+
+    def video_path(self, video_key):
+        return os.path.join(self.root, video_key)
+
+    def videos(self):
+        '''Keys of the stored videos.'''
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'meta.json')))
+
+    def ingest(self, video_key, output_path, job_id=None):
+        '''Convert a Face Detector JSON output into a stored video (replacing it).
+
+        The output is streamed batch by batch into the column files, so memory use
+        does not grow with the video length. The face index is a stable argsort
+        of the memory-mapped face id column with numpy, a count and place pass
+        over the column without it.
+
+        Args:
+            video_key (str): Key of the video in the store.
+            output_path (str): Path of the Face Detector JSON output.
+            job_id (str): Media Job Id, kept in the metadata.
+
+        Returns:
+            The number of rows stored.
+        '''
+        path = self.video_path(video_key)
+        tmp_path = path + '.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        files = dict((name, open(os.path.join(tmp_path, name + '.bin'), mode='wb')) for name, typecode in ams_face_parser.COLUMNS)
+        rows = 0
+        metadata = {}
+        try:
+            for batch in ams_face_parser.iter_face_batches(output_path):
+                for name, column in batch.columns.items():
+                    column.tofile(files[name])
+                rows += len(batch)
+                metadata.update(batch.metadata)
+        finally:
+            for file in files.values():
+                file.close()
+
+        faces = _write_face_index(tmp_path, rows)
+
+        meta = {'metadata': metadata, 'rows': rows, 'job_id': job_id, 'source': os.path.basename(output_path),
+                'columns': dict(ams_face_parser.COLUMNS), 'faces': faces}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as metaFile:
+            json.dump(meta, metaFile)
+
+        self.close(video_key)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        return rows
+
+    def open(self, video_key):
+        '''The StoredTrack of a video (kept open for later queries).'''
+        track = self._open.get(video_key)
+        if track is None:
+            track = self._open[video_key] = StoredTrack(self.video_path(video_key))
+        return track
+
+    def close(self, video_key=None):
+        '''Release the memory maps of one video, or of all of them.'''
+        for key in ([video_key] if video_key is not None else list(self._open)):
+            track = self._open.pop(key, None)
+            if track is not None:
+                track.close()
+
+    def query(self, columns=('timestamp', 'face_id'), face_id=None, start=None, end=None, where=(), dominant=None, videos=None):
+        '''Query the store, reading only the columns and rows involved.
+
+        Example, all rows where face 3 is mostly angry:
+            store.query(['timestamp'], face_id=3, dominant='anger')
+
+        Args:
+            columns (list): Columns to return.
+            face_id (int): Only this face.
+            start (float): From this time (seconds, inclusive).
+            end (float): Up to this time (seconds, exclusive).
+            where (list): (column, operator, value) conditions, operator one of OPERATORS.
+            dominant (str): Only rows where this emotion has the highest score.
+            videos (list): Video keys to query, all by default.
+
+        Yields:
+            (video_key, dict of column name -> list of values) for each video with matching rows.
+        '''
+        for video_key in (videos if videos is not None else self.videos()):
+            track = self.open(video_key)
+            rows = track.select(face_id, start, end)
+            if len(rows) == 0:
+                continue
+            for name, op, value in where:
+                column = track.column(name)
+                compare = OPERATORS[op]
+                rows = [row for row in rows if compare(column[row], value)]
+            if dominant is not None:
+                dominant_column = track.column(dominant)
+                others = [track.column(emotion) for emotion in ams_face_parser.EMOTIONS if emotion != dominant]
+                rows = [row for row in rows if all(dominant_column[row] >= other[row] for other in others)]
+            if len(rows) == 0:
+                continue
+            if isinstance(rows, range):
+                result = dict((name, track.column(name)[rows.start:rows.stop].tolist()) for name in columns)
+            else:
+                result = dict((name, [track.column(name)[row] for row in rows]) for name in columns)
+            yield video_key, result
+
+def result_video_key(result_path):
+    '''Store key of a downloaded result file: its name without the .json extensions, then a digest of its
+    folder, so results of same-named videos in different folders do not replace each other.'''
+    name = os.path.basename(result_path)
+    while name.endswith('.json'):
+        name = name[:-len('.json')]
+    folder = os.path.dirname(os.path.abspath(result_path))
+    return name + '-' + hashlib.sha1(folder.encode('utf-8')).hexdigest()[:10]
+
+def ingest_job_results(result_paths, job_id=None, store=None):
+    '''Ingest the JSON results of a job into the results store.
+
+    Args:
+        result_paths (list): Local paths returned by download_job_output.
+        job_id (str): Media Job Id.
+        store (ResultsStore): The store, a ResultsStore(RESULTS_STORE) by default.
+
+    Returns:
+        A dict of video key -> rows stored.
+    '''
+    if store is None:
+        store = ResultsStore()
+    ingested = {}
+    for result_path in result_paths:
+        if not result_path.endswith('.json.json'):
+            continue
+        try:
+            ingested[result_video_key(result_path)] = store.ingest(result_video_key(result_path), result_path, job_id)
+        except ValueError as e:
+            print("Results Store...........................: " + result_path + " not a Face Detector output (" + str(e) + ")")
+    return ingested
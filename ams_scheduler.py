@@ -0,0 +1,335 @@
+# coding: utf-8
+
+#Request scheduler: per-account token buckets, Retry-After and jittered retries, stage priorities
+import time
+import heapq
+import random
+import threading
+import itertools
+import contextvars
+import functools
+import email.utils
+
+import ams_metrics
+
+# Rate limits (requests per second and burst) of each AMS account and each storage account, None for no limit
+AMS_REQUESTS_PER_SECOND  = 10
+AMS_BURST                = 20
+BLOB_REQUESTS_PER_SECOND = 200
+BLOB_BURST               = 400
+
+# Retries: attempts after the first call, full-jitter exponential backoff (seconds)
+MAX_RETRIES        = 6
+BACKOFF_BASE       = 0.5
+BACKOFF_MAX        = 60
+RETRY_AFTER_MAX    = 300                    # a longer Retry-After is capped
+THROTTLE_STATUSES  = (429, 503)             # rejected unprocessed: retried for every method
+RETRY_STATUSES     = (408, 500, 502, 504)   # retried for the idempotent methods only
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'PATCH', 'MERGE', 'OPTIONS')
+
+# Adaptive rate: cut on every throttled call, regained a step per successful call
+RATE_DECREASE = 0.5    # factor applied to the current rate
+RATE_INCREASE = 0.02   # fraction of the configured rate regained
+RATE_MIN      = 0.1    # floor, as a fraction of the configured rate
+
+# Workflow stages, lower goes first when calls queue for the bucket
+PRIORITIES = {'upload': 0, 'submit': 1, 'download': 1, 'default': 2, 'poll': 3, 'cleanup': 4}
+
+_stage = contextvars.ContextVar('ams_stage', default='default')
+
+class priority(object):
+    '''Context manager setting the stage (see PRIORITIES) of the calls made in this thread or task.'''
+    def __init__(self, stage):
+        if stage not in PRIORITIES:
+            raise ValueError("Request Scheduler: unknown stage '" + stage + "'")
+        self.stage = stage
+        self._token = None
+
+    def __enter__(self):
+        self._token = _stage.set(self.stage)
+        return self
+
+    def __exit__(self, *exc):
+        _stage.reset(self._token)
+
+def prioritized(stage):
+    '''Decorator running every call of a function at a stage priority.'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with priority(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def current_stage():
+    '''The stage of the calls made in this thread or task.'''
+    return _stage.get()
+
+def retry_after(headers):
+    '''Seconds asked for by a throttled response (Retry-After or x-ms-retry-after-ms), None if not given.'''
+    if not headers:
+        return None
+    headers = dict((str(name).lower(), value) for name, value in headers.items())
+    if headers.get('x-ms-retry-after-ms'):
+        try:
+            return min(RETRY_AFTER_MAX, float(headers['x-ms-retry-after-ms']) / 1000)
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return min(RETRY_AFTER_MAX, max(0.0, float(value)))
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value) if email.utils.parsedate(value) else None
+        return min(RETRY_AFTER_MAX, max(0.0, date.timestamp() - time.time())) if date is not None else None
+
+def backoff(attempt):
+    '''Full-jitter exponential backoff of a retry attempt (0 for the first retry).'''
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class RequestScheduler(object):
+    '''Shared token bucket and retry policy of one account.
+
+    Every call takes a token first; calls waiting for a token are served by
+    stage priority (uploads before job polling), then in arrival order. A
+    throttled response (429/503) blocks the whole bucket for its Retry-After
+    and halves the rate, which then grows back with every successful call, so
+    the workers settle at the account quota instead of all retrying at once.
+
+    Args:
+        name (str): Name of the account, used as a metrics label.
+        rate (float): Requests per second, None for no limit.
+        burst (int): Requests allowed at once above the rate.
+    '''
+    def __init__(self, name, rate=None, burst=1):
+        self.name = name
+        self.max_rate = float(rate) if rate else None
+        self.rate = self.max_rate
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.blocked_until = 0.0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+
+    def _grant(self, ticket, now):
+        # under the lock: 0 if the ticket got its token, else seconds to wait (None: until notified)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self._waiters[0] != ticket:
+            return None
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        heapq.heappop(self._waiters)
+        self._cond.notify_all()
+        return 0
+
+    def _ticket(self, stage):
+        ticket = (PRIORITIES.get(stage or _stage.get(), PRIORITIES['default']), next(self._sequence))
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+        return ticket
+
+    def _withdraw(self, ticket):
+        with self._cond:
+            if ticket in self._waiters:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def _record_wait(self, stage, started):
+        waited = time.time() - started
+        if waited > 0.001:
+            ams_metrics.get_registry().observe('ams_scheduler_wait_seconds', waited, scheduler=self.name, stage=stage or _stage.get())
+
+    def acquire(self, stage=None):
+        '''Wait for a token (blocking), at the priority of `stage` (the current stage by default).'''
+        started = time.time()
+        ticket = self._ticket(stage)
+        granted = False
+        try:
+            with self._cond:
+                while True:
+                    wait = self._grant(ticket, time.time())
+                    if wait == 0:
+                        granted = True
+                        break
+                    self._cond.wait(wait)
+        finally:
+            if not granted:
+                self._withdraw(ticket)
+        self._record_wait(stage, started)
+
+    async def acquire_async(self, stage=None):
+        '''Wait for a token without blocking the event loop.'''
+        import asyncio   # only the asyncio API needs it, keep it off the start-up of the sync commands
+        started = time.time()
+        ticket = self._ticket(stage)
+        granted = False
+        try:
+            while True:
+                with self._cond:
+                    wait = self._grant(ticket, time.time())
+                if wait == 0:
+                    granted = True
+                    break
+                # not at the head of the queue yet: check again shortly
+                await asyncio.sleep(0.01 if wait is None else wait)
+        finally:
+            if not granted:
+                self._withdraw(ticket)
+        self._record_wait(stage, started)
+
+    def throttled(self, delay):
+        '''Record a throttled call: block the bucket for `delay` seconds and cut the rate.'''
+        with self._cond:
+            self.blocked_until = max(self.blocked_until, time.time() + delay)
+            self.tokens = 0.0
+            self.updated = time.time()
+            if self.max_rate is not None:
+                self.rate = max(self.max_rate * RATE_MIN, self.rate * RATE_DECREASE)
+        ams_metrics.get_registry().inc('ams_throttled_total', scheduler=self.name)
+
+    def succeeded(self):
+        '''Record a successful call: grow the rate back towards the configured one.'''
+        if self.max_rate is not None and self.rate < self.max_rate:
+            with self._cond:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RATE_INCREASE)
+
+    def retry_delay(self, attempt, method, status_code=None, headers=None, error=None):
+        '''Seconds to wait before retrying a call, None to give up.
+
+        Args:
+            attempt (int): Retries done so far.
+            method (str): HTTP method of the call.
+            status_code (int): Response status, None if the call raised `error`.
+            headers (dict): Response headers.
+            error (Exception): Connection error or timeout of the call.
+
+        Returns:
+            The delay in seconds, or None.
+        '''
+        if status_code in THROTTLE_STATUSES:
+            delay = retry_after(headers)
+            if delay is None:
+                delay = backoff(attempt)
+            self.throttled(delay)
+        elif (status_code in RETRY_STATUSES or (status_code is None and error is not None)) and method.upper() in IDEMPOTENT_METHODS:
+            delay = backoff(attempt)
+        else:
+            return None
+        if attempt >= MAX_RETRIES:
+            return None
+        ams_metrics.get_registry().inc('ams_retries_total', scheduler=self.name,
+                                       reason=str(status_code) if status_code is not None else type(error).__name__)
+        return delay
+
+    def call(self, send, method="GET", retry_exceptions=(), stage=None):
+        '''Run a call under the rate limit, retrying it while retry_delay() allows.
+
+        Args:
+            send (callable): Sends the request, returns a response with status_code and headers.
+            method (str): HTTP method (for the idempotency check).
+            retry_exceptions (tuple): Connection errors worth a retry.
+            stage (str): Stage priority, the current stage by default.
+
+        Returns:
+            The last response (successful, or the one retries gave up on).
+        '''
+        attempt = 0
+        while True:
+            self.acquire(stage)
+            try:
+                response = send()
+            except retry_exceptions as e:
+                delay = self.retry_delay(attempt, method, error=e)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(attempt, method, response.status_code, response.headers)
+                if delay is None:
+                    if response.status_code < 500 and response.status_code not in THROTTLE_STATUSES:
+                        self.succeeded()
+                    return response
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, send, method="GET", retry_exceptions=(), stage=None):
+        '''asyncio counterpart of call(): `send` is a coroutine function.'''
+        import asyncio
+        attempt = 0
+        while True:
+            await self.acquire_async(stage)
+            try:
+                response = await send()
+            except retry_exceptions as e:
+                delay = self.retry_delay(attempt, method, error=e)
+                if delay is None:
+                    raise
+            else:
+                delay = self.retry_delay(attempt, method, response.status_code, response.headers)
+                if delay is None:
+                    if response.status_code < 500 and response.status_code not in THROTTLE_STATUSES:
+                        self.succeeded()
+                    return response
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def storage_callbacks(self, stage=None):
+        '''request_callback and retry functions for an azure-storage service client.
+
+        Every request (and retry) of the client takes a token at the priority of
+        `stage`, the stage current when the client is configured by default (the
+        SDK sends from its own worker threads), and the retries follow retry_delay().
+
+        Returns:
+            (request_callback, retry)
+        '''
+        stage = stage or _stage.get()
+
+        def request_callback(request):
+            self.acquire(stage)
+
+        def retry(context):
+            attempt = getattr(context, 'count', 0)
+            response = context.response
+            delay = self.retry_delay(attempt, context.request.method, response.status if response is not None else None,
+                                     response.headers if response is not None else None, getattr(context, 'exception', None))
+            if delay is None:
+                return None
+            body = getattr(context.request, 'body', None)
+            if hasattr(body, 'read'):
+                # a stream body has to be rewound, or the retry would send it short
+                if getattr(context, 'body_position', None) is None:
+                    return None
+                body.seek(context.body_position)
+            context.count = attempt + 1
+            return delay
+
+        return request_callback, retry
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(name, rate=None, burst=1):
+    '''Return the shared RequestScheduler of an account (created with `rate` and `burst` on first use).'''
+    with _schedulers_lock:
+        scheduler = _schedulers.get(name)
+        if scheduler is None:
+            scheduler = _schedulers[name] = RequestScheduler(name, rate, burst)
+        return scheduler
+
+def for_ams(endpoint):
+    '''The scheduler of the AMS account behind an initial endpoint.'''
+    return get_scheduler('ams:' + str(endpoint), AMS_REQUESTS_PER_SECOND, AMS_BURST)
+
+def for_blob(account_name):
+    '''The scheduler of a storage account.'''
+    return get_scheduler('blob:' + str(account_name), BLOB_REQUESTS_PER_SECOND, BLOB_BURST)
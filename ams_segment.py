@@ -0,0 +1,607 @@
+# coding: utf-8
+
+#Segmenting mode: split long MP4s at keyframes, analyse the segments concurrently and stitch the results
+import os
+import sys
+import json
+import struct
+import argparse
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import ams_face_parser
+
+SEGMENT_SECONDS  = 300
+SEGMENT_WORKERS  = 8
+COPY_CHUNK_SIZE  = 1024 * 1024
+MATCH_SECONDS    = 1.0    # faces seen this close to a segment boundary are matched across it
+MATCH_MIN_IOU    = 0.3
+
+#----------------------------------------------------------------------------------------------
+# MP4 boxes
+
+def box(box_type, payload):
+    '''Serialize an MP4 box (64-bit size when needed).'''
+    if len(payload) + 8 <= 0xFFFFFFFF:
+        return struct.pack('>I4s', len(payload) + 8, box_type) + payload
+    return struct.pack('>I4sQ', 1, box_type, len(payload) + 16) + payload
+
+def iter_boxes(data, start=0, end=None):
+    '''Walk the boxes of an in-memory buffer.
+
+    Yields:
+        (type, payload start, box end) for each box.
+    '''
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header:
+            raise ValueError("MP4: invalid box size at " + str(pos))
+        yield box_type, pos + header, pos + size
+        pos += size
+
+def find_box(data, path, start=0, end=None):
+    '''Payload (start, end) of the first box at a '/'-separated path, or None.'''
+    box_type, _, rest = path.partition('/')
+    for found_type, payload_start, box_end in iter_boxes(data, start, end):
+        if found_type == box_type.encode('ascii'):
+            if rest:
+                return find_box(data, rest, payload_start, box_end)
+            return payload_start, box_end
+    return None
+
+def read_top_level_boxes(file):
+    '''Read ftyp and moov of an MP4 file (mdat is left on disk).
+
+    Returns:
+        (ftyp box bytes, moov payload bytes)
+    '''
+    file.seek(0, os.SEEK_END)
+    file_size = file.tell()
+    pos = 0
+    ftyp = moov = None
+    while pos + 8 <= file_size:
+        file.seek(pos)
+        size, box_type = struct.unpack('>I4s', file.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', file.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if box_type == b'ftyp':
+            file.seek(pos)
+            ftyp = file.read(size)
+        elif box_type == b'moov':
+            file.seek(pos + header)
+            moov = file.read(size - header)
+        pos += size
+    if moov is None:
+        raise ValueError("MP4: no moov box (fragmented or truncated file)")
+    return ftyp or b'', moov
+
+def _full_box_duration(data, start, durations_at):
+    '''(offset, 64 bit) of the duration field of mvhd/tkhd/mdhd for its version.'''
+    version = data[start]
+    return (start + durations_at[1], True) if version == 1 else (start + durations_at[0], False)
+
+def _patch_duration(payload, durations_at, duration):
+    payload = bytearray(payload)
+    offset, wide = _full_box_duration(payload, 0, durations_at)
+    struct.pack_into('>Q' if wide else '>I', payload, offset, min(duration, 0xFFFFFFFFFFFFFFFF if wide else 0xFFFFFFFF))
+    return bytes(payload)
+
+# duration field offsets in the payload, (version 0, version 1)
+MVHD_DURATION = (16, 24)
+TKHD_DURATION = (20, 28)
+MDHD_DURATION = (16, 24)
+
+def _unpack_array(typecode, fmt, data, pos, count):
+    return array(typecode, struct.unpack_from('>%d%s' % (count, fmt), data, pos))
+
+class Mp4Track(object):
+    '''Sample table of one track: per sample offset, size, decode time, duration, composition offset, sync flag.'''
+    def __init__(self, moov, trak_start, trak_end):
+        self.moov = moov
+        self.trak = (trak_start, trak_end)
+        self.trak_children = [(box_type, moov[payload_start:box_end]) for box_type, payload_start, box_end in iter_boxes(moov, trak_start, trak_end)]
+        tkhd = find_box(moov, 'tkhd', trak_start, trak_end)
+        self.tkhd = moov[tkhd[0]:tkhd[1]]
+        mdia = find_box(moov, 'mdia', trak_start, trak_end)
+        self.mdia_children = [(box_type, moov[payload_start:box_end]) for box_type, payload_start, box_end in iter_boxes(moov, *mdia)]
+        mdhd = find_box(moov, 'mdhd', *mdia)
+        self.mdhd = moov[mdhd[0]:mdhd[1]]
+        self.timescale = struct.unpack_from('>I', moov, mdhd[0] + (20 if moov[mdhd[0]] == 1 else 12))[0]
+        hdlr = find_box(moov, 'hdlr', *mdia)
+        self.hdlr = moov[hdlr[0]:hdlr[1]]
+        self.handler = moov[hdlr[0] + 8:hdlr[0] + 12].decode('ascii', 'replace')
+        minf = find_box(moov, 'minf', *mdia)
+        self.minf_children = [(box_type, moov[payload_start:box_end]) for box_type, payload_start, box_end in iter_boxes(moov, *minf) if box_type != b'stbl']
+        stbl = find_box(moov, 'stbl', *minf)
+        tables = dict((box_type, (payload_start, box_end)) for box_type, payload_start, box_end in iter_boxes(moov, *stbl))
+        self.stsd = moov[tables[b'stsd'][0]:tables[b'stsd'][1]]
+        # the segments are written with a single stsc entry
+        if struct.unpack_from('>I', self.stsd, 4)[0] != 1:
+            raise ValueError("MP4: unsupported track with " + str(struct.unpack_from('>I', self.stsd, 4)[0]) + " sample descriptions")
+
+        # edit list: an optional leading empty edit (presentation delay, movie ticks) then one media edit
+        self.edit_delay = 0
+        self.edit_media_time = None
+        self.elst_version = 0
+        elst = find_box(moov, 'edts/elst', trak_start, trak_end)
+        if elst is not None:
+            self.elst_version = moov[elst[0]]
+            fmt = '>QqhH' if self.elst_version == 1 else '>IihH'
+            entries = struct.unpack_from('>I', moov, elst[0] + 4)[0]
+            edits = [struct.unpack_from(fmt, moov, elst[0] + 8 + index * struct.calcsize(fmt)) for index in range(entries)]
+            if edits and edits[0][1] == -1:
+                self.edit_delay = edits[0][0]
+                edits = edits[1:]
+            if len(edits) > 1 or any(edit[1] < 0 or edit[2] != 1 for edit in edits):
+                raise ValueError("MP4: unsupported edit list (" + str(entries) + " edits)")
+            self.edit_media_time = edits[0][1] if edits else 0
+
+        # sample sizes
+        if b'stsz' not in tables:
+            raise ValueError("MP4: unsupported sample size table (stz2)")
+        pos = tables[b'stsz'][0]
+        sample_size, count = struct.unpack_from('>II', moov, pos + 4)
+        self.sizes = _unpack_array('L', 'I', moov, pos + 12, count) if sample_size == 0 else array('L', [sample_size]) * count
+        self.count = count
+
+        # decode times and durations
+        pos = tables[b'stts'][0]
+        entries = struct.unpack_from('>I', moov, pos + 4)[0]
+        runs = struct.unpack_from('>%dI' % (2 * entries), moov, pos + 8)
+        self.durations = array('q')
+        for index in range(entries):
+            self.durations.extend(array('q', [runs[2 * index + 1]]) * runs[2 * index])
+        self.dts = array('q', [0]) * count
+        time = 0
+        for index in range(count):
+            self.dts[index] = time
+            time += self.durations[index]
+        self.duration = time
+
+        # composition offsets
+        self.ctts_version = 0
+        self.cts = None
+        if b'ctts' in tables:
+            pos = tables[b'ctts'][0]
+            self.ctts_version = moov[pos]
+            entries = struct.unpack_from('>I', moov, pos + 4)[0]
+            runs = struct.unpack_from('>' + ('Ii' if self.ctts_version == 1 else 'II') * entries, moov, pos + 8)
+            self.cts = array('q')
+            for index in range(entries):
+                self.cts.extend(array('q', [runs[2 * index + 1]]) * runs[2 * index])
+
+        # sync samples (all samples are sync samples without stss)
+        self.sync = None
+        if b'stss' in tables:
+            pos = tables[b'stss'][0]
+            entries = struct.unpack_from('>I', moov, pos + 4)[0]
+            self.sync = [number - 1 for number in struct.unpack_from('>%dI' % entries, moov, pos + 8)]
+
+        # chunk offsets -> sample offsets
+        if b'co64' in tables:
+            pos = tables[b'co64'][0]
+            entries = struct.unpack_from('>I', moov, pos + 4)[0]
+            chunk_offsets = struct.unpack_from('>%dQ' % entries, moov, pos + 8)
+        else:
+            pos = tables[b'stco'][0]
+            entries = struct.unpack_from('>I', moov, pos + 4)[0]
+            chunk_offsets = struct.unpack_from('>%dI' % entries, moov, pos + 8)
+        pos = tables[b'stsc'][0]
+        entries = struct.unpack_from('>I', moov, pos + 4)[0]
+        stsc = struct.unpack_from('>%dI' % (3 * entries), moov, pos + 8)
+        self.offsets = array('q', [0]) * count
+        sample = 0
+        for index in range(entries):
+            first_chunk = stsc[3 * index]
+            last_chunk = stsc[3 * (index + 1)] if index + 1 < entries else len(chunk_offsets) + 1
+            samples_per_chunk = stsc[3 * index + 1]
+            for chunk in range(first_chunk, last_chunk):
+                offset = chunk_offsets[chunk - 1]
+                for _ in range(samples_per_chunk):
+                    if sample >= count:
+                        break
+                    self.offsets[sample] = offset
+                    offset += self.sizes[sample]
+                    sample += 1
+
+    def sync_samples(self):
+        '''Indexes of the sync (key) samples.'''
+        return self.sync if self.sync is not None else list(range(self.count))
+
+    def samples_between(self, start_seconds, end_seconds):
+        '''Range of the samples decoded in [start_seconds, end_seconds).'''
+        from bisect import bisect_left
+        first = bisect_left(self.dts, int(round(start_seconds * self.timescale)))
+        last = self.count if end_seconds is None else bisect_left(self.dts, int(round(end_seconds * self.timescale)))
+        return range(first, last)
+
+    def build_trak(self, samples, data_offset, movie_timescale):
+        '''Serialize this track restricted to `samples`, its data starting at `data_offset`.
+
+        The samples are laid out back to back, one sample per chunk, so the
+        chunk offsets are the running offsets of the samples. The media edit
+        is kept (its media time is relative to the first sample, a keyframe)
+        but not the empty edit: the segment starts at its first sample, see
+        Mp4File.presentation_delay. The other trak boxes are copied as is.
+
+        Returns:
+            (trak box bytes, size of the sample data)
+        '''
+        samples = list(samples)
+        durations = [self.durations[index] for index in samples]
+        duration = sum(durations)
+
+        def runs(values):
+            encoded = []
+            for value in values:
+                if encoded and encoded[-1][1] == value:
+                    encoded[-1][0] += 1
+                else:
+                    encoded.append([1, value])
+            return encoded
+
+        stts = runs(durations)
+        tables = [box(b'stsd', self.stsd),
+                  box(b'stts', struct.pack('>II', 0, len(stts)) + b''.join(struct.pack('>II', count, value) for count, value in stts))]
+        if self.cts is not None:
+            ctts = runs([self.cts[index] for index in samples])
+            fmt = '>Ii' if self.ctts_version == 1 else '>II'
+            tables.append(box(b'ctts', struct.pack('>BxxxI', self.ctts_version, len(ctts)) + b''.join(struct.pack(fmt, count, value) for count, value in ctts)))
+        if self.sync is not None:
+            sync = set(self.sync)
+            numbers = [number + 1 for number, index in enumerate(samples) if index in sync]
+            tables.append(box(b'stss', struct.pack('>II', 0, len(numbers)) + struct.pack('>%dI' % len(numbers), *numbers)))
+        tables.append(box(b'stsc', struct.pack('>IIIII', 0, 1, 1, 1, 1)))
+        sizes = [self.sizes[index] for index in samples]
+        tables.append(box(b'stsz', struct.pack('>III', 0, 0, len(sizes)) + struct.pack('>%dI' % len(sizes), *sizes)))
+        offsets = []
+        offset = data_offset
+        for size in sizes:
+            offsets.append(offset)
+            offset += size
+        tables.append(box(b'co64', struct.pack('>II', 0, len(offsets)) + struct.pack('>%dQ' % len(offsets), *offsets)))
+
+        minf = b''.join(box(box_type, payload) for box_type, payload in self.minf_children) + box(b'stbl', b''.join(tables))
+        rebuilt = {b'mdhd': _patch_duration(self.mdhd, MDHD_DURATION, duration), b'minf': minf}
+        mdia = b''.join(box(box_type, rebuilt.get(box_type, payload)) for box_type, payload in self.mdia_children)
+        movie_duration = duration * movie_timescale // self.timescale
+        rebuilt = {b'tkhd': _patch_duration(self.tkhd, TKHD_DURATION, movie_duration), b'mdia': mdia}
+        if self.edit_media_time is not None:
+            fmt = '>QqhH' if self.elst_version == 1 else '>IihH'
+            rebuilt[b'edts'] = box(b'elst', struct.pack('>BxxxI', self.elst_version, 1) + struct.pack(fmt, movie_duration, self.edit_media_time, 1, 0))
+        trak = box(b'trak', b''.join(box(box_type, rebuilt.get(box_type, payload)) for box_type, payload in self.trak_children))
+        return trak, offset - data_offset
+
+class Mp4File(object):
+    '''The tracks of a (non-fragmented) MP4 file.
+
+    Args:
+        path (str): MP4 file path.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, mode='rb') as file:
+            self.ftyp, self.moov = read_top_level_boxes(file)
+        mvhd = find_box(self.moov, 'mvhd')
+        self.mvhd = self.moov[mvhd[0]:mvhd[1]]
+        self.timescale = struct.unpack_from('>I', self.mvhd, 20 if self.mvhd[0] == 1 else 12)[0]
+        self.tracks = [Mp4Track(self.moov, payload_start, box_end) for box_type, payload_start, box_end in iter_boxes(self.moov) if box_type == b'trak']
+        videos = [track for track in self.tracks if track.handler == 'vide']
+        if not videos:
+            raise ValueError("MP4: no video track")
+        self.video = videos[0]
+        # seconds before the first video sample is presented (empty edit), added to the segment starts
+        self.presentation_delay = self.video.edit_delay / float(self.timescale)
+
+    def keyframe_cuts(self, segment_seconds):
+        '''Cut times (seconds) at the first keyframe at or after each multiple of segment_seconds.'''
+        video = self.video
+        cuts = [0.0]
+        target = segment_seconds
+        for index in video.sync_samples():
+            seconds = video.dts[index] / float(video.timescale)
+            if seconds >= target:
+                cuts.append(seconds)
+                while target <= seconds:
+                    target += segment_seconds
+        return cuts
+
+    def write_segment(self, output_path, start_seconds, end_seconds):
+        '''Write the samples decoded in [start_seconds, end_seconds) as a standalone MP4.
+
+        The sample data is copied from the source file in coalesced ranges, never
+        holding more than COPY_CHUNK_SIZE bytes.
+        '''
+        selections = [(track, track.samples_between(start_seconds, end_seconds)) for track in self.tracks]
+        selections = [(track, samples) for track, samples in selections if len(samples)]
+
+        # the moov size does not depend on the offsets (co64 everywhere), so build it twice
+        def build_moov(data_offset):
+            traks = []
+            offset = data_offset
+            movie_duration = 0
+            for track, samples in selections:
+                trak, size = track.build_trak(samples, offset, self.timescale)
+                traks.append(trak)
+                offset += size
+                movie_duration = max(movie_duration, sum(track.durations[index] for index in samples) * self.timescale // track.timescale)
+            moov = box(b'moov', box(b'mvhd', _patch_duration(self.mvhd, MVHD_DURATION, movie_duration)) + b''.join(traks))
+            return moov, offset - data_offset
+
+        moov, data_size = build_moov(0)
+        mdat_header = 16 if data_size + 8 > 0xFFFFFFFF else 8
+        moov, data_size = build_moov(len(self.ftyp) + len(moov) + mdat_header)
+
+        with open(self.path, mode='rb') as source, open(output_path, mode='wb') as output:
+            output.write(self.ftyp)
+            output.write(moov)
+            if mdat_header == 16:
+                output.write(struct.pack('>I4sQ', 1, b'mdat', data_size + 16))
+            else:
+                output.write(struct.pack('>I4s', data_size + 8, b'mdat'))
+            for track, samples in selections:
+                for offset, size in _coalesce((track.offsets[index], track.sizes[index]) for index in samples):
+                    source.seek(offset)
+                    while size:
+                        chunk = source.read(min(size, COPY_CHUNK_SIZE))
+                        if not chunk:
+                            raise ValueError("MP4: sample data beyond the end of " + self.path)
+                        output.write(chunk)
+                        size -= len(chunk)
+        return output_path
+
+def _coalesce(ranges):
+    '''Merge adjacent (offset, size) ranges.'''
+    current = None
+    for offset, size in ranges:
+        if current is not None and current[0] + current[1] == offset:
+            current[1] += size
+            continue
+        if current is not None:
+            yield current[0], current[1]
+        current = [offset, size]
+    if current is not None:
+        yield current[0], current[1]
+
+def split_mp4(video_path, segment_seconds=SEGMENT_SECONDS, output_dir=None):
+    '''Split an MP4 into keyframe-aligned segments, without re-encoding.
+
+    Args:
+        video_path (str): Source MP4 path.
+        segment_seconds (float): Target segment length.
+        output_dir (str): Where to write the segments, next to the video by default.
+
+    Returns:
+        A list of (segment path, start seconds in the source's presentation time).
+    '''
+    mp4 = Mp4File(video_path)
+    cuts = mp4.keyframe_cuts(segment_seconds)
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(video_path))
+    name = os.path.splitext(os.path.basename(video_path))[0]
+    segments = []
+    for index, start in enumerate(cuts):
+        end = cuts[index + 1] if index + 1 < len(cuts) else None
+        segment_path = os.path.join(output_dir, '{0}_part{1:03d}.mp4'.format(name, index))
+        mp4.write_segment(segment_path, start, end)
+        segments.append((segment_path, start + mp4.presentation_delay))
+    return segments
+
+#----------------------------------------------------------------------------------------------
+# Stitching the per segment Face Detector outputs
+
+def _iou(a, b):
+    x1 = max(a[0], b[0])
+    y1 = max(a[1], b[1])
+    x2 = min(a[0] + a[2], b[0] + b[2])
+    y2 = min(a[1] + a[3], b[1] + b[3])
+    inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+def _iter_faces(fragment):
+    start = fragment.get('start', 0)
+    interval = fragment.get('interval', 0)
+    for index, event in enumerate(fragment.get('events') or ()):
+        for face in event:
+            if isinstance(face, dict) and 'id' in face:
+                yield start + index * interval, face
+
+def _face_box(face):
+    return (face.get('x', 0.0), face.get('y', 0.0), face.get('width', 0.0), face.get('height', 0.0))
+
+def _head_boxes(json_path, window_ticks):
+    '''First box of each face id seen in the first window_ticks of an output.'''
+    boxes = {}
+    with open(json_path, encoding='utf-8') as file:
+        for kind, key, value in ams_face_parser.iter_output(file):
+            if kind != 'fragment':
+                continue
+            if value.get('start', 0) >= window_ticks:
+                break
+            for timestamp, face in _iter_faces(value):
+                if timestamp < window_ticks and face['id'] not in boxes:
+                    boxes[face['id']] = _face_box(face)
+    return boxes
+
+def merge_face_outputs(parts, output_path, match_seconds=MATCH_SECONDS, min_iou=MATCH_MIN_IOU):
+    '''Merge per-segment Face Detector outputs into one output.
+
+    Fragment times are shifted by each segment's start. Face ids are made
+    global: a face seen at the start of a segment keeps the id of the face it
+    overlaps most (IoU >= min_iou) at the end of the previous segment, other
+    faces get new ids. The end of a segment is the start of the next one, so
+    only the faces still on screen in its last match_seconds are continued.
+    The merged output is written fragment by fragment.
+
+    Args:
+        parts (list): (Face Detector JSON path, segment start seconds), in order.
+        output_path (str): Merged JSON output path.
+        match_seconds (float): How close to a boundary faces are matched.
+        min_iou (float): Minimum box overlap to continue a face across a boundary.
+
+    Returns:
+        The number of distinct faces in the merged output.
+    '''
+    next_face = 0
+    tail = {}
+    metadata = None
+    first_fragment = True
+    with open(output_path, 'w', encoding='utf-8') as output:
+        for index, (json_path, start_seconds) in enumerate(parts):
+            with open(json_path, encoding='utf-8') as file:
+                header = dict((key, value) for kind, key, value in _iter_header(file))
+            timescale = header.get('timescale') or 1
+            if metadata is None:
+                metadata = header
+                out_timescale = timescale
+                output.write('{' + ''.join(json.dumps(key) + ':' + json.dumps(value) + ',' for key, value in metadata.items()) + '"fragments":[')
+            shift = int(round(start_seconds * out_timescale))
+            scale = out_timescale / float(timescale)
+            window = int(match_seconds * timescale)
+            # end of this segment in its own ticks (no tail after the last one)
+            boundary = int(round((parts[index + 1][1] - start_seconds) * timescale)) if index + 1 < len(parts) else None
+
+            # continue the faces of the previous segment's tail
+            mapping = {}
+            candidates = sorted(((_iou(box_a, box_b), local_id, global_id) for local_id, box_a in _head_boxes(json_path, window).items()
+                                 for global_id, box_b in tail.items()), reverse=True)
+            used = set()
+            for iou, local_id, global_id in candidates:
+                if iou < min_iou:
+                    break
+                if local_id in mapping or global_id in used:
+                    continue
+                mapping[local_id] = global_id
+                used.add(global_id)
+
+            last_seen = {}
+            with open(json_path, encoding='utf-8') as file:
+                for kind, key, fragment in ams_face_parser.iter_output(file):
+                    if kind != 'fragment':
+                        continue
+                    for timestamp, face in _iter_faces(fragment):
+                        local_id = face['id']
+                        if local_id not in mapping:
+                            mapping[local_id] = next_face
+                            next_face += 1
+                        face['id'] = mapping[local_id]
+                        last_seen[face['id']] = (timestamp, _face_box(face))
+                    for field in ('start', 'duration', 'interval'):
+                        if field in fragment:
+                            fragment[field] = int(round(fragment[field] * scale))
+                    fragment['start'] = fragment.get('start', 0) + shift
+                    if not first_fragment:
+                        output.write(',')
+                    output.write(json.dumps(fragment, separators=(',', ':')))
+                    first_fragment = False
+            tail = {}
+            if boundary is not None:
+                tail = dict((global_id, face_box) for global_id, (timestamp, face_box) in last_seen.items() if timestamp >= boundary - window)
+        if metadata is None:
+            output.write('{"fragments":[')
+        output.write(']}')
+    return next_face
+
+def _iter_header(file):
+    for kind, key, value in ams_face_parser.iter_output(file):
+        if kind == 'fragment':
+            return
+        yield kind, key, value
+
+def find_face_output(result_paths):
+    '''The Face Detector output among the downloaded results of a job (the JSON with fragments).'''
+    for result_path in result_paths:
+        if not result_path.endswith('.json'):
+            continue
+        try:
+            with open(result_path, encoding='utf-8') as file:
+                for kind, key, value in ams_face_parser.iter_output(file):
+                    if kind == 'fragment':
+                        return result_path
+        except (IOError, ValueError):
+            continue
+    return None
+
+#----------------------------------------------------------------------------------------------
+# Segmented analysis
+
+def analyse_segmented(access_token, video_path, sto_account_name, sto_accountKey, segment_seconds=SEGMENT_SECONDS, workers=SEGMENT_WORKERS, output_path=None):
+    '''Analyse a long video as concurrent Face Detector jobs over its segments.
+
+    Args:
+        access_token (str): A valid Azure authentication token.
+        video_path (str): MP4 path.
+        sto_account_name (str): Storage account name.
+        sto_accountKey (str): Storage account key.
+        segment_seconds (float): Target segment length.
+        workers (int): Segments uploaded and analysed at once.
+        output_path (str): Merged output path, OUTPUT_FOLDER + name + '_merged.json' by default.
+
+    Returns:
+        The merged output path, or None if a segment failed.
+    '''
+    import ams_face_track_api as ams
+    segments = split_mp4(video_path, segment_seconds)
+    print("Video Segments..........................: " + str(len(segments)))
+
+    def analyse(segment):
+        segment_path, start_seconds = segment
+        name = os.path.basename(segment_path)
+        processor_id, asset_id = ams.upload_video(access_token, name, sto_account_name, segment_path)
+        job_id, result_paths = ams.get_face_track_emotion(access_token, processor_id, asset_id, sto_account_name, sto_accountKey, 'analysed_' + name)
+        return find_face_output(result_paths), start_seconds
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parts = list(executor.map(analyse, segments))
+    finally:
+        for segment_path, start_seconds in segments:
+            os.remove(segment_path)
+    if any(json_path is None for json_path, start_seconds in parts):
+        print("Segmented Analysis......................: ERROR, a segment has no Face Detector output")
+        return None
+
+    if output_path is None:
+        output_path = ams.OUTPUT_FOLDER + os.path.basename(video_path) + '_merged.json'
+    faces = merge_face_outputs(parts, output_path)
+    print("Merged Results..........................: " + output_path + " (" + str(faces) + " faces)")
+    if ams.STORE_RESULTS:
+        import ams_results
+        ams_results.ResultsStore().ingest(ams_results.result_video_key(output_path), output_path)
+    return output_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Azure Media Analytics - Face Detector on a long video, in concurrent segments')
+    parser.add_argument('video', help='MP4 video path')
+    parser.add_argument('--segment-seconds', type=float, default=SEGMENT_SECONDS)
+    parser.add_argument('--workers', type=int, default=SEGMENT_WORKERS)
+    parser.add_argument('--config', default=None)
+    parser.add_argument('--split-only', action='store_true', help='only write the segments next to the video')
+    args = parser.parse_args(argv)
+    if args.split_only:
+        for segment_path, start_seconds in split_mp4(args.video, args.segment_seconds):
+            print('{0:10.3f}s {1}'.format(start_seconds, segment_path))
+        return 0
+
+    import ams_face_track_api as ams
+    configData = ams.load_config(args.config or ams.CONFIG_FILE)
+    access_token, ams_redirected_rest_endpoint = ams.get_access_token_with_rest_end(configData['tenant_id'], configData['application_id'], configData['accountKey'])
+    ams.configure_ams_client(pool_maxsize=max(ams.ams_pool_maxsize, 2 * args.workers))
+    output_path = analyse_segmented(access_token, args.video, configData['sto_accountName'], configData['sto_accountKey'], args.segment_seconds, args.workers)
+    return 0 if output_path else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,76 @@
+# coding: utf-8
+
+#Tests of the workflow journal's resume state machine
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ams_journal
+
+def _video(tmp_path, content=b'video'):
+    path = str(tmp_path / 'video.mp4')
+    with open(path, 'wb') as file:
+        file.write(content)
+    return path
+
+def _analysed(journal, path):
+    journal.update(path, 'assetfile_updated', asset_id='asset-1', assetfile_id='file-1')
+    journal.update(path, 'job_submitted', job_id='job-1', output_asset='analysed_video.mp4')
+    journal.update(path, 'job_finished', job={'Id': 'job-1', 'State': 3}, job_state="3")
+    journal.update(path, 'downloaded', result_paths=['output/video.json'])
+    return journal.update(path, 'done')
+
+def test_resume_same_video_and_configuration(tmp_path):
+    journal = ams_journal.WorkflowJournal(':memory:')
+    path = _video(tmp_path)
+    journal.start(path, 'config-a')
+    _analysed(journal, path)
+    entry = journal.start(path, 'config-a')
+    assert entry['state'] == 'done'
+    assert entry['result_paths'] == ['output/video.json']
+
+def test_configuration_change_reuses_the_upload(tmp_path):
+    journal = ams_journal.WorkflowJournal(':memory:')
+    path = _video(tmp_path)
+    journal.start(path, 'config-a')
+    _analysed(journal, path)
+    entry = journal.start(path, 'config-b')
+    assert entry['state'] == 'assetfile_updated'
+    assert entry['asset_id'] == 'asset-1'
+    assert entry['job_id'] is None and entry['result_paths'] is None
+    assert entry['configuration_digest'] == 'config-b'
+    # no configuration given: not checked
+    assert journal.start(path)['state'] == 'assetfile_updated'
+
+def test_configuration_set_before_the_job(tmp_path):
+    journal = ams_journal.WorkflowJournal(':memory:')
+    path = _video(tmp_path)
+    journal.start(path, 'config-a')
+    journal.update(path, 'uploaded', asset_id='asset-1')
+    entry = journal.start(path, 'config-b')
+    assert entry['state'] == 'uploaded'
+    assert entry['configuration_digest'] == 'config-b'
+
+def test_changed_video_starts_over(tmp_path):
+    journal = ams_journal.WorkflowJournal(':memory:')
+    path = _video(tmp_path)
+    journal.start(path, 'config-a')
+    _analysed(journal, path)
+    _video(tmp_path, b'another video')
+    entry = journal.start(path, 'config-a')
+    assert entry['state'] == 'new'
+    assert entry['asset_id'] is None and entry['job_id'] is None and entry['result_paths'] is None
+    assert entry['video_stamp'] == ams_journal.video_stamp(path)
+
+def test_journal_without_the_new_columns(tmp_path):
+    import sqlite3
+    database = str(tmp_path / 'journal.db')
+    connection = sqlite3.connect(database)
+    connection.execute('CREATE TABLE videos (key TEXT PRIMARY KEY, state TEXT NOT NULL, created REAL, updated REAL, video_path TEXT, asset_id TEXT)')
+    connection.commit()
+    connection.close()
+    journal = ams_journal.WorkflowJournal(database)
+    path = _video(tmp_path)
+    assert journal.start(path, 'config-a')['configuration_digest'] == 'config-a'
+    journal.close()
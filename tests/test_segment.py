@@ -0,0 +1,127 @@
+# coding: utf-8
+
+#Tests of the segmenting mode: output stitching and MP4 splitting
+import os
+import sys
+import json
+import struct
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ams_segment
+
+TIMESCALE = 1000
+
+def _write_output(path, fragments):
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({'version': 1, 'timescale': TIMESCALE, 'offset': 0, 'framerate': 1, 'width': 640, 'height': 360, 'fragments': fragments}, file)
+
+def _face(face_id, x=0.1, y=0.1):
+    return {'id': face_id, 'x': x, 'y': y, 'width': 0.2, 'height': 0.2}
+
+def _merged_ids(path):
+    with open(path, encoding='utf-8') as file:
+        merged = json.load(file)
+    return [[face['id'] for event in fragment['events'] for face in event] for fragment in merged['fragments']]
+
+def test_merge_continues_faces_across_a_boundary(tmp_path):
+    first = str(tmp_path / 'part000.json')
+    second = str(tmp_path / 'part001.json')
+    # face 0 is on screen up to the end of the 300 s segment
+    _write_output(first, [{'start': 0, 'duration': 300000, 'interval': 299500, 'events': [[_face(0)], [_face(0)]]}])
+    _write_output(second, [{'start': 0, 'duration': 1000, 'interval': 1000, 'events': [[_face(7)]]}])
+    faces = ams_segment.merge_face_outputs([(first, 0.0), (second, 300.0)], str(tmp_path / 'merged.json'))
+    assert faces == 1
+    assert _merged_ids(str(tmp_path / 'merged.json')) == [[0, 0], [0]]
+
+def test_merge_ignores_faces_gone_before_the_boundary(tmp_path):
+    first = str(tmp_path / 'part000.json')
+    second = str(tmp_path / 'part001.json')
+    # face 0 was last seen at 10 s of a 300 s segment: the face at the start of the next one is another face
+    _write_output(first, [{'start': 0, 'duration': 300000, 'interval': 10000, 'events': [[_face(0)], [_face(0)]]}])
+    _write_output(second, [{'start': 0, 'duration': 1000, 'interval': 1000, 'events': [[_face(0)]]}])
+    faces = ams_segment.merge_face_outputs([(first, 0.0), (second, 300.0)], str(tmp_path / 'merged.json'))
+    assert faces == 2
+    assert _merged_ids(str(tmp_path / 'merged.json')) == [[0, 0], [1]]
+
+#----------------------------------------------------------------------------------------------
+# A small MP4: a 5 s video track (keyframe every 2 s, B-frame delay, edit list, udta) and an audio track
+
+box = ams_segment.box
+
+def _full(box_type, version, payload):
+    return box(box_type, bytes([version, 0, 0, 0]) + payload)
+
+def _trak(track_id, handler, timescale, durations, sizes, chunk_offsets, samples_per_chunk, sync=None, cts=None, edits=None, descriptions=1):
+    duration = sum(durations)
+    tables = [_full(b'stsd', 0, struct.pack('>I', descriptions) + box(b'mp4v', b'\0' * 8) * descriptions),
+              _full(b'stts', 0, struct.pack('>I', len(durations)) + b''.join(struct.pack('>II', 1, value) for value in durations)),
+              _full(b'stsc', 0, struct.pack('>IIII', 1, 1, samples_per_chunk, 1)),
+              _full(b'stsz', 0, struct.pack('>II', 0, len(sizes)) + b''.join(struct.pack('>I', size) for size in sizes)),
+              _full(b'stco', 0, struct.pack('>I', len(chunk_offsets)) + b''.join(struct.pack('>I', offset) for offset in chunk_offsets))]
+    if sync is not None:
+        tables.append(_full(b'stss', 0, struct.pack('>I', len(sync)) + b''.join(struct.pack('>I', number + 1) for number in sync)))
+    if cts is not None:
+        tables.append(_full(b'ctts', 0, struct.pack('>I', len(cts)) + b''.join(struct.pack('>II', 1, value) for value in cts)))
+    mdia = (_full(b'mdhd', 0, struct.pack('>IIII', 0, 0, timescale, duration) + b'\0' * 4)
+            + _full(b'hdlr', 0, b'\0' * 4 + handler + b'\0' * 13)
+            + box(b'minf', box(b'dinf', b'') + box(b'stbl', b''.join(tables))))
+    trak = _full(b'tkhd', 0, struct.pack('>IIIII', 0, 0, track_id, 0, duration) + b'\0' * 60)
+    if edits is not None:
+        trak += box(b'edts', _full(b'elst', 0, struct.pack('>I', len(edits)) + b''.join(struct.pack('>IihH', *edit) for edit in edits)))
+    trak += box(b'mdia', mdia) + box(b'udta', box(b'name', handler))
+    return box(b'trak', trak)
+
+def _write_mp4(path, descriptions=1):
+    video_sizes = [100 + index for index in range(10)]
+    audio_sizes = [10 + index for index in range(20)]
+    ftyp = box(b'ftyp', b'isom\0\0\0\0isom')
+
+    def build(data_offset):
+        video_offsets = [data_offset + sum(video_sizes[:index]) for index in (0, 5)]
+        audio_start = data_offset + sum(video_sizes)
+        audio_offsets = [audio_start + sum(audio_sizes[:index]) for index in range(0, 20, 4)]
+        return box(b'moov', _full(b'mvhd', 0, struct.pack('>IIII', 0, 0, 1000, 5000) + b'\0' * 80)
+                   + _trak(1, b'vide', 1000, [500] * 10, video_sizes, video_offsets, 5, sync=[0, 4, 8], cts=[500] * 10,
+                           edits=[(250, -1, 1, 0), (5000, 500, 1, 0)], descriptions=descriptions)
+                   + _trak(2, b'soun', 100, [25] * 20, audio_sizes, audio_offsets, 4))
+
+    moov = build(0)
+    moov = build(len(ftyp) + len(moov) + 8)
+    data = b''.join(bytes([index % 256]) * size for index, size in enumerate(video_sizes + audio_sizes))
+    with open(path, 'wb') as file:
+        file.write(ftyp + moov + box(b'mdat', data))
+
+def _samples(mp4, track):
+    with open(mp4.path, 'rb') as file:
+        data = file.read()
+    return [data[track.offsets[index]:track.offsets[index] + track.sizes[index]] for index in range(track.count)]
+
+def test_split_round_trip(tmp_path):
+    source = str(tmp_path / 'video.mp4')
+    _write_mp4(source)
+    original = ams_segment.Mp4File(source)
+    segments = ams_segment.split_mp4(source, 2, str(tmp_path))
+    # cut at the keyframes, shifted by the 0.25 s empty edit
+    assert [start for path, start in segments] == [0.25, 2.25, 4.25]
+
+    videos, audios = [], []
+    for path, start in segments:
+        segment = ams_segment.Mp4File(path)
+        video, audio = segment.tracks
+        assert video.sync_samples()[0] == 0
+        assert (video.edit_delay, video.edit_media_time) == (0, 500)
+        assert list(video.cts) == [500] * video.count
+        assert (b'udta', ams_segment.box(b'name', b'vide')) in video.trak_children
+        videos += _samples(segment, video)
+        audios += _samples(segment, audio)
+    assert videos == _samples(original, original.tracks[0])
+    assert audios == _samples(original, original.tracks[1])
+
+def test_split_rejects_several_sample_descriptions(tmp_path):
+    source = str(tmp_path / 'video.mp4')
+    _write_mp4(source, descriptions=2)
+    with pytest.raises(ValueError):
+        ams_segment.Mp4File(source)